@@ -1,11 +1,41 @@
 import time
-import json
-import os
-from openai import OpenAI
+import asyncio
+from LLM.client_pool import get_client, get_async_client, get_async_semaphore
+from LLM.rate_limiter import get_limiter, estimate_tokens, on_call_error
+from LLM.early_stop import collect_stream, collect_stream_async
+from LLM.hedging import hedged_request
+from LLM.errors import LLMConfigError, LLMCallFailed
+from LLM.ledger import note_retry, note_usage
+from LLM.usage_stats import record_prompt_cache
 
-def DS_output(messages, temperature=1, model="deepseek-reasoner", max_retries=3, max_token=8192):
+def _parse_response(response, model):
     """
-    Initializes the client by reading a configuration file, calls the language model API, supports retries,
+    Extracts token usage, reasoning content and content from a non-streaming chat completion.
+    """
+    token_data = {
+        "model": model,
+        "prompt_tokens": response.usage.prompt_tokens,
+        "completion_tokens": response.usage.completion_tokens,
+        "total_tokens": response.usage.total_tokens
+    }
+    # DeepSeek context caching: prompt_cache_hit_tokens / prompt_cache_miss_tokens
+    cache_tokens = record_prompt_cache(model, response.usage)
+    note_usage(response.usage)
+    if cache_tokens is not None:
+        token_data["prompt_cache_hit_tokens"], token_data["prompt_cache_miss_tokens"] = cache_tokens
+
+    if model == "deepseek-reasoner":
+        content = response.choices[0].message.content
+        reasoning_content = response.choices[0].message.reasoning_content
+    else:
+        content = response.choices[0].message.content
+        reasoning_content = ""
+
+    return token_data, reasoning_content, content
+
+def DS_output(messages, temperature=1, model="deepseek-reasoner", max_retries=3, max_token=8192, stop_when=None):
+    """
+    Calls the language model API through the shared DeepSeek client, supports retries,
     and returns token usage and model output.
 
     Parameters:
@@ -14,53 +44,28 @@ def DS_output(messages, temperature=1, model="deepseek-reasoner", max_retries=3,
     model (str): The name of the model to use.
     max_retries (int): The maximum number of retries after a failure.
     max_token (int): Specifies the maximum number of tokens for the model to generate.
+    stop_when (str or callable): Optional early-stop condition ("json", "answer", "sql" or a callable, see LLM/early_stop.py).
+                                 When set, the response is streamed and closed as soon as the condition is met.
 
     Returns:
     tuple: A tuple containing four values (input_token_count, output_token_count, reasoning_content, content).
-           If there is a configuration error or the API call fails completely, it will return a tuple with an error message.
+
+    Raises:
+    LLMConfigError: If the "DeepSeek-AI" configuration is missing or invalid.
+    LLMCallFailed: If every attempt failed.
     """
     
-    # --- 1. Read and validate the configuration file ---
+    # --- 1. Get the pooled client (the configuration is read and validated once per process) ---
     try:
-        # Get the directory where the current script file is located
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        config_path = os.path.join(current_dir, "LLM_config.json")
-
-        # Check if the configuration file exists
-        if not os.path.exists(config_path):
-            raise FileNotFoundError(f"Configuration file not found. Please ensure the {config_path} file exists.")
-
-        with open(config_path, 'r', encoding='utf-8') as f:
-            config = json.load(f)
-
-        # Check if the 'DeepSeek-AI' configuration exists
-        if "DeepSeek-AI" not in config:
-            raise KeyError("The 'DeepSeek-AI' configuration item is missing in the LLM_config.json file.")
-
-        deepseek_config = config["DeepSeek-AI"]
-        
-        # Check if url and key exist and are not empty
-        url = deepseek_config.get("url")
-        key = deepseek_config.get("key")
-
-        if not url: # Covers cases where the key is missing or the value is an empty string ""
-            raise ValueError("In the 'DeepSeek-AI' configuration, the 'url' field is missing or empty.")
-        
-        if not key:
-            raise ValueError("In the 'DeepSeek-AI' configuration, the 'key' field is missing or empty.")
-
-        # --- 2. Initialize the API client ---
-        client = OpenAI(api_key=key, base_url=url)
+        client = get_client("DeepSeek-AI")
 
     except Exception as e:
-        # Capture all exceptions during the configuration phase and format the return
-        error_message = f"LLM configuration error: {str(e)}"
-        print(error_message)
-        return 0, 0, "", error_message
+        raise LLMConfigError(f"LLM configuration error: {str(e)}") from e
 
-    # --- 3. Core logic for API calls (with retry mechanism) ---
+    # --- 2. Core logic for API calls (with retry mechanism) ---
     attempt = 0
     success_flag = False
+    last_error = None
     content = "LLM call error"
     reasoning_content = ""
     token_data = {
@@ -70,44 +75,131 @@ def DS_output(messages, temperature=1, model="deepseek-reasoner", max_retries=3,
         "total_tokens": 0
     }
 
+    # Shared RPM/TPM budgets of the provider (see LLM/rate_limiter.py)
+    limiter = get_limiter("DeepSeek-AI")
+    estimated_tokens = estimate_tokens(messages) if limiter.tokens else 0
+
     while attempt < max_retries:
+        sent = False
         try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_token,
-                stream=False
-            )
-
-            token_data = {
-                "model": model,
-                "prompt_tokens": response.usage.prompt_tokens,
-                "completion_tokens": response.usage.completion_tokens,
-                "total_tokens": response.usage.total_tokens
-            }
-            
-            if model == "deepseek-reasoner":
-                content = response.choices[0].message.content
-                reasoning_content = response.choices[0].message.reasoning_content
+            limiter.acquire(estimated_tokens)
+            sent = True
+            # Hedged requests are streamed too, so the losing one can be closed
+            if stop_when or hedged_request():
+                stream_response = client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_token,
+                    stream=True,
+                    stream_options={"include_usage": True}
+                )
+                prompt_tokens, completion_tokens, reasoning_content, content = collect_stream(stream_response, messages, stop_when)
+                token_data = {"model": model, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                              "total_tokens": prompt_tokens + completion_tokens}
             else:
-                content = response.choices[0].message.content
-                reasoning_content = ""
-                
+                response = client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_token,
+                    stream=False
+                )
+                token_data, reasoning_content, content = _parse_response(response, model)
+            limiter.settle_usage(estimated_tokens, token_data["prompt_tokens"], token_data["completion_tokens"])
             success_flag = True
             break
 
         except Exception as e:
             print(f"[Attempt {attempt + 1}] LLM call exception: {str(e)}")
+            last_error = e
+            if sent:
+                limiter.settle_failure(estimated_tokens, e)
+            note_retry()
             attempt += 1
             if attempt < max_retries:
-                time.sleep(1*attempt)
+                # Jittered exponential backoff; 429s pause the whole provider until Retry-After
+                time.sleep(on_call_error(limiter, e, attempt))
     
     if not success_flag:
-        content = "The LLM call still failed after multiple retries."
+        raise LLMCallFailed(f"The LLM call still failed after {max_retries} attempts: {last_error}",
+                            provider="DeepSeek-AI", model=model, attempts=max_retries) from last_error
 
-    # --- 4. Prepare and return the results ---
+    # --- 3. Prepare and return the results ---
     input_token_count = token_data["prompt_tokens"]
     output_token_count = token_data["completion_tokens"]
     
-    return input_token_count, output_token_count, reasoning_content, content
\ No newline at end of file
+    return input_token_count, output_token_count, reasoning_content, content
+
+
+async def DS_output_async(messages, temperature=1, model="deepseek-reasoner", max_retries=3, max_token=8192, stop_when=None):
+    """
+    Asyncio counterpart of DS_output. Uses the event loop's AsyncOpenAI client, and every attempt
+    waits for a slot of the provider semaphore ("max_concurrency" in LLM_config.json).
+
+    Returns:
+    tuple: (input_token_count, output_token_count, reasoning_content, content), same as DS_output.
+    """
+    try:
+        client = get_async_client("DeepSeek-AI")
+        semaphore = get_async_semaphore("DeepSeek-AI")
+    except Exception as e:
+        raise LLMConfigError(f"LLM configuration error: {str(e)}") from e
+
+    attempt = 0
+    success_flag = False
+    last_error = None
+    content = "LLM call error"
+    reasoning_content = ""
+    token_data = {"model": model, "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+    limiter = get_limiter("DeepSeek-AI")
+    estimated_tokens = estimate_tokens(messages) if limiter.tokens else 0
+
+    while attempt < max_retries:
+        sent = False
+        try:
+            async with semaphore:
+                await limiter.acquire_async(estimated_tokens)
+                sent = True
+                if stop_when or hedged_request():
+                    stream_response = await client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=max_token,
+                        stream=True,
+                        stream_options={"include_usage": True}
+                    )
+                    prompt_tokens, completion_tokens, reasoning_content, content = await collect_stream_async(stream_response, messages, stop_when)
+                    token_data = {"model": model, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                  "total_tokens": prompt_tokens + completion_tokens}
+                else:
+                    response = await client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=max_token,
+                        stream=False
+                    )
+                    token_data, reasoning_content, content = _parse_response(response, model)
+
+            limiter.settle_usage(estimated_tokens, token_data["prompt_tokens"], token_data["completion_tokens"])
+            success_flag = True
+            break
+
+        except Exception as e:
+            print(f"[Async attempt {attempt + 1}] LLM call exception: {str(e)}")
+            last_error = e
+            if sent:
+                limiter.settle_failure(estimated_tokens, e)
+            note_retry()
+            attempt += 1
+            if attempt < max_retries:
+                await asyncio.sleep(on_call_error(limiter, e, attempt))
+
+    if not success_flag:
+        raise LLMCallFailed(f"The LLM call still failed after {max_retries} attempts: {last_error}",
+                            provider="DeepSeek-AI", model=model, attempts=max_retries) from last_error
+
+    return token_data["prompt_tokens"], token_data["completion_tokens"], reasoning_content, content
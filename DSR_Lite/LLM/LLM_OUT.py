@@ -1,16 +1,192 @@
+import time
+import asyncio
 from LLM.DeepSeek_LLM import *
 from LLM.Modelscope_LLM import *
+from LLM.VLLM_LLM import *
+from LLM.errors import LLMError, LLMConfigError, LLMCallFailed, CircuitOpenError
+from LLM.response_cache import get_cache, configure_cache, LLMCacheMiss
+from LLM.rate_limiter import get_limiter_stats
+from LLM.early_stop import get_early_stop_stats
+from LLM.usage_stats import get_prompt_cache_stats
+from LLM.hedging import call_with_hedging, call_with_hedging_async, configure_hedging, get_hedging_stats
+from LLM.circuit_breaker import get_breaker, get_breaker_stats, get_failover_config
+from LLM.ledger import begin_call, record_call, configure_ledger, set_ledger_context, get_ledger_context, set_budget_alarm, get_ledger_summary, get_ledger_totals
 
-def LLM_output(messages, temperature=1, model="deepseek-reasoner", max_retries=10,max_token=65535,**kwargs):
+def _route(model, max_token, provider=None):
+    """
+    Resolves the provider of a model, its functions (sync, async) and the max_token value that is actually sent.
+    Models served by the local vLLM server are addressed with provider="VLLM".
+    """
+    if provider == "VLLM":
+        return "VLLM", vllm_chat, vllm_chat_async, 8192
     if model in ["deepseek-reasoner","deepseek-chat"]:
-        return DS_output(messages=messages,temperature=temperature,model=model,max_retries=max_retries,max_token=max_token if model == "deepseek-reasoner" else 8192)
+        return "DeepSeek-AI", DS_output, DS_output_async, (max_token if model == "deepseek-reasoner" else 8192)
     if model in ["Qwen/Qwen3-Coder-480B-A35B-Instruct","deepseek-ai/DeepSeek-R1-0528","Qwen/Qwen3-235B-A22B-Thinking-2507"]:
-        return modelscope_Think(messages=messages,temperature=temperature,model=model,max_retries=max_retries,max_token=max_token)
+        return "Modelscope", modelscope_Think, modelscope_Think_async, max_token
     if model in ["Qwen/Qwen3-Next-80B-A3B-Instruct","Qwen/Qwen3-235B-A22B-Instruct-2507","Qwen/Qwen3-30B-A3B-Instruct-2507"]:
-        return modelscope_chat(messages=messages,temperature=temperature,model=model,max_retries=max_retries,max_token=8192)
+        return "Modelscope", modelscope_chat, modelscope_chat_async, 8192
     else:
         raise ValueError(f"Error: You have not configured the corresponding LLM: '{model}'. Please check if the model name is spelled correctly.")
-    
+
+def _failover_plan(model, max_token, provider=None):
+    """
+    Returns the targets tried for a request, in order: the requested model, then its fallback chain from the
+    "Failover" entry of LLM_config.json (when enabled). Each target is (provider, model, sync_func, async_func, max_token).
+    """
+    targets = [(model, provider)]
+    failover = get_failover_config()
+    if failover.get("enabled"):
+        targets += [(t["model"], t.get("provider")) for t in failover.get("chains", {}).get(model, [])]
+    plan = []
+    for target_model, target_provider in targets:
+        target_provider, sync_func, async_func, target_max_token = _route(target_model, max_token, target_provider)
+        plan.append((target_provider, target_model, sync_func, async_func, target_max_token))
+    return plan
+
+def _circuit_open(breaker, provider, model):
+    return CircuitOpenError(f"The circuit breaker of '{breaker.name}' is open, retry in {breaker.retry_in():.0f}s.",
+                            provider=provider, model=model, retry_in=breaker.retry_in())
+
+def _cache_lookup(cache, messages, temperature, model, max_token, last=True):
+    """
+    Returns (cache_key, cached_result) for one target of the failover plan. cached_result is None when the
+    request has to be sent. In replay mode only a miss on the last target raises LLMCacheMiss.
+    """
+    if cache is None:
+        return None, None
+    cache_key = cache.make_key(model, messages, temperature, max_token)
+    if cache.serves(temperature):
+        return cache_key, cache.get(cache_key, raise_on_miss=last)
+    return cache_key, None
+
+def _replaying(cache):
+    return cache is not None and cache.mode == "replay"
+
+def LLM_output(messages, temperature=1, model="deepseek-reasoner", max_retries=10,max_token=65535,use_cache=True,stop_when=None,stage=None,provider=None,**kwargs):
+    """
+    Calls the provider of `model` and returns (input_token_count, output_token_count, reasoning, content).
+    stop_when ("json", "answer", "sql" or a callable) streams the answer and stops as soon as the block the
+    caller is going to parse is complete (see LLM/early_stop.py).
+    stage names the pipeline step for the per-(model, stage) latency tracking used by hedged requests
+    (see LLM/hedging.py).
+
+    Every (provider, model) is guarded by a circuit breaker (see LLM/circuit_breaker.py). When a call fails
+    or its breaker is open, the request moves down the configured fallback chain.
+
+    Each call is reported to the token and cost ledger (see LLM/ledger.py) under its stage.
+
+    Raises:
+        LLMCallFailed / CircuitOpenError / LLMConfigError: If no target of the chain produced an answer.
+        LLMCacheMiss: In replay mode, if the request was not recorded.
+    """
+    plan = _failover_plan(model, max_token, provider)
+    call = begin_call()
+
+    # Optional response cache (see LLM/response_cache.py); use_cache=False always calls the provider.
+    # Answers are cached under the target that produced them, so each target is looked up before it is called.
+    cache = get_cache() if use_cache else None
+
+    errors = []
+    for i, (target_provider, target_model, func, _, target_max_token) in enumerate(plan):
+        cache_key, cached = _cache_lookup(cache, messages, temperature, target_model, target_max_token, last=i == len(plan) - 1)
+        if cached is not None:
+            record_call(call, stage, None, target_model, cached, cache_hit=True)
+            return cached
+        if _replaying(cache):
+            continue
+
+        breaker = get_breaker(target_provider, target_model)
+        if not breaker.allow():
+            errors.append(_circuit_open(breaker, target_provider, target_model))
+            continue
+
+        call_kwargs = dict(messages=messages,temperature=temperature,model=target_model,max_retries=max_retries,max_token=target_max_token,stop_when=stop_when)
+        start = time.time()
+        try:
+            result = call_with_hedging(func, call_kwargs, target_model, stage, target_provider)
+        except LLMConfigError as e:
+            # A fallback without configuration is skipped and does not count against its breaker
+            breaker.release()
+            errors.append(e)
+            continue
+        except Exception as e:
+            breaker.record(False, time.time() - start)
+            if not isinstance(e, LLMCallFailed):
+                raise
+            errors.append(e)
+            continue
+        except BaseException:
+            # The outcome is unknown, but a half-open probe must not stay claimed
+            breaker.release()
+            raise
+        breaker.record(True, time.time() - start)
+
+        if target_model != model:
+            print(f"[Failover] '{model}' was answered by '{breaker.name}'.")
+        if cache is not None and cache.stores(temperature):
+            cache.put(cache_key, target_model, result)
+        record_call(call, stage, target_provider, target_model, result)
+        return result
+
+    record_call(call, stage, None, model, ok=False)
+    raise errors[-1]
+
+async def LLM_output_async(messages, temperature=1, model="deepseek-reasoner", max_retries=10,max_token=65535,use_cache=True,stop_when=None,stage=None,provider=None,**kwargs):
+    """
+    Asyncio counterpart of LLM_output with the same arguments, return value and exceptions.
+    In-flight requests are capped per provider by the "max_concurrency" entry of LLM_config.json, e.g.:
+
+        results = await asyncio.gather(*(LLM_output_async(m, model=model) for m in all_messages))
+    """
+    plan = _failover_plan(model, max_token, provider)
+    call = begin_call()
+
+    cache = get_cache() if use_cache else None
+
+    errors = []
+    for i, (target_provider, target_model, _, func, target_max_token) in enumerate(plan):
+        cache_key, cached = _cache_lookup(cache, messages, temperature, target_model, target_max_token, last=i == len(plan) - 1)
+        if cached is not None:
+            record_call(call, stage, None, target_model, cached, cache_hit=True)
+            return cached
+        if _replaying(cache):
+            continue
+
+        breaker = get_breaker(target_provider, target_model)
+        if not breaker.allow():
+            errors.append(_circuit_open(breaker, target_provider, target_model))
+            continue
+
+        call_kwargs = dict(messages=messages,temperature=temperature,model=target_model,max_retries=max_retries,max_token=target_max_token,stop_when=stop_when)
+        start = time.time()
+        try:
+            result = await call_with_hedging_async(func, call_kwargs, target_model, stage, target_provider)
+        except LLMConfigError as e:
+            breaker.release()
+            errors.append(e)
+            continue
+        except asyncio.CancelledError:
+            # The outcome is unknown, but a half-open probe must not stay claimed
+            breaker.release()
+            raise
+        except Exception as e:
+            breaker.record(False, time.time() - start)
+            if not isinstance(e, LLMCallFailed):
+                raise
+            errors.append(e)
+            continue
+        breaker.record(True, time.time() - start)
+
+        if target_model != model:
+            print(f"[Failover] '{model}' was answered by '{breaker.name}'.")
+        if cache is not None and cache.stores(temperature):
+            cache.put(cache_key, target_model, result)
+        record_call(call, stage, target_provider, target_model, result)
+        return result
+
+    record_call(call, stage, None, model, ok=False)
+    raise errors[-1]
+
 
 if __name__ == "__main__":
 
@@ -24,4 +200,4 @@ if __name__ == "__main__":
 
 """
 python -m LLM.LLM_OUT
-"""
\ No newline at end of file
+"""
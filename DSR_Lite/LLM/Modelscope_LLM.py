@@ -1,55 +1,40 @@
 import time
-import json
-import os
-from openai import OpenAI
+import asyncio
+from LLM.client_pool import get_client, get_async_client, get_async_semaphore
+from LLM.rate_limiter import get_limiter, estimate_tokens, on_call_error
+from LLM.early_stop import collect_stream, collect_stream_async
+from LLM.errors import LLMConfigError, LLMCallFailed
+from LLM.ledger import note_retry
 
 # ------------------- Main Functions -------------------
 
-def modelscope_Think(messages, temperature=1, model="deepseek-ai/DeepSeek-R1-0528", max_retries=3, max_token=65535):
+def modelscope_Think(messages, temperature=1, model="deepseek-ai/DeepSeek-R1-0528", max_retries=3, max_token=65535, stop_when=None):
     """
     Calls a model that supports a thinking process (e.g., deepseek-reasoner).
-    The function handles configuration reading and client initialization internally.
+    The client is shared process-wide via LLM.client_pool.
     It uses the streaming API to internally aggregate the complete thinking process and the final answer, and collects token information.
+    With stop_when set (see LLM/early_stop.py), the stream is closed as soon as the answer block is complete.
     """
-    # --- 1. Read, validate configuration file and initialize the client (inlined logic) ---
+    # --- 1. Get the pooled client (the configuration is read and validated once per process) ---
     try:
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        config_path = os.path.join(current_dir, "LLM_config.json")
-
-        if not os.path.exists(config_path):
-            raise FileNotFoundError(f"Configuration file not found. Please ensure the {config_path} file exists.")
-
-        with open(config_path, 'r', encoding='utf-8') as f:
-            config = json.load(f)
-
-        if "Modelscope" not in config:
-            raise KeyError("The 'Modelscope' configuration item is missing in the LLM_config.json file.")
-
-        modelscope_config = config["Modelscope"]
-        url = modelscope_config.get("url")
-        key = modelscope_config.get("key")
-
-        if not url:
-            raise ValueError("In the 'Modelscope' configuration, the 'url' field is missing or empty.")
-        if not key:
-            raise ValueError("In the 'Modelscope' configuration, the 'key' field is missing or empty.")
-        
-        client = OpenAI(api_key=key, base_url=url)
+        client = get_client("Modelscope")
 
     except Exception as e:
-        error_message = f"LLM configuration error: {str(e)}"
-        print(error_message)
-        return 0, 0, "", error_message
+        raise LLMConfigError(f"LLM configuration error: {str(e)}") from e
 
     # --- 2. Core logic for the API call ---
     attempt = 0
     token_data = {"prompt_tokens": 0, "completion_tokens": 0}
 
+    # Shared RPM/TPM budgets of the provider (see LLM/rate_limiter.py)
+    limiter = get_limiter("Modelscope")
+    estimated_tokens = estimate_tokens(messages) if limiter.tokens else 0
+
     while attempt < max_retries:
+        sent = False
         try:
-            content = ""
-            reasoning_content = ""
-            
+            limiter.acquire(estimated_tokens)
+            sent = True
             stream_response = client.chat.completions.create(
                 model=model,
                 messages=messages,
@@ -59,77 +44,55 @@ def modelscope_Think(messages, temperature=1, model="deepseek-ai/DeepSeek-R1-052
                 max_tokens=max_token
             )
 
-            for chunk in stream_response:
-                if not chunk.choices:
-                    if chunk.usage:
-                        token_data["prompt_tokens"] = chunk.usage.prompt_tokens
-                        token_data["completion_tokens"] = chunk.usage.completion_tokens
-                    continue
-
-                delta = chunk.choices[0].delta
-                
-                if hasattr(delta, 'reasoning_content') and delta.reasoning_content:
-                    reasoning_content += delta.reasoning_content
-                elif delta.content:
-                    content += delta.content
+            token_data["prompt_tokens"], token_data["completion_tokens"], reasoning_content, content = collect_stream(
+                stream_response, messages, stop_when)
 
+            limiter.settle_usage(estimated_tokens, token_data["prompt_tokens"], token_data["completion_tokens"])
             break  
 
         except Exception as e:
             print(f"['Think' model - Attempt {attempt + 1}] LLM call exception: {str(e)}")
+            if sent:
+                limiter.settle_failure(estimated_tokens, e)
+            note_retry()
             attempt += 1
             if attempt < max_retries:
-                time.sleep(1*attempt)
+                # Jittered exponential backoff; 429s pause the whole provider until Retry-After
+                time.sleep(on_call_error(limiter, e, attempt))
             else:
-                return token_data["prompt_tokens"], token_data["completion_tokens"], "", "The LLM call still failed after multiple retries."
+                raise LLMCallFailed(f"The LLM call still failed after {max_retries} attempts: {e}",
+                                    provider="Modelscope", model=model, attempts=max_retries) from e
 
     return token_data["prompt_tokens"], token_data["completion_tokens"], reasoning_content, content
 
 
-def modelscope_chat(messages, temperature=1, model="Qwen/Qwen3-235B-A22B-Instruct-2507", max_retries=3, max_token=8192):
+def modelscope_chat(messages, temperature=1, model="Qwen/Qwen3-235B-A22B-Instruct-2507", max_retries=3, max_token=8192, stop_when=None):
     """
     Calls a standard chat model (e.g., deepseek-chat).
-    The function handles configuration reading and client initialization internally.
+    The client is shared process-wide via LLM.client_pool.
     It uses the streaming API to internally aggregate the complete answer and collect token information.
+    With stop_when set (see LLM/early_stop.py), the stream is closed as soon as the answer block is complete.
     """
-    # --- 1. Read, validate configuration file and initialize the client (inlined logic) ---
+    # --- 1. Get the pooled client (the configuration is read and validated once per process) ---
     try:
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        config_path = os.path.join(current_dir, "LLM_config.json")
-
-        if not os.path.exists(config_path):
-            raise FileNotFoundError(f"Configuration file not found. Please ensure the {config_path} file exists.")
-
-        with open(config_path, 'r', encoding='utf-8') as f:
-            config = json.load(f)
-
-        if "Modelscope" not in config:
-            raise KeyError("The 'Modelscope' configuration item is missing in the LLM_config.json file.")
-
-        modelscope_config = config["Modelscope"]
-        url = modelscope_config.get("url")
-        key = modelscope_config.get("key")
-
-        if not url:
-            raise ValueError("In the 'Modelscope' configuration, the 'url' field is missing or empty.")
-        if not key:
-            raise ValueError("In the 'Modelscope' configuration, the 'key' field is missing or empty.")
-        
-        client = OpenAI(api_key=key, base_url=url)
+        client = get_client("Modelscope")
 
     except Exception as e:
-        error_message = f"LLM configuration error: {str(e)}"
-        print(error_message)
-        return 0, 0, "", error_message
+        raise LLMConfigError(f"LLM configuration error: {str(e)}") from e
 
     # --- 2. Core logic for the API call ---
     attempt = 0
     token_data = {"prompt_tokens": 0, "completion_tokens": 0}
 
+    # Shared RPM/TPM budgets of the provider (see LLM/rate_limiter.py)
+    limiter = get_limiter("Modelscope")
+    estimated_tokens = estimate_tokens(messages) if limiter.tokens else 0
+
     while attempt < max_retries:
+        sent = False
         try:
-            content = ""
-            
+            limiter.acquire(estimated_tokens)
+            sent = True
             stream_response = client.chat.completions.create(
                 model=model,
                 messages=messages,
@@ -139,26 +102,132 @@ def modelscope_chat(messages, temperature=1, model="Qwen/Qwen3-235B-A22B-Instruc
                 max_tokens=max_token
             )
 
-            for chunk in stream_response:
-                if not chunk.choices:
-                    if chunk.usage:
-                        token_data["prompt_tokens"] = chunk.usage.prompt_tokens
-                        token_data["completion_tokens"] = chunk.usage.completion_tokens
-                    continue
-                
-                delta = chunk.choices[0].delta
-
-                if delta.content:
-                    content += delta.content
+            token_data["prompt_tokens"], token_data["completion_tokens"], reasoning_content, content = collect_stream(
+                stream_response, messages, stop_when)
 
+            limiter.settle_usage(estimated_tokens, token_data["prompt_tokens"], token_data["completion_tokens"])
             break
 
         except Exception as e:
             print(f"['Chat' model - Attempt {attempt + 1}] LLM call exception: {str(e)}")
+            if sent:
+                limiter.settle_failure(estimated_tokens, e)
+            note_retry()
+            attempt += 1
+            if attempt < max_retries:
+                # Jittered exponential backoff; 429s pause the whole provider until Retry-After
+                time.sleep(on_call_error(limiter, e, attempt))
+            else:
+                raise LLMCallFailed(f"The LLM call still failed after {max_retries} attempts: {e}",
+                                    provider="Modelscope", model=model, attempts=max_retries) from e
+
+    return token_data["prompt_tokens"], token_data["completion_tokens"], "", content
+
+
+# ------------------- Asyncio Counterparts -------------------
+
+async def modelscope_Think_async(messages, temperature=1, model="deepseek-ai/DeepSeek-R1-0528", max_retries=3, max_token=65535, stop_when=None):
+    """
+    Asyncio counterpart of modelscope_Think. Every attempt holds a slot of the Modelscope semaphore
+    ("max_concurrency" in LLM_config.json) while its stream is being consumed.
+    """
+    try:
+        client = get_async_client("Modelscope")
+        semaphore = get_async_semaphore("Modelscope")
+    except Exception as e:
+        raise LLMConfigError(f"LLM configuration error: {str(e)}") from e
+
+    attempt = 0
+    token_data = {"prompt_tokens": 0, "completion_tokens": 0}
+
+    # Shared RPM/TPM budgets of the provider (see LLM/rate_limiter.py)
+    limiter = get_limiter("Modelscope")
+    estimated_tokens = estimate_tokens(messages) if limiter.tokens else 0
+
+    while attempt < max_retries:
+        sent = False
+        try:
+            async with semaphore:
+                await limiter.acquire_async(estimated_tokens)
+                sent = True
+                stream_response = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    max_tokens=max_token
+                )
+
+                token_data["prompt_tokens"], token_data["completion_tokens"], reasoning_content, content = await collect_stream_async(
+                    stream_response, messages, stop_when)
+
+            limiter.settle_usage(estimated_tokens, token_data["prompt_tokens"], token_data["completion_tokens"])
+            break
+
+        except Exception as e:
+            print(f"['Think' model - Async attempt {attempt + 1}] LLM call exception: {str(e)}")
+            if sent:
+                limiter.settle_failure(estimated_tokens, e)
+            note_retry()
+            attempt += 1
+            if attempt < max_retries:
+                await asyncio.sleep(on_call_error(limiter, e, attempt))
+            else:
+                raise LLMCallFailed(f"The LLM call still failed after {max_retries} attempts: {e}",
+                                    provider="Modelscope", model=model, attempts=max_retries) from e
+
+    return token_data["prompt_tokens"], token_data["completion_tokens"], reasoning_content, content
+
+
+async def modelscope_chat_async(messages, temperature=1, model="Qwen/Qwen3-235B-A22B-Instruct-2507", max_retries=3, max_token=8192, stop_when=None):
+    """
+    Asyncio counterpart of modelscope_chat.
+    """
+    try:
+        client = get_async_client("Modelscope")
+        semaphore = get_async_semaphore("Modelscope")
+    except Exception as e:
+        raise LLMConfigError(f"LLM configuration error: {str(e)}") from e
+
+    attempt = 0
+    token_data = {"prompt_tokens": 0, "completion_tokens": 0}
+
+    # Shared RPM/TPM budgets of the provider (see LLM/rate_limiter.py)
+    limiter = get_limiter("Modelscope")
+    estimated_tokens = estimate_tokens(messages) if limiter.tokens else 0
+
+    while attempt < max_retries:
+        sent = False
+        try:
+            async with semaphore:
+                await limiter.acquire_async(estimated_tokens)
+                sent = True
+                stream_response = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    max_tokens=max_token
+                )
+
+                token_data["prompt_tokens"], token_data["completion_tokens"], reasoning_content, content = await collect_stream_async(
+                    stream_response, messages, stop_when)
+
+            limiter.settle_usage(estimated_tokens, token_data["prompt_tokens"], token_data["completion_tokens"])
+            break
+
+        except Exception as e:
+            print(f"['Chat' model - Async attempt {attempt + 1}] LLM call exception: {str(e)}")
+            if sent:
+                limiter.settle_failure(estimated_tokens, e)
+            note_retry()
             attempt += 1
             if attempt < max_retries:
-                time.sleep(1*attempt)
+                await asyncio.sleep(on_call_error(limiter, e, attempt))
             else:
-                return token_data["prompt_tokens"], token_data["completion_tokens"], "", "The LLM call still failed after multiple retries."
+                raise LLMCallFailed(f"The LLM call still failed after {max_retries} attempts: {e}",
+                                    provider="Modelscope", model=model, attempts=max_retries) from e
 
-    return token_data["prompt_tokens"], token_data["completion_tokens"], "", content
\ No newline at end of file
+    return token_data["prompt_tokens"], token_data["completion_tokens"], "", content
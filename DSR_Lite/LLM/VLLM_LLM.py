@@ -0,0 +1,111 @@
+import time
+import asyncio
+from LLM.client_pool import get_client, get_async_client, get_async_semaphore
+from LLM.rate_limiter import get_limiter, estimate_tokens, on_call_error
+from LLM.early_stop import collect_stream, collect_stream_async
+from LLM.errors import LLMConfigError, LLMCallFailed
+from LLM.ledger import note_retry
+
+# ------------------- Main Functions -------------------
+
+def vllm_chat(messages, temperature=1, model="Qwen/Qwen3-30B-A3B-Instruct-2507", max_retries=3, max_token=8192, stop_when=None):
+    """
+    Calls a model served by a local vLLM OpenAI-compatible server (the "VLLM" entry of LLM_config.json).
+    `model` must be the name the server was started with. Reasoning content is returned when the server
+    runs with a reasoning parser, otherwise it is "".
+
+    Returns:
+    tuple: (input_token_count, output_token_count, reasoning_content, content).
+
+    Raises:
+    LLMConfigError: If the "VLLM" configuration is missing or invalid.
+    LLMCallFailed: If every attempt failed.
+    """
+    try:
+        client = get_client("VLLM")
+    except Exception as e:
+        raise LLMConfigError(f"LLM configuration error: {str(e)}") from e
+
+    attempt = 0
+    limiter = get_limiter("VLLM")
+    estimated_tokens = estimate_tokens(messages) if limiter.tokens else 0
+
+    while attempt < max_retries:
+        sent = False
+        try:
+            limiter.acquire(estimated_tokens)
+            sent = True
+            stream_response = client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                stream=True,
+                stream_options={"include_usage": True},
+                max_tokens=max_token
+            )
+
+            prompt_tokens, completion_tokens, reasoning_content, content = collect_stream(stream_response, messages, stop_when)
+            limiter.settle_usage(estimated_tokens, prompt_tokens, completion_tokens)
+            return prompt_tokens, completion_tokens, reasoning_content, content
+
+        except Exception as e:
+            print(f"['VLLM' model - Attempt {attempt + 1}] LLM call exception: {str(e)}")
+            if sent:
+                limiter.settle_failure(estimated_tokens, e)
+            note_retry()
+            attempt += 1
+            if attempt < max_retries:
+                time.sleep(on_call_error(limiter, e, attempt))
+            else:
+                raise LLMCallFailed(f"The LLM call still failed after {max_retries} attempts: {e}",
+                                    provider="VLLM", model=model, attempts=max_retries) from e
+
+
+# ------------------- Asyncio Counterparts -------------------
+
+async def vllm_chat_async(messages, temperature=1, model="Qwen/Qwen3-30B-A3B-Instruct-2507", max_retries=3, max_token=8192, stop_when=None):
+    """
+    Asyncio counterpart of vllm_chat.
+    """
+    try:
+        client = get_async_client("VLLM")
+        semaphore = get_async_semaphore("VLLM")
+    except Exception as e:
+        raise LLMConfigError(f"LLM configuration error: {str(e)}") from e
+
+    attempt = 0
+    limiter = get_limiter("VLLM")
+    estimated_tokens = estimate_tokens(messages) if limiter.tokens else 0
+
+    while attempt < max_retries:
+        sent = False
+        try:
+            async with semaphore:
+                await limiter.acquire_async(estimated_tokens)
+                sent = True
+                stream_response = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    max_tokens=max_token
+                )
+
+                prompt_tokens, completion_tokens, reasoning_content, content = await collect_stream_async(
+                    stream_response, messages, stop_when)
+
+            limiter.settle_usage(estimated_tokens, prompt_tokens, completion_tokens)
+            return prompt_tokens, completion_tokens, reasoning_content, content
+
+        except Exception as e:
+            print(f"['VLLM' model - Async attempt {attempt + 1}] LLM call exception: {str(e)}")
+            if sent:
+                limiter.settle_failure(estimated_tokens, e)
+            note_retry()
+            attempt += 1
+            if attempt < max_retries:
+                await asyncio.sleep(on_call_error(limiter, e, attempt))
+            else:
+                raise LLMCallFailed(f"The LLM call still failed after {max_retries} attempts: {e}",
+                                    provider="VLLM", model=model, attempts=max_retries) from e
@@ -0,0 +1,130 @@
+import time
+import threading
+from collections import deque
+
+from LLM.client_pool import load_llm_config
+
+# --- Circuit breaker per (provider, model) ---
+# A breaker watches the outcome of the last `window` calls. It opens when the share of failed calls
+# reaches `error_rate` or the share of slow calls (longer than `slow_call_seconds`) reaches
+# `slow_call_rate`, once at least `min_calls` outcomes have been seen. While open, requests go
+# straight to the next entry of the fallback chain. After `open_seconds` one probe request is let
+# through (half-open); its outcome closes the breaker or opens it again.
+#
+# Thresholds come from the "Failover" -> "breaker" entry of LLM_config.json.
+
+DEFAULT_BREAKER = {
+    "window": 20,
+    "min_calls": 5,
+    "error_rate": 0.5,
+    "slow_call_seconds": 600,
+    "slow_call_rate": 0.8,
+    "open_seconds": 120
+}
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitBreaker:
+    def __init__(self, name, window=20, min_calls=5, error_rate=0.5, slow_call_seconds=600, slow_call_rate=0.8, open_seconds=120):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.outcomes = deque(maxlen=window)  # (ok, seconds)
+        self.stats = {"calls": 0, "failures": 0, "rejected": 0, "trips": 0}
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a request may be sent now. In half-open state only a single probe is allowed."""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+                self.state = HALF_OPEN
+                self.probe_in_flight = False
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            self.stats["rejected"] += 1
+            return False
+
+    def retry_in(self):
+        """Seconds until an open breaker lets the next probe through."""
+        return max(0.0, self.opened_at + self.open_seconds - time.monotonic())
+
+    def record(self, ok, seconds):
+        """Registers the outcome of an allowed request and updates the breaker state."""
+        with self._lock:
+            self.stats["calls"] += 1
+            self.stats["failures"] += int(not ok)
+
+            if self.state == HALF_OPEN:
+                self.probe_in_flight = False
+                if ok and seconds < self.slow_call_seconds:
+                    self.state = CLOSED
+                    self.outcomes.clear()
+                else:
+                    self._trip()
+                return
+
+            self.outcomes.append((ok, seconds))
+            if len(self.outcomes) < self.min_calls:
+                return
+            failures = sum(1 for o, _ in self.outcomes if not o)
+            slow = sum(1 for _, s in self.outcomes if s >= self.slow_call_seconds)
+            if failures / len(self.outcomes) >= self.error_rate or slow / len(self.outcomes) >= self.slow_call_rate:
+                self._trip()
+
+    def release(self):
+        """Frees the half-open probe slot of a request whose outcome is unknown (e.g. a cancelled task) or that was never sent."""
+        with self._lock:
+            self.probe_in_flight = False
+
+    def _trip(self):
+        print(f"[Circuit breaker] '{self.name}' opened for {self.open_seconds}s.")
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.outcomes.clear()
+        self.stats["trips"] += 1
+
+
+# --- Process-wide registry ---
+_breakers = {}
+_registry_lock = threading.Lock()
+
+
+def get_failover_config():
+    """Returns the "Failover" entry of LLM_config.json ({} when missing)."""
+    try:
+        return load_llm_config().get("Failover", {})
+    except FileNotFoundError:
+        return {}
+
+
+def get_breaker(provider, model):
+    key = (provider, model)
+    breaker = _breakers.get(key)
+    if breaker is None:
+        with _registry_lock:
+            breaker = _breakers.get(key)
+            if breaker is None:
+                settings = {**DEFAULT_BREAKER, **get_failover_config().get("breaker", {})}
+                breaker = CircuitBreaker(f"{provider} | {model}", **settings)
+                _breakers[key] = breaker
+    return breaker
+
+
+def get_breaker_stats():
+    """
+    Returns the state and counters of every breaker used so far, e.g.
+    {"Modelscope | deepseek-ai/DeepSeek-R1-0528": {"state": "open", "calls": 40, "failures": 12, "rejected": 30, "trips": 1}}
+    """
+    with _registry_lock:
+        return {breaker.name: {"state": breaker.state, **breaker.stats} for breaker in _breakers.values()}
@@ -0,0 +1,203 @@
+import os
+import json
+import atexit
+import asyncio
+import weakref
+import threading
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+import httpx
+
+# --- Process-wide client registry ---
+# LLM_config.json is read once and every provider gets a single OpenAI client whose
+# underlying httpx connection pool is shared by all threads calling LLM_output.
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "LLM_config.json")
+
+# Default keep-alive pool; can be overridden per provider with a "pool" entry in LLM_config.json
+DEFAULT_POOL = {
+    "max_connections": 64,
+    "max_keepalive_connections": 32,
+    "keepalive_expiry": 120
+}
+
+# Upper bound of in-flight async requests per provider and event loop ("max_concurrency" in LLM_config.json)
+DEFAULT_MAX_CONCURRENCY = 64
+
+# When set, every provider is sent to this OpenAI-compatible endpoint instead of its configured url,
+# e.g. the offline replay server of LLM/replay_server.py: DSR_LLM_ENDPOINT_OVERRIDE=http://127.0.0.1:8765/v1
+ENDPOINT_OVERRIDE_ENV = "DSR_LLM_ENDPOINT_OVERRIDE"
+
+_config = None
+_clients = {}
+_lock = threading.Lock()
+
+# Async clients and semaphores are bound to the event loop that created them
+_async_resources = weakref.WeakKeyDictionary()
+
+
+def load_llm_config(reload=False):
+    """
+    Reads and caches LLM_config.json.
+
+    Args:
+        reload (bool): Force re-reading the file even if it has already been loaded.
+
+    Returns:
+        dict: The parsed configuration.
+    """
+    global _config
+    if _config is not None and not reload:
+        return _config
+
+    with _lock:
+        if _config is None or reload:
+            if not os.path.exists(CONFIG_PATH):
+                raise FileNotFoundError(f"Configuration file not found. Please ensure the {CONFIG_PATH} file exists.")
+            with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
+                _config = json.load(f)
+    return _config
+
+
+def get_provider_config(provider):
+    """
+    Returns the validated configuration entry of a provider ("DeepSeek-AI", "Modelscope", "VLLM", ...).
+    """
+    config = load_llm_config()
+
+    override = os.environ.get(ENDPOINT_OVERRIDE_ENV)
+    if override:
+        # The stand-in endpoint ignores the key, so providers without credentials can be replayed too
+        provider_config = config.get(provider, {})
+        return {**provider_config, "url": override, "key": provider_config.get("key") or "replay"}
+
+    if provider not in config:
+        raise KeyError(f"The '{provider}' configuration item is missing in the LLM_config.json file.")
+
+    provider_config = config[provider]
+    # Covers cases where the key is missing or the value is an empty string ""
+    if not provider_config.get("url"):
+        raise ValueError(f"In the '{provider}' configuration, the 'url' field is missing or empty.")
+    if not provider_config.get("key"):
+        raise ValueError(f"In the '{provider}' configuration, the 'key' field is missing or empty.")
+
+    return provider_config
+
+
+def _build_limits(provider_config):
+    pool = {**DEFAULT_POOL, **provider_config.get("pool", {})}
+    return httpx.Limits(
+        max_connections=pool["max_connections"],
+        max_keepalive_connections=pool["max_keepalive_connections"],
+        keepalive_expiry=pool["keepalive_expiry"]
+    )
+
+
+def _build_http_client(provider_config):
+    return DefaultHttpxClient(limits=_build_limits(provider_config))
+
+
+def get_client(provider):
+    """
+    Returns the shared, thread-safe OpenAI client of a provider, creating it on first use.
+
+    Args:
+        provider (str): The configuration key in LLM_config.json.
+
+    Returns:
+        OpenAI: A client backed by a pooled keep-alive HTTP connection pool.
+    """
+    client = _clients.get(provider)
+    if client is not None:
+        return client
+
+    provider_config = get_provider_config(provider)
+    with _lock:
+        # Another thread may have created it while we were validating the configuration
+        client = _clients.get(provider)
+        if client is None:
+            client = OpenAI(
+                api_key=provider_config["key"],
+                base_url=provider_config["url"],
+                # Retries and backoff are handled by the provider functions and LLM/rate_limiter.py
+                max_retries=0,
+                http_client=_build_http_client(provider_config)
+            )
+            _clients[provider] = client
+    return client
+
+
+def _loop_resources():
+    loop = asyncio.get_running_loop()
+    with _lock:
+        resources = _async_resources.get(loop)
+        if resources is None:
+            resources = {"clients": {}, "semaphores": {}}
+            _async_resources[loop] = resources
+    return resources
+
+
+def get_async_client(provider):
+    """
+    Returns the AsyncOpenAI client of a provider for the running event loop, creating it on first use.
+    Must be called from inside a coroutine.
+    """
+    resources = _loop_resources()
+    client = resources["clients"].get(provider)
+    if client is None:
+        provider_config = get_provider_config(provider)
+        # The connection pool must not be smaller than the number of requests allowed in flight
+        max_concurrency = provider_config.get("max_concurrency", DEFAULT_MAX_CONCURRENCY)
+        pool = {**DEFAULT_POOL, **provider_config.get("pool", {})}
+        pool["max_connections"] = max(pool["max_connections"], max_concurrency)
+        # Only the running loop touches its own resources, so no lock is needed past this point
+        client = AsyncOpenAI(
+            api_key=provider_config["key"],
+            base_url=provider_config["url"],
+            max_retries=0,
+            http_client=DefaultAsyncHttpxClient(limits=_build_limits({**provider_config, "pool": pool}))
+        )
+        resources["clients"][provider] = client
+    return client
+
+
+def get_async_semaphore(provider):
+    """
+    Returns the semaphore that caps in-flight requests of a provider on the running event loop.
+    The limit is the provider's "max_concurrency" entry in LLM_config.json.
+    """
+    resources = _loop_resources()
+    semaphore = resources["semaphores"].get(provider)
+    if semaphore is None:
+        try:
+            limit = load_llm_config().get(provider, {}).get("max_concurrency", DEFAULT_MAX_CONCURRENCY)
+        except FileNotFoundError:
+            limit = DEFAULT_MAX_CONCURRENCY
+        semaphore = asyncio.Semaphore(limit)
+        resources["semaphores"][provider] = semaphore
+    return semaphore
+
+
+async def close_async_clients():
+    """Closes the async clients of the running event loop. Call it before the loop shuts down."""
+    resources = _loop_resources()
+    for client in resources["clients"].values():
+        try:
+            await client.close()
+        except Exception:
+            pass
+    resources["clients"].clear()
+
+
+def close_clients():
+    """Closes every pooled client and forgets the cached configuration."""
+    global _config
+    with _lock:
+        for client in _clients.values():
+            try:
+                client.close()
+            except Exception:
+                pass
+        _clients.clear()
+        _config = None
+
+
+atexit.register(close_clients)
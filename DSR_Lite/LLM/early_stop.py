@@ -0,0 +1,134 @@
+import re
+import threading
+
+from LLM.rate_limiter import estimate_tokens
+from LLM.usage_stats import record_prompt_cache
+from LLM.ledger import note_usage
+from LLM.hedging import request_cancelled
+
+# --- Streaming early stop ---
+# Reasoning models often keep writing explanations after the block the pipeline actually parses.
+# LLM_output(..., stop_when=...) streams the answer and closes the connection as soon as that
+# block is complete, which saves output tokens and wall-clock time.
+#
+#   stop_when="json"    - a closed ```json {...} ``` block (what extract_and_parse_json reads first)
+#   stop_when="answer"  - a non-empty <answer>...</answer> (what extract_answer_content reads first)
+#   stop_when="sql"     - a closed ```sql ... ``` block (what extract_sql reads first)
+#   stop_when=callable  - any function content_so_far -> bool
+#
+# The patterns mirror the first matching strategy of the parsers in utils/extract_json.py, so the
+# truncated text parses to exactly the same result as the full response would have.
+# Only the answer content is inspected; the reasoning stream is never cut.
+#
+# A request of a hedged call (LLM/hedging.py) is also closed as soon as the other request has answered;
+# its partial output is returned and discarded by the caller.
+
+STOP_PATTERNS = {
+    "json": (re.compile(r'```json\s*({[\s\S]*?})\s*```', re.DOTALL), "`"),
+    "answer": (re.compile(r"<answer>(.*?)</answer>", re.DOTALL | re.IGNORECASE), ">"),
+    "sql": (re.compile(r"```sql\s*(.*?)\s*```", re.DOTALL | re.IGNORECASE), "`"),
+}
+
+_stats = {"streams": 0, "stopped": 0, "estimated_usage": 0}
+_stats_lock = threading.Lock()
+
+
+class StreamStopper:
+    """
+    Incremental stop detector fed with content deltas.
+    The regex is only re-evaluated when a delta contains the last character of the closing marker,
+    so checking a long stream stays linear in practice.
+    """
+    def __init__(self, stop_when):
+        self.parts = []
+        if callable(stop_when):
+            self.pattern, self.trigger, self.func = None, None, stop_when
+        elif stop_when in STOP_PATTERNS:
+            (self.pattern, self.trigger), self.func = STOP_PATTERNS[stop_when], None
+        else:
+            raise ValueError(f"Invalid stop_when: '{stop_when}'. Supported values: {tuple(STOP_PATTERNS)} or a callable.")
+
+    def feed(self, delta):
+        """Appends a content delta and returns True once the stop condition is met."""
+        self.parts.append(delta)
+        if self.func is not None:
+            return bool(self.func("".join(self.parts)))
+        if self.trigger not in delta:
+            return False
+        match = self.pattern.search("".join(self.parts))
+        return bool(match and match.group(1).strip())
+
+
+def make_stopper(stop_when):
+    """Returns a StreamStopper, or None when early stop is disabled."""
+    return StreamStopper(stop_when) if stop_when else None
+
+
+def _handle_chunk(chunk, state, stopper):
+    """Accumulates one stream chunk into state. Returns True when the stream should be closed."""
+    if not chunk.choices:
+        if chunk.usage:
+            state["usage"] = (chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+            record_prompt_cache(getattr(chunk, "model", None), chunk.usage)
+            note_usage(chunk.usage)
+        return False
+
+    delta = chunk.choices[0].delta
+    if getattr(delta, "reasoning_content", None):
+        state["reasoning"].append(delta.reasoning_content)
+    elif delta.content:
+        state["content"].append(delta.content)
+        if stopper is not None and stopper.feed(delta.content):
+            return True
+    return False
+
+
+def _finish(state, messages, stopped):
+    reasoning, content = "".join(state["reasoning"]), "".join(state["content"])
+    usage = state["usage"]
+    with _stats_lock:
+        _stats["streams"] += 1
+        _stats["stopped"] += int(stopped)
+        if usage is None:
+            _stats["estimated_usage"] += 1
+    if usage is None:
+        # Closing the stream early drops the final usage chunk, so estimate it locally
+        usage = (estimate_tokens(messages), estimate_tokens([{"content": reasoning + content}]))
+    return usage[0], usage[1], reasoning, content
+
+
+def collect_stream(stream_response, messages, stop_when=None):
+    """
+    Consumes a chat completion stream and returns (prompt_tokens, completion_tokens, reasoning_content, content).
+    With stop_when set, the stream is closed as soon as the condition is met (or when the request lost a hedge).
+    """
+    stopper = make_stopper(stop_when)
+    state = {"reasoning": [], "content": [], "usage": None}
+    stopped = False
+    for chunk in stream_response:
+        stop = _handle_chunk(chunk, state, stopper)
+        if stop or request_cancelled():
+            stopped = stop
+            stream_response.close()
+            break
+    return _finish(state, messages, stopped)
+
+
+async def collect_stream_async(stream_response, messages, stop_when=None):
+    """Asyncio counterpart of collect_stream."""
+    stopper = make_stopper(stop_when)
+    state = {"reasoning": [], "content": [], "usage": None}
+    stopped = False
+    async for chunk in stream_response:
+        stop = _handle_chunk(chunk, state, stopper)
+        if stop or request_cancelled():
+            stopped = stop
+            await stream_response.close()
+            break
+    return _finish(state, messages, stopped)
+
+
+def get_early_stop_stats():
+    """Returns {"streams": ..., "stopped": ..., "estimated_usage": ...} for the streamed calls so far."""
+    with _stats_lock:
+        return dict(_stats)
@@ -0,0 +1,29 @@
+# --- Typed LLM errors ---
+# Provider functions raise these instead of returning placeholder text as the answer content,
+# so callers can tell a failed call apart from a model answer that does not parse.
+
+
+class LLMError(Exception):
+    """Base class of every error raised by LLM_output and the provider functions."""
+
+
+class LLMConfigError(LLMError):
+    """The provider entry in LLM_config.json is missing or invalid."""
+
+
+class LLMCallFailed(LLMError):
+    """A provider call still failed after all of its retries."""
+    def __init__(self, message, provider=None, model=None, attempts=0):
+        super().__init__(message)
+        self.provider = provider
+        self.model = model
+        self.attempts = attempts
+
+
+class CircuitOpenError(LLMError):
+    """The circuit breaker of a (provider, model) is open and no fallback could take the request."""
+    def __init__(self, message, provider=None, model=None, retry_in=0.0):
+        super().__init__(message)
+        self.provider = provider
+        self.model = model
+        self.retry_in = retry_in
@@ -0,0 +1,343 @@
+import time
+import asyncio
+import threading
+import contextvars
+from collections import defaultdict, deque
+
+from LLM.client_pool import load_llm_config
+from LLM.errors import LLMError
+from LLM.ledger import begin_call, current_call, adopt_call, record_call
+
+# --- Hedged LLM requests ---
+# Reasoning calls have a long latency tail. With hedging enabled, a call to one of the configured
+# models that is still running after the chosen latency percentile of its (model, stage) gets a
+# duplicate request, and whichever answer arrives first is used.
+#
+# "Hedging" entry of LLM_config.json (or configure_hedging(...)):
+#   enabled         - turn hedging on
+#   models          - models that may be hedged (reasoning models with a long tail)
+#   percentile      - latency percentile after which the duplicate is sent (e.g. 50 or 95)
+#   min_samples     - observations of a (model, stage) needed before it is hedged
+#   min_delay       - never hedge earlier than this many seconds
+#   max_hedge_ratio - upper bound of hedges / calls, i.e. the extra cost that may be spent
+#
+# The primary request runs on the calling thread and the duplicate on a timer thread of its own, so a
+# busy worker pool can neither delay the primary nor trigger hedges for calls that have not started.
+# When one request answers, the other one is closed at its next stream chunk (request_cancelled);
+# providers stream every hedged request for this reason. Each request keeps its own ledger state: the
+# answer that is used is merged into the call's record, the other request is recorded as a hedge
+# (see LLM/ledger.py), so its tokens count toward the per-stage spend and the cost budgets.
+
+DEFAULT_HEDGING = {
+    "enabled": False,
+    "models": ["deepseek-reasoner", "deepseek-ai/DeepSeek-R1-0528", "Qwen/Qwen3-235B-A22B-Thinking-2507"],
+    "percentile": 95,
+    "min_samples": 20,
+    "min_delay": 5,
+    "max_hedge_ratio": 0.1
+}
+
+WINDOW_SIZE = 200  # latency observations kept per (model, stage)
+
+
+class LatencyTracker:
+    """Sliding-window latency percentiles per (model, stage)."""
+    def __init__(self, window=WINDOW_SIZE):
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def record(self, model, stage, seconds):
+        with self._lock:
+            self._samples[(model, stage)].append(seconds)
+
+    def count(self, model, stage):
+        with self._lock:
+            return len(self._samples[(model, stage)])
+
+    def percentile(self, model, stage, q):
+        """Returns the q-th percentile (0-100) of the recorded latencies, or None without samples."""
+        with self._lock:
+            samples = sorted(self._samples[(model, stage)])
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(q / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def summary(self):
+        with self._lock:
+            keys = list(self._samples)
+        return {f"{model} | {stage}": {"n": self.count(model, stage),
+                                       "p50": round(self.percentile(model, stage, 50), 2),
+                                       "p95": round(self.percentile(model, stage, 95), 2)}
+                for model, stage in keys}
+
+
+_settings = None
+_tracker = LatencyTracker()
+_stats = {"calls": 0, "hedges_fired": 0, "hedges_won": 0, "skipped_budget": 0}
+_lock = threading.Lock()
+# Set in the context of each request of a hedged call; the event fires when the other request has won
+_cancel = contextvars.ContextVar("hedge_cancel", default=None)
+
+
+def configure_hedging(**overrides):
+    """
+    (Re)configures hedging. Keyword arguments override the "Hedging" entry of LLM_config.json,
+    which overrides DEFAULT_HEDGING. Returns the active settings.
+    """
+    global _settings
+    try:
+        file_settings = load_llm_config().get("Hedging", {})
+    except FileNotFoundError:
+        file_settings = {}
+    settings = {**DEFAULT_HEDGING, **file_settings}
+    settings.update({k: v for k, v in overrides.items() if v is not None})
+    settings.pop("Describe", None)
+    with _lock:
+        _settings = settings
+    return settings
+
+
+def get_hedging_settings():
+    if _settings is None:
+        configure_hedging()
+    return _settings
+
+
+def hedge_delay(model, stage):
+    """
+    Seconds after which a call of (model, stage) gets a duplicate, or None when it must not be hedged.
+    """
+    settings = get_hedging_settings()
+    if not settings["enabled"] or model not in settings["models"]:
+        return None
+    if _tracker.count(model, stage) < settings["min_samples"]:
+        return None
+    return max(settings["min_delay"], _tracker.percentile(model, stage, settings["percentile"]))
+
+
+def _take_hedge_budget():
+    """Counts a fired hedge if the extra-cost cap allows it."""
+    with _lock:
+        if _stats["hedges_fired"] + 1 > get_hedging_settings()["max_hedge_ratio"] * _stats["calls"]:
+            _stats["skipped_budget"] += 1
+            return False
+        _stats["hedges_fired"] += 1
+        return True
+
+
+def hedged_request():
+    """Whether the running request belongs to a hedged call (the provider then streams it, so it can be closed)."""
+    return _cancel.get() is not None
+
+
+def request_cancelled():
+    """Whether the other request of the running hedged call has already answered. Streams check it after every chunk."""
+    event = _cancel.get()
+    return event is not None and event.is_set()
+
+
+def _timed(func, kwargs, model, stage):
+    start = time.time()
+    result = func(**kwargs)
+    _tracker.record(model, stage, time.time() - start)
+    return result
+
+
+class _HedgedCall:
+    """Shared state of the primary and the duplicate request of one hedged call."""
+    def __init__(self, model, stage, provider):
+        self.model, self.stage, self.provider = model, stage, provider
+        self.parent = current_call()
+        self.cancel = {"primary": threading.Event(), "hedge": threading.Event()}
+        self.outcomes = {}
+        self.winner = None
+        self.primary_done = False
+        self.hedged = False
+        self.hedge_done = threading.Event()
+        self._lock = threading.Lock()
+
+    def start_hedge(self):
+        """Claims the duplicate request unless the primary has finished or the extra-cost cap is reached."""
+        with self._lock:
+            if self.primary_done or not _take_hedge_budget():
+                return False
+            self.hedged = True
+            return True
+
+    def finish(self, name, outcome):
+        """
+        Settles a finished request with its (result, error, ledger state). Returns True when its answer is the
+        one used; the other request is then told to close its stream.
+        """
+        result, error, state = outcome
+        with self._lock:
+            self.outcomes[name] = outcome
+            if name == "primary":
+                self.primary_done = True
+            won = self.winner is None and error is None
+            if won:
+                self.winner = name
+                self.cancel["hedge" if name == "primary" else "primary"].set()
+            hedged = self.hedged
+        if won and name == "hedge":
+            with _lock:
+                _stats["hedges_won"] += 1
+        if won or not hedged:
+            adopt_call(self.parent, state)
+        elif state is not None:
+            # The request that was not used has been paid for all the same
+            record_call(state, self.stage, self.provider, self.model, result, ok=error is None, hedge=True)
+        return won
+
+    def abandon(self):
+        """The caller gave up (e.g. an unexpected exception): the duplicate is not sent or is closed."""
+        with self._lock:
+            self.primary_done = True
+            self.cancel["hedge"].set()
+
+
+def _run_request(func, kwargs, model, stage, cancel):
+    """
+    Runs one request of a hedged call and returns (result, error, ledger state). Must run in a context of
+    its own, since it sets the cancel event and the ledger state of the request.
+    """
+    _cancel.set(cancel)
+    state = begin_call()
+    try:
+        result = func(**kwargs)
+    except LLMError as e:
+        return None, e, state
+    if not cancel.is_set():
+        # A request closed because the other one won says nothing about the latency distribution
+        _tracker.record(model, stage, time.time() - state["start"])
+    return result, None, state
+
+
+async def _run_request_async(func, kwargs, model, stage, cancel):
+    """Asyncio counterpart of _run_request (a task runs in a copy of the caller's context already)."""
+    _cancel.set(cancel)
+    state = begin_call()
+    try:
+        result = await func(**kwargs)
+    except LLMError as e:
+        return None, e, state
+    if not cancel.is_set():
+        _tracker.record(model, stage, time.time() - state["start"])
+    return result, None, state
+
+
+def call_with_hedging(func, kwargs, model, stage=None, provider=None):
+    """
+    Calls func(**kwargs) on the calling thread, sending a duplicate request from a timer thread once the
+    call is slower than the configured percentile of (model, stage). Returns the first successful result;
+    the slower request is closed and recorded in the ledger under `provider`.
+    """
+    with _lock:
+        _stats["calls"] += 1
+    delay = hedge_delay(model, stage)
+    if delay is None:
+        return _timed(func, kwargs, model, stage)
+
+    race = _HedgedCall(model, stage, provider)
+
+    def run_hedge():
+        try:
+            if race.start_hedge():
+                try:
+                    outcome = _run_request(func, kwargs, model, stage, race.cancel["hedge"])
+                except Exception as e:
+                    outcome = (None, e, None)
+                race.finish("hedge", outcome)
+        except Exception as e:
+            print(f"[Hedging] Could not settle the duplicate request of '{model}': {e}")
+        finally:
+            race.hedge_done.set()
+
+    # Both requests run with a copy of the caller's context so the ledger attributes them to this call
+    timer = threading.Timer(delay, contextvars.copy_context().run, args=(run_hedge,))
+    timer.name, timer.daemon = "llm-hedge", True
+    timer.start()
+    try:
+        outcome = contextvars.copy_context().run(_run_request, func, kwargs, model, stage, race.cancel["primary"])
+    except BaseException:
+        timer.cancel()
+        race.abandon()
+        raise
+    timer.cancel()
+
+    if race.finish("primary", outcome):
+        return outcome[0]
+    if race.hedged:
+        race.hedge_done.wait()
+        if race.winner == "hedge":
+            return race.outcomes["hedge"][0]
+    # A failed request only counts when the other one has failed too (or was never sent)
+    raise outcome[1]
+
+
+def _settle_task(race, name, task):
+    """Done callback of the request that lost an async hedged call: records it once its stream is closed."""
+    if task.cancelled() or task.exception() is not None:
+        return
+    try:
+        race.finish(name, task.result())
+    except Exception as e:
+        print(f"[Hedging] Could not settle the {name} request of '{race.model}': {e}")
+
+
+async def call_with_hedging_async(func, kwargs, model, stage=None, provider=None):
+    """
+    Asyncio counterpart of call_with_hedging. The losing request closes its stream at its next chunk and is
+    recorded when it finishes; both requests are cancelled when the caller is.
+    """
+    with _lock:
+        _stats["calls"] += 1
+
+    async def timed():
+        start = time.time()
+        result = await func(**kwargs)
+        _tracker.record(model, stage, time.time() - start)
+        return result
+
+    delay = hedge_delay(model, stage)
+    if delay is None:
+        return await timed()
+
+    race = _HedgedCall(model, stage, provider)
+    # Tasks run in a copy of the caller's context, so the cancel event and ledger state stay per request
+    tasks = {asyncio.ensure_future(_run_request_async(func, kwargs, model, stage, race.cancel["primary"])): "primary"}
+    done, _ = await asyncio.wait(set(tasks), timeout=delay)
+    if not done and race.start_hedge():
+        tasks[asyncio.ensure_future(_run_request_async(func, kwargs, model, stage, race.cancel["hedge"]))] = "hedge"
+
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            answer = None
+            for task in done:
+                outcome = task.result()
+                if race.finish(tasks[task], outcome):
+                    answer = outcome
+            if answer is not None:
+                for task in pending:
+                    task.add_done_callback(lambda t, name=tasks[task]: _settle_task(race, name, t))
+                pending = set()
+                return answer[0]
+        # A failed request only counts when the other one has failed too (or was never sent)
+        raise race.outcomes["primary"][1]
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def get_hedging_stats():
+    """
+    Returns the hedging counters and the tracked latency percentiles, e.g.
+    {"calls": 500, "hedges_fired": 31, "hedges_won": 22, "skipped_budget": 4, "latency": {...}}
+    """
+    with _lock:
+        stats = dict(_stats)
+    stats["latency"] = _tracker.summary()
+    return stats
@@ -0,0 +1,302 @@
+import os
+import json
+import time
+import threading
+import contextvars
+from collections import defaultdict, deque
+
+from LLM.client_pool import load_llm_config
+from LLM.usage_stats import prompt_cache_tokens
+from LLM.rate_limiter import estimate_tokens
+
+# --- Per-call token and cost ledger ---
+# Every LLM_output call appends one record: stage, provider, model, prompt / completion / reasoning /
+# cached tokens, latency, failed attempts and cost, tagged with the instance, run and DB of the context
+# set by the pipeline. When a path is configured, every record is appended to a JSONL file; in memory the
+# ledger only keeps running totals per (instance, run, db, stage, provider, model) for get_ledger_totals /
+# get_ledger_summary(by=...) and the last RECENT_RECORDS records, so a long multi-path run does not grow
+# with the number of calls.
+#
+# Both requests of a hedged call (LLM/hedging.py) are paid for: the one whose answer is used is part of the
+# call's record, the other one gets a record of its own with "hedge": true (counted under "hedges").
+#
+# "Ledger" entry of LLM_config.json:
+#   prices - per model, price per 1M tokens: {"input": ..., "cached_input": ..., "output": ...}
+#   budget - "<scope>_tokens" / "<scope>_cost" limits for scope in instance, run, db (0 disables);
+#            the budget alarm fires once per scope key when a limit is crossed.
+#
+# The context lives in context variables, so asyncio tasks inherit it. Worker threads do not: submit
+# work with contextvars.copy_context().run (as LLM/hedging.py does) or call set_ledger_context there.
+
+SCOPES = ("instance", "run", "db")
+GROUP_FIELDS = ("instance", "run", "db", "stage", "provider", "model")
+SUM_FIELDS = ("prompt_tokens", "completion_tokens", "reasoning_tokens", "cached_tokens", "latency", "retries", "cost")
+RECENT_RECORDS = 1000
+
+_context = contextvars.ContextVar("ledger_context", default={})
+_call = contextvars.ContextVar("ledger_call", default=None)
+
+_recent = deque(maxlen=RECENT_RECORDS)
+_groups = {}  # tuple of GROUP_FIELDS values -> counters of the records in that group
+_totals = defaultdict(lambda: {"tokens": 0, "cost": 0.0})  # (scope, key) -> running totals for the budget alarm
+_alarmed = set()
+_settings = None
+_sink_path = None
+_lock = threading.Lock()
+
+
+def _default_alarm(scope, key, metric, value, limit):
+    print(f"[Ledger] Budget exceeded for {scope} '{key}': {metric} = {value:.4g} > {limit:.4g}")
+
+
+_alarm = _default_alarm
+
+
+# ------------------- Configuration -------------------
+
+def configure_ledger(path=None, prices=None, budget=None):
+    """
+    (Re)configures the ledger. `prices` and `budget` override the "Ledger" entry of LLM_config.json.
+    With `path` set, every record is also appended to that JSONL file.
+    """
+    global _settings, _sink_path
+    try:
+        file_settings = load_llm_config().get("Ledger", {})
+    except FileNotFoundError:
+        file_settings = {}
+    settings = {"prices": {**file_settings.get("prices", {}), **(prices or {})},
+                "budget": {**file_settings.get("budget", {}), **(budget or {})}}
+    with _lock:
+        _settings = settings
+        _sink_path = path
+    if path and os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    return settings
+
+
+def _get_settings():
+    if _settings is None:
+        configure_ledger()
+    return _settings
+
+
+def set_budget_alarm(callback):
+    """
+    Installs the budget alarm hook, called as callback(scope, key, metric, value, limit),
+    e.g. callback("instance", "local062", "cost", 1.37, 1.0). None restores the default warning.
+    """
+    global _alarm
+    _alarm = callback or _default_alarm
+
+
+def set_ledger_context(**fields):
+    """
+    Tags the following LLM calls of the current thread / task, e.g. set_ledger_context(instance="local062", db="complex_oracle").
+    Fields set to None are removed.
+    """
+    context = {**_context.get(), **fields}
+    _context.set({k: v for k, v in context.items() if v is not None})
+
+
+def get_ledger_context():
+    return dict(_context.get())
+
+
+# ------------------- Per-call state -------------------
+
+def begin_call():
+    """
+    Starts the bookkeeping of one LLM_output call. The state dict is shared with the threads and tasks
+    that run the request, so retries and usage noted there end up in the same record.
+    """
+    state = {"start": time.time(), "retries": 0, "reasoning_tokens": None, "cached_tokens": None}
+    _call.set(state)
+    return state
+
+
+def current_call():
+    """The state of the LLM_output call running in this context, or None."""
+    return _call.get()
+
+
+def adopt_call(parent, state):
+    """
+    Merges the state of the request whose answer a call uses (e.g. the winner of a hedged call, which ran
+    with a state of its own) into the state of the call.
+    """
+    if parent is None or state is None:
+        return
+    parent["retries"] += state["retries"]
+    for field in ("reasoning_tokens", "cached_tokens"):
+        if state[field] is not None:
+            parent[field] = state[field]
+
+
+def note_retry():
+    """Counts a failed attempt of the running call (called by the provider functions)."""
+    state = _call.get()
+    if state is not None:
+        state["retries"] += 1
+
+
+def note_usage(usage):
+    """Takes the reasoning and cached prompt tokens from a provider usage block."""
+    state = _call.get()
+    if state is None or usage is None:
+        return
+    details = getattr(usage, "completion_tokens_details", None)
+    reasoning = getattr(details, "reasoning_tokens", None) if details is not None else None
+    if reasoning is not None:
+        state["reasoning_tokens"] = reasoning
+    cache_tokens = prompt_cache_tokens(usage)
+    if cache_tokens is not None:
+        state["cached_tokens"] = cache_tokens[0]
+
+
+def call_cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    """Cost of one call from the configured prices (0 for models without a price)."""
+    price = _get_settings()["prices"].get(model)
+    if not price:
+        return 0.0
+    cached_tokens = min(cached_tokens or 0, prompt_tokens)
+    return ((prompt_tokens - cached_tokens) * price.get("input", 0)
+            + cached_tokens * price.get("cached_input", price.get("input", 0))
+            + completion_tokens * price.get("output", 0)) / 1_000_000
+
+
+def _empty_totals():
+    return {"calls": 0, "failed": 0, "cache_hits": 0, "hedges": 0, "prompt_tokens": 0, "completion_tokens": 0,
+            "reasoning_tokens": 0, "cached_tokens": 0, "latency": 0.0, "retries": 0, "cost": 0.0}
+
+
+def _add_record(totals, record):
+    if record.get("hedge"):
+        totals["hedges"] += 1
+    else:
+        totals["calls"] += 1
+        totals["failed"] += int(not record["ok"])
+        totals["cache_hits"] += int(record["cache_hit"])
+    for field in SUM_FIELDS:
+        totals[field] += record[field]
+
+
+def record_call(state, stage, provider, model, result=None, ok=True, cache_hit=False, hedge=False):
+    """
+    Closes the bookkeeping of a call and appends its record.
+
+    Args:
+        state (dict): The state returned by begin_call().
+        stage (str): Pipeline stage of the call.
+        provider (str): Provider that answered (None for cache hits and failures).
+        model (str): Model that answered, or the requested model.
+        result (tuple): (prompt_tokens, completion_tokens, reasoning, content) of a successful call.
+        ok (bool): Whether an answer was produced.
+        cache_hit (bool): Whether the answer came from the local response cache (no tokens are spent).
+        hedge (bool): Whether this is the unused request of a hedged call.
+
+    Returns:
+        dict: The record.
+    """
+    prompt_tokens = completion_tokens = reasoning_tokens = cached_tokens = 0
+    if result is not None and not cache_hit:
+        prompt_tokens, completion_tokens = result[0] or 0, result[1] or 0
+        reasoning_tokens = state["reasoning_tokens"]
+        if reasoning_tokens is None:
+            # Streams stopped early and most providers do not report reasoning tokens separately
+            reasoning_tokens = estimate_tokens([{"content": result[2]}]) if result[2] else 0
+        cached_tokens = state["cached_tokens"] or 0
+
+    record = {
+        "timestamp": round(time.time(), 3),
+        **get_ledger_context(),
+        "stage": stage,
+        "provider": provider,
+        "model": model,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "reasoning_tokens": reasoning_tokens,
+        "cached_tokens": cached_tokens,
+        "latency": round(time.time() - state["start"], 3),
+        "retries": state["retries"],
+        "cost": round(call_cost(model, prompt_tokens, completion_tokens, cached_tokens), 6),
+        "ok": ok,
+        "cache_hit": cache_hit
+    }
+    if hedge:
+        record["hedge"] = True
+
+    alarms = []
+    budget = _get_settings()["budget"]
+    with _lock:
+        _recent.append(record)
+        group = tuple(record.get(field) for field in GROUP_FIELDS)
+        if group not in _groups:
+            _groups[group] = _empty_totals()
+        _add_record(_groups[group], record)
+        for scope in SCOPES:
+            key = record.get(scope)
+            if key is None:
+                continue
+            totals = _totals[(scope, key)]
+            totals["tokens"] += prompt_tokens + completion_tokens
+            totals["cost"] += record["cost"]
+            for metric in ("tokens", "cost"):
+                limit = budget.get(f"{scope}_{metric}")
+                if limit and totals[metric] > limit and (scope, key, metric) not in _alarmed:
+                    _alarmed.add((scope, key, metric))
+                    alarms.append((scope, key, metric, totals[metric], limit))
+        if _sink_path:
+            with open(_sink_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    # The hook runs outside the lock so it may call back into the ledger (or raise to abort the instance)
+    for alarm in alarms:
+        _alarm(*alarm)
+    return record
+
+
+# ------------------- Aggregation -------------------
+
+def _check_filters(filters):
+    unknown = set(filters) - set(GROUP_FIELDS)
+    if unknown:
+        raise ValueError(f"Invalid filter fields: {sorted(unknown)}. Supported fields: {GROUP_FIELDS}.")
+
+
+def get_ledger_records(**filters):
+    """
+    Returns the recent records (the last RECENT_RECORDS) matching all filters, e.g. get_ledger_records(instance="local062").
+    The complete history is the JSONL file set with configure_ledger(path=...).
+    """
+    with _lock:
+        return [dict(r) for r in _recent if all(r.get(k) == v for k, v in filters.items())]
+
+
+def _matching_groups(filters):
+    _check_filters(filters)
+    index = {field: i for i, field in enumerate(GROUP_FIELDS)}
+    with _lock:
+        return [(group, dict(totals)) for group, totals in _groups.items()
+                if all(group[index[k]] == v for k, v in filters.items())]
+
+
+def get_ledger_totals(**filters):
+    """Sums the calls matching the filters (fields of GROUP_FIELDS) into a single dict of counters."""
+    totals = _empty_totals()
+    for _, group_totals in _matching_groups(filters):
+        for field, value in group_totals.items():
+            totals[field] += value
+    totals["latency"] = round(totals["latency"], 3)
+    totals["cost"] = round(totals["cost"], 6)
+    return totals
+
+
+def get_ledger_summary(by="stage", **filters):
+    """
+    Aggregates the calls per value of `by` ("instance", "run", "db", "stage", "provider" or "model"), e.g.
+    {"SQL Continuation Stage": {"calls": 40, "hedges": 2, "prompt_tokens": 190000, ..., "latency": 4100.2, "cost": 1.9}}
+    """
+    if by not in GROUP_FIELDS:
+        raise ValueError(f"Invalid group field: '{by}'. Supported values: {GROUP_FIELDS}.")
+    keys = {group[GROUP_FIELDS.index(by)] for group, _ in _matching_groups(filters)}
+    return {key: get_ledger_totals(**{**filters, by: key}) for key in sorted(keys, key=str)}
@@ -0,0 +1,247 @@
+import time
+import random
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+
+from LLM.client_pool import load_llm_config
+
+# --- Shared per-provider rate limiter ---
+# Each provider entry of LLM_config.json may define
+#     "rate_limit": {"rpm": <requests per minute>, "tpm": <tokens per minute>}
+# (0 or missing disables that budget). All threads and event loops of the process draw from the
+# same token buckets, and a 429 pauses the whole provider until its Retry-After has passed.
+#
+# Every attempt reserves its estimated prompt tokens. A successful attempt replaces the estimate by its
+# usage (settle_usage); a failed one is refunded only when it never reached the provider (settle_failure).
+
+BACKOFF_BASE = 1.0   # seconds
+BACKOFF_CAP = 60.0   # seconds
+
+
+class TokenBucket:
+    """
+    A token bucket that refills continuously at `per_minute / 60` units per second.
+    Reservations may drive the level negative; the caller then waits until the debt is repaid,
+    which keeps concurrent callers in FIFO order without a condition variable.
+    """
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount, now):
+        """Takes `amount` units and returns how many seconds the caller has to wait before using them."""
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= min(amount, self.capacity)
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def refund(self, amount):
+        """Corrects an earlier reservation (negative amounts charge extra units)."""
+        self.level = min(self.capacity, self.level + amount)
+
+
+class ProviderLimiter:
+    def __init__(self, provider, rpm=0, tpm=0):
+        self.provider = provider
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "waits": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0, "rate_limited": 0}
+
+    def _reserve(self, estimated_tokens):
+        now = time.monotonic()
+        with self._lock:
+            wait = max(0.0, self.blocked_until - now)
+            if self.requests:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens:
+                wait = max(wait, self.tokens.reserve(estimated_tokens, now))
+
+            self.stats["requests"] += 1
+            if wait > 0:
+                self.stats["waits"] += 1
+                self.stats["wait_seconds"] += wait
+                self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], wait)
+        return wait
+
+    def _unreserve(self, estimated_tokens):
+        with self._lock:
+            if self.requests:
+                self.requests.refund(1)
+            if self.tokens:
+                self.tokens.refund(estimated_tokens)
+
+    def acquire(self, estimated_tokens=0):
+        """
+        Blocks until the request fits into the provider budgets. Returns the time waited in seconds.
+        When the wait is interrupted, the reservation is given back before the exception propagates.
+        """
+        wait = self._reserve(estimated_tokens)
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            except BaseException:
+                self._unreserve(estimated_tokens)
+                raise
+        return wait
+
+    async def acquire_async(self, estimated_tokens=0):
+        """Asyncio counterpart of acquire (a cancelled wait gives its reservation back)."""
+        wait = self._reserve(estimated_tokens)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except BaseException:
+                self._unreserve(estimated_tokens)
+                raise
+        return wait
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """
+        Replaces the estimated token reservation by `actual_tokens` (0 refunds it; None keeps the estimate).
+        """
+        if self.tokens and actual_tokens is not None:
+            with self._lock:
+                self.tokens.refund(estimated_tokens - actual_tokens)
+
+    def settle_usage(self, estimated_tokens, prompt_tokens, completion_tokens):
+        """
+        Settles a successful attempt with the prompt + completion tokens of its usage block.
+        A response without usage (both 0) keeps the estimate.
+        """
+        self.settle(estimated_tokens, (prompt_tokens or 0) + (completion_tokens or 0) or None)
+
+    def settle_failure(self, estimated_tokens, e):
+        """
+        Settles an attempt that was sent and failed with `e`. The reservation is refunded only when the request
+        never reached the provider (connection errors, 429s); timeouts and server errors keep the estimate,
+        since the provider has usually counted the prompt against its TPM budget already.
+        """
+        if not reached_provider(e):
+            self.settle(estimated_tokens, 0)
+
+    def pause(self, seconds):
+        """Holds back every caller of this provider, e.g. after a 429 with a Retry-After header."""
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.stats["rate_limited"] += 1
+
+
+# --- Process-wide registry ---
+_limiters = {}
+_registry_lock = threading.Lock()
+
+
+def get_limiter(provider):
+    limiter = _limiters.get(provider)
+    if limiter is None:
+        with _registry_lock:
+            limiter = _limiters.get(provider)
+            if limiter is None:
+                try:
+                    rate_limit = load_llm_config().get(provider, {}).get("rate_limit", {})
+                except FileNotFoundError:
+                    rate_limit = {}
+                limiter = ProviderLimiter(provider, rpm=rate_limit.get("rpm", 0), tpm=rate_limit.get("tpm", 0))
+                _limiters[provider] = limiter
+    return limiter
+
+
+def get_limiter_stats():
+    """
+    Returns the limiter metrics of every provider used so far, e.g.
+    {"Modelscope": {"requests": 120, "waits": 14, "wait_seconds": 37.2, "max_wait_seconds": 6.1, "rate_limited": 2}}
+    """
+    with _registry_lock:
+        return {provider: {k: (round(v, 3) if isinstance(v, float) else v) for k, v in limiter.stats.items()}
+                for provider, limiter in _limiters.items()}
+
+
+# --- Helpers shared by the provider functions ---
+
+def estimate_tokens(messages):
+    """
+    Estimates the prompt tokens of a message list with the local DeepSeek tokenizer,
+    falling back to a characters-per-token heuristic when the tokenizer is unavailable.
+    """
+    text = "\n".join(str(m.get("content", "")) for m in messages)
+    try:
+        from utils.mytoken.deepseek_tokenizer import get_token_count
+        return get_token_count(text)
+    except Exception:
+        return len(text) // 3 + 1
+
+
+def is_rate_limit_error(e):
+    status = getattr(e, "status_code", None)
+    if status is None and getattr(e, "response", None) is not None:
+        status = getattr(e.response, "status_code", None)
+    return status == 429 or type(e).__name__ == "RateLimitError"
+
+
+def reached_provider(e):
+    """
+    Whether a failed request may have been processed (and billed against TPM) by the provider:
+    False for rate-limit rejections and for connection errors other than timeouts.
+    """
+    if is_rate_limit_error(e):
+        return False
+    names = {cls.__name__ for cls in type(e).__mro__}
+    if names & {"APITimeoutError", "TimeoutException", "TimeoutError", "ReadTimeout"}:
+        return True
+    return not names & {"APIConnectionError", "ConnectError", "ConnectionError"}
+
+
+def retry_after_seconds(e):
+    """
+    Reads the Retry-After (or retry-after-ms) header of an API error. Returns None when absent.
+    """
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except Exception:
+            return None
+
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Delay before retry number `attempt` (1-based): the server's Retry-After plus a little jitter when known,
+    otherwise full-jitter exponential backoff capped at BACKOFF_CAP.
+    """
+    if retry_after is not None:
+        return retry_after + random.uniform(0, BACKOFF_BASE)
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def on_call_error(limiter, e, attempt):
+    """
+    Registers a failed attempt and returns how long to sleep before the next one.
+    Rate-limit errors pause the whole provider so concurrent callers do not pile onto it.
+    """
+    retry_after = retry_after_seconds(e)
+    if is_rate_limit_error(e):
+        # The next acquire() waits out the pause, so the caller itself does not sleep
+        limiter.pause(backoff_delay(attempt, retry_after))
+        return 0.0
+    return backoff_delay(attempt, retry_after)
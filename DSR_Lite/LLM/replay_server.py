@@ -0,0 +1,460 @@
+import os
+import re
+import ast
+import sys
+import json
+import glob
+import time
+import random
+import hashlib
+import argparse
+import threading
+from collections import defaultdict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- Offline LLM replay server ---
+# Benchmarks the pipeline without paying for API time. Recorded runs already contain every prompt,
+# reasoning and answer, so they are harvested into a corpus and served by a local OpenAI-compatible
+# stand-in that sleeps for a latency drawn from the recorded timings.
+#
+#   1. Harvest one or more result directories into a corpus:
+#        python -m LLM.replay_server harvest Result_12081549 --out replay_corpus.jsonl
+#   2. Serve it:
+#        python -m LLM.replay_server serve replay_corpus.jsonl --port 8765 --latency sample --time_scale 0.1
+#   3. Point every provider at it and run the pipeline as usual:
+#        DSR_LLM_ENDPOINT_OVERRIDE=http://127.0.0.1:8765/v1 python main_lite.py ...
+#
+# A request whose messages were recorded verbatim gets its recorded answer. Any other request is
+# classified by prompt kind (exploration, SQL generation, schema linking, ...) and answered with a
+# recorded response of the same kind, so the parsers downstream see well-formed answers.
+# GET /stats returns the served requests and injected latency per prompt kind.
+
+# Ordered (kind, marker) pairs matched against the last user message. Markers are taken from the
+# templates in utils/Prompt.py, utils/SL/*.py and utils/Database_Interface.py.
+PROMPT_KINDS = [
+    ("sql_repair", "Please analyze and fix the current"),
+    ("simple_fix", "**SQL that reports an error:**"),
+    ("exploration", "## Task("),
+    ("aggregation", "responsible for inferring key information for SQL generation"),
+    ("sql_generation", "most confidently solvable sub-question"),
+    ("sql_continuation", "most confident next sub-question"),
+    ("schema_linking", "generate 5 to 10 diverse"),
+    ("schema_linking", "write one SQL statement to maximize the potential of the current table"),
+    ("extract_tables", "extract the entity tables and columns"),
+    ("sql_completion", "specialized in completing repetitive code"),
+    ("knowledge_compression", "---Knowledge Base---"),
+]
+
+LATENCY_MODES = ("sample", "recorded", "fixed", "none")
+CHUNK_CHARS = 64  # characters per streamed delta
+
+# Newer logs carry the thread name after the level, so the interleaved calls of concurrent workers can be paired
+_LOG_RECORD = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) - \S+ - [A-Z]+ - (?:([\w\-]+) - )?", re.MULTILINE)
+_PROMPT_RECORD = re.compile(r"^(?:Prompt：|fix prompt: |prompt: |【Question_id: [^】]*】 \|\s+LLM Input: )(\[.*\])\s*$", re.DOTALL)
+_STAGE_RECORD = re.compile(r"Start Stage: ([^】]+)】")
+
+
+# ------------------- Corpus -------------------
+
+def messages_key(messages):
+    """Hash of the (role, content) sequence used for exact matching."""
+    normalized = [[m.get("role", ""), str(m.get("content", ""))] for m in messages]
+    return hashlib.sha256(json.dumps(normalized, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def classify_messages(messages):
+    """Returns the prompt kind of a message list (see PROMPT_KINDS), or "other"."""
+    user_messages = [str(m.get("content", "")) for m in messages if m.get("role") == "user"]
+    text = user_messages[-1] if user_messages else ""
+    for kind, marker in PROMPT_KINDS:
+        if marker in text:
+            return kind
+    return "other"
+
+
+def _estimate_tokens(text):
+    return len(text) // 3 + 1
+
+
+def _make_entry(messages, reasoning, content, latency, source, question_id=None, stage=None, model=None,
+                prompt_tokens=None, completion_tokens=None):
+    return {
+        "key": messages_key(messages),
+        "kind": classify_messages(messages),
+        "stage": stage,
+        "question_id": question_id,
+        "model": model,
+        "reasoning": reasoning or "",
+        "content": content or "",
+        "prompt_tokens": prompt_tokens or _estimate_tokens("\n".join(str(m.get("content", "")) for m in messages)),
+        "completion_tokens": completion_tokens or _estimate_tokens((reasoning or "") + (content or "")),
+        "latency": round(max(0.0, latency), 3),
+        "source": source
+    }
+
+
+def _read_log_records(path):
+    """Splits a main_*.log file into (timestamp, thread, message) records; messages may span several lines."""
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        text = f.read()
+    matches = list(_LOG_RECORD.finditer(text))
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        timestamp = datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S,%f").timestamp()
+        yield timestamp, match.group(2), text[match.end():end].rstrip("\n")
+
+
+def _read_status(path):
+    """Token counts of status_*.jsonl grouped by step name, in logging order."""
+    tokens = defaultdict(list)
+    if not os.path.exists(path):
+        return tokens
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(record.get("step"), str) and record["step"] != "Time Cost":
+                tokens[record["step"]].append((record.get("input_token_count"), record.get("output_token_count")))
+    return tokens
+
+
+def harvest_main_log(log_path, status_path=None):
+    """
+    Extracts the LLM calls of one main_*.log file.
+
+    Each prompt record (FGE "Prompt：", "fix prompt:", IA "LLM Input:", GSB/CSW "prompt:") is paired with the
+    following Thinking/Output records of the same thread. The latency is the time between the last
+    "Calling language model" (or prompt) record and the output record. Token counts are taken from the matching status_*.jsonl
+    step when available and estimated otherwise.
+
+    Returns:
+        list: Corpus entries.
+    """
+    run_key = os.path.basename(os.path.dirname(log_path))
+    question_id = run_key.rsplit("_", 1)[0]
+    status_tokens = _read_status(status_path) if status_path else {}
+
+    entries = []
+    stage = None
+    calls = defaultdict(lambda: {"messages": None, "repair": False, "call_start": None, "reasoning": ""})  # per thread
+    for timestamp, thread, message in _read_log_records(log_path):
+        stage_match = _STAGE_RECORD.search(message)
+        if stage_match:
+            stage = stage_match.group(1).strip()
+            continue
+
+        call = calls[thread]
+        prompt_match = _PROMPT_RECORD.match(message)
+        if prompt_match:
+            try:
+                call["messages"] = ast.literal_eval(prompt_match.group(1))
+            except (ValueError, SyntaxError):
+                call["messages"] = None
+                continue
+            call["repair"] = message.startswith("fix prompt")
+            call["call_start"], call["reasoning"] = timestamp, ""
+            continue
+
+        if call["messages"] is None:
+            continue
+        if "Calling language model" in message:
+            call["call_start"] = timestamp
+            continue
+
+        head, _, body = message.lstrip("\n").partition("\n")
+        if head.endswith("Thinking]:") or head.endswith("Thinking content:"):
+            call["reasoning"] = body
+        elif head.endswith("Output]:") or head.endswith("output content:"):
+            # Status steps follow main_lite.py: "<step> Repair Stage" for exploration repairs, "<step> Repair" otherwise
+            step = stage if not call["repair"] else (f"{stage} Repair Stage" if stage == "Exploration Stage" else f"{stage} Repair")
+            queue = status_tokens.get(step)
+            prompt_tokens, completion_tokens = queue.pop(0) if queue else (None, None)
+            entries.append(_make_entry(call["messages"], call["reasoning"], body, timestamp - (call["call_start"] or timestamp),
+                                       source=os.path.basename(log_path), question_id=question_id, stage=step,
+                                       prompt_tokens=prompt_tokens, completion_tokens=completion_tokens))
+            call["reasoning"] = ""
+    return entries
+
+
+def harvest_sl_log(log_path, status_path=None):
+    """
+    Extracts the schema-linking calls of Other_log/LOG_SL/LLM_call_SL.log.
+    V3_SL.jsonl records hold the elapsed time of the LLM call plus the table extraction in "step".
+    A call is matched with the record whose time window contains its log timestamp, which gives the
+    token counts and the LLM part of the latency. Calls without a record (e.g. a failed extraction
+    that was retried) get the median latency of the matched ones.
+    """
+    windows = defaultdict(list)
+    if status_path and os.path.exists(status_path):
+        with open(status_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    end = datetime.fromisoformat(record["TIME"]).timestamp()
+                    windows[record.get("Question_id")].append((end - float(record["step"]), end, record))
+                except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                    continue
+
+    entries, unmatched = [], []
+    with open(log_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                # Timestamps are truncated to the second
+                logged_at = datetime.strptime(record["timestamp"], "%Y-%m-%d %H:%M:%S").timestamp() + 0.5
+            except (json.JSONDecodeError, KeyError, ValueError):
+                continue
+            question_id = record.get("Question_id")
+            match = next((w for w in windows[question_id] if w[0] - 1 <= logged_at <= w[1] + 1), None)
+            latency, prompt_tokens, completion_tokens = 0.0, None, None
+            if match is not None:
+                windows[question_id].remove(match)
+                latency = max(0.1, logged_at - match[0])
+                prompt_tokens, completion_tokens = match[2].get("input_token_count"), match[2].get("output_token_count")
+
+            messages = [{"role": "user", "content": record.get("prompt", "")}]
+            entry = _make_entry(messages, record.get("think"), record.get("output"), latency,
+                                source=os.path.basename(log_path), question_id=question_id, stage="Schema Linking",
+                                model=record.get("model"), prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+            entries.append(entry)
+            if match is None:
+                unmatched.append(entry)
+
+    matched = sorted(e["latency"] for e in entries if e not in unmatched)
+    for entry in unmatched:
+        entry["latency"] = matched[len(matched) // 2] if matched else 0.0
+    return entries
+
+
+def harvest(result_dirs, out_path):
+    """
+    Harvests every recorded LLM call of the given Result_* directories into a JSONL corpus.
+
+    Args:
+        result_dirs (list): Result directories containing log/<run_key>/main_<run_key>.log and Other_log/.
+        out_path (str): Output corpus path.
+
+    Returns:
+        dict: Number of harvested entries per prompt kind.
+    """
+    entries = []
+    for result_dir in result_dirs:
+        for log_path in sorted(glob.glob(os.path.join(result_dir, "log", "*", "main_*.log"))):
+            run_key = os.path.basename(os.path.dirname(log_path))
+            status_path = os.path.join(os.path.dirname(log_path), f"status_{run_key}.jsonl")
+            entries.extend(harvest_main_log(log_path, status_path))
+
+        sl_log = os.path.join(result_dir, "Other_log", "LOG_SL", "LLM_call_SL.log")
+        if os.path.exists(sl_log):
+            entries.extend(harvest_sl_log(sl_log, os.path.join(result_dir, "Other_log", "LOG_SL", "V3_SL.jsonl")))
+
+    with open(out_path, "w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    counts = defaultdict(int)
+    for entry in entries:
+        counts[entry["kind"]] += 1
+    return dict(counts)
+
+
+def load_corpus(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# ------------------- Server -------------------
+
+class ReplayCorpus:
+    """Recorded responses indexed by message hash and by prompt kind, plus the serving counters."""
+    def __init__(self, entries, latency="sample", fixed_latency=1.0, time_scale=1.0, seed=None):
+        if latency not in LATENCY_MODES:
+            raise ValueError(f"Invalid latency mode: '{latency}'. Supported values: {LATENCY_MODES}.")
+        self.size = len(entries)
+        self.by_key = defaultdict(list)
+        self.by_kind = defaultdict(list)
+        for entry in entries:
+            self.by_key[entry["key"]].append(entry)
+            self.by_kind[entry["kind"]].append(entry)
+        self.latency = latency
+        self.fixed_latency = fixed_latency
+        self.time_scale = time_scale
+        self.random = random.Random(seed)
+        self.started = time.time()
+        self.stats = defaultdict(lambda: {"requests": 0, "exact": 0, "missing": 0, "injected_seconds": 0.0})
+        self._lock = threading.Lock()
+
+    def lookup(self, messages):
+        """Returns (entry, kind, exact) for a request; entry is None when nothing of that kind was recorded."""
+        kind = classify_messages(messages)
+        # Retried prompts were recorded several times; any of their answers is a valid replay
+        exact_entries = self.by_key.get(messages_key(messages))
+        candidates = exact_entries or self.by_kind.get(kind)
+        exact = bool(exact_entries)
+        with self._lock:
+            entry = self.random.choice(candidates) if candidates else None
+            stats = self.stats[kind]
+            stats["requests"] += 1
+            stats["exact"] += int(exact)
+            stats["missing"] += int(entry is None)
+        return entry, kind, exact
+
+    def delay(self, entry, kind):
+        """Seconds to wait before the response is complete."""
+        if self.latency == "none":
+            seconds = 0.0
+        elif self.latency == "fixed":
+            seconds = self.fixed_latency
+        elif self.latency == "recorded":
+            seconds = entry["latency"]
+        else:
+            with self._lock:
+                seconds = self.random.choice(self.by_kind[kind])["latency"]
+        seconds *= self.time_scale
+        with self._lock:
+            self.stats[kind]["injected_seconds"] += seconds
+        return seconds
+
+    def summary(self):
+        with self._lock:
+            kinds = {kind: {**stats, "injected_seconds": round(stats["injected_seconds"], 3)}
+                     for kind, stats in self.stats.items()}
+        return {"uptime_seconds": round(time.time() - self.started, 3), "corpus_size": self.size, "kinds": kinds}
+
+
+def _chunks(text):
+    return [text[i:i + CHUNK_CHARS] for i in range(0, len(text), CHUNK_CHARS)]
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    corpus = None  # set by serve()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        payload = f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8") if data is not None else b"data: [DONE]\n\n"
+        self.wfile.write(f"{len(payload):x}\r\n".encode("ascii") + payload + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            models = sorted({e.get("model") or "replay" for entries in self.corpus.by_kind.values() for e in entries})
+            self._send_json(200, {"object": "list", "data": [{"id": m, "object": "model", "owned_by": "replay"} for m in models]})
+        elif self.path.rstrip("/").endswith("/stats"):
+            self._send_json(200, self.corpus.summary())
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "not_found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "not_found"}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        messages = request.get("messages", [])
+        model = request.get("model", "replay")
+
+        entry, kind, exact = self.corpus.lookup(messages)
+        if entry is None:
+            self._send_json(404, {"error": {"message": f"No recorded response for prompt kind '{kind}'.", "type": "not_found"}})
+            return
+
+        delay = self.corpus.delay(entry, kind)
+        usage = {"prompt_tokens": entry["prompt_tokens"], "completion_tokens": entry["completion_tokens"],
+                 "total_tokens": entry["prompt_tokens"] + entry["completion_tokens"]}
+        response_id = f"replay-{entry['key'][:12]}-{int(time.time() * 1000)}"
+        base = {"id": response_id, "created": int(time.time()), "model": model}
+
+        try:
+            if not request.get("stream"):
+                time.sleep(delay)
+                message = {"role": "assistant", "content": entry["content"]}
+                if entry["reasoning"]:
+                    message["reasoning_content"] = entry["reasoning"]
+                self._send_json(200, {**base, "object": "chat.completion", "usage": usage,
+                                      "choices": [{"index": 0, "message": message, "finish_reason": "stop"}]})
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            # The delay is spread over the deltas so that a client closing the stream early saves time
+            deltas = [{"reasoning_content": c} for c in _chunks(entry["reasoning"])] + [{"content": c} for c in _chunks(entry["content"])]
+            pause = delay / max(1, len(deltas))
+            chunk_base = {**base, "object": "chat.completion.chunk"}
+            for delta in deltas:
+                time.sleep(pause)
+                self._write_chunk({**chunk_base, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]})
+            self._write_chunk({**chunk_base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            if (request.get("stream_options") or {}).get("include_usage"):
+                self._write_chunk({**chunk_base, "choices": [], "usage": usage})
+            self._write_chunk(None)
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # Streams stopped early by the client (LLM/early_stop.py) end here
+            self.close_connection = True
+
+
+def serve(corpus_path, host="127.0.0.1", port=8765, latency="sample", fixed_latency=1.0, time_scale=1.0, seed=None):
+    """Serves a harvested corpus until interrupted, then prints the serving statistics."""
+    ReplayHandler.corpus = ReplayCorpus(load_corpus(corpus_path), latency=latency, fixed_latency=fixed_latency,
+                                        time_scale=time_scale, seed=seed)
+    server = ThreadingHTTPServer((host, port), ReplayHandler)
+    server.daemon_threads = True
+    print(f"Replay server listening on http://{host}:{port}/v1 "
+          f"({ReplayHandler.corpus.size} recorded responses, latency={latency}, time_scale={time_scale})")
+    print(f"Run the pipeline with DSR_LLM_ENDPOINT_OVERRIDE=http://{host}:{port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(ReplayHandler.corpus.summary(), indent=2, ensure_ascii=False))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline OpenAI-compatible replay server built from recorded run logs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    harvest_parser = subparsers.add_parser("harvest", help="Harvest Result_* directories into a corpus")
+    harvest_parser.add_argument("result_dirs", nargs="+", help="Result directories of earlier runs")
+    harvest_parser.add_argument("--out", default="replay_corpus.jsonl", help="Output corpus path. Default: replay_corpus.jsonl")
+
+    serve_parser = subparsers.add_parser("serve", help="Serve a harvested corpus")
+    serve_parser.add_argument("corpus", help="Corpus produced by the harvest command")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8765)
+    serve_parser.add_argument("--latency", choices=LATENCY_MODES, default="sample",
+                              help="sample: draw from the recorded latencies of the prompt kind; recorded: latency of the "
+                                   "served response; fixed: --fixed_latency seconds; none: answer immediately")
+    serve_parser.add_argument("--fixed_latency", type=float, default=1.0)
+    serve_parser.add_argument("--time_scale", type=float, default=1.0, help="Multiplier applied to every latency")
+    serve_parser.add_argument("--seed", type=int, default=None)
+
+    args = parser.parse_args(argv)
+    if args.command == "harvest":
+        counts = harvest(args.result_dirs, args.out)
+        print(f"Harvested {sum(counts.values())} LLM calls into {args.out}: {counts}")
+    else:
+        serve(args.corpus, host=args.host, port=args.port, latency=args.latency,
+              fixed_latency=args.fixed_latency, time_scale=args.time_scale, seed=args.seed)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import defaultdict
+
+from LLM.client_pool import load_llm_config
+from LLM.errors import LLMError
+
+# --- Content-addressed LLM response cache ---
+# Stores the (input_tokens, output_tokens, reasoning, content) tuple returned by LLM_output in a
+# local SQLite file, keyed on a hash of (model, messages, temperature, max_tokens).
+#
+# Modes:
+#   off    - no caching (default)
+#   on     - deterministic (temperature 0) calls are read from and written to the cache
+#   record - every call is written; deterministic calls are also served from the cache
+#   replay - every call must be served from the cache; a miss raises LLMCacheMiss
+#
+# Sampled calls (temperature > 0) are keyed with their occurrence number within the process,
+# so the n-th identical sampled request of a recorded run replays the n-th recorded answer.
+#
+# An answer is stored under the model that produced it: when a failover target answered, the entry is
+# keyed on that target, and lookups walk the same failover plan, so a replay never passes a fallback
+# model's answer off as the requested model's.
+
+CACHE_MODES = ("off", "on", "record", "replay")
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "llm_cache.sqlite")
+DEFAULT_MAX_SIZE_MB = 2048
+
+class LLMCacheMiss(LLMError, KeyError):
+    """Raised in replay mode when a request has no recorded response."""
+
+
+class LLMResponseCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_size_mb=DEFAULT_MAX_SIZE_MB, mode="on"):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Invalid cache mode: '{mode}'. Supported modes: {CACHE_MODES}")
+
+        self.path = path
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._occurrences = defaultdict(int)
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # One shared connection guarded by a lock; WAL lets several runner processes share the file
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                value TEXT,
+                size INTEGER,
+                created REAL,
+                last_access REAL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @property
+    def enabled(self):
+        return self.mode != "off"
+
+    def make_key(self, model, messages, temperature, max_tokens):
+        """
+        Builds the cache key of a request. Sampled requests get their per-process occurrence number appended.
+        """
+        payload = json.dumps(
+            {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens},
+            ensure_ascii=False, sort_keys=True
+        )
+        key = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        if temperature:
+            with self._lock:
+                occurrence = self._occurrences[key]
+                self._occurrences[key] += 1
+            key = f"{key}:{occurrence}"
+        return key
+
+    def serves(self, temperature):
+        """Whether a request with this temperature may be answered from the cache."""
+        if self.mode == "replay":
+            return True
+        return self.mode in ("on", "record") and not temperature
+
+    def stores(self, temperature):
+        """Whether the response of a request with this temperature should be written to the cache."""
+        if self.mode == "record":
+            return True
+        return self.mode == "on" and not temperature
+
+    def get(self, key, raise_on_miss=True):
+        """
+        Returns the cached tuple, or None on a miss. In replay mode a miss raises LLMCacheMiss, unless
+        raise_on_miss is False (a later target of the failover plan may still have the answer).
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+                self.hits += 1
+                return tuple(json.loads(row[0]))
+            self.misses += 1
+
+        if self.mode == "replay" and raise_on_miss:
+            raise LLMCacheMiss(f"Replay mode: no cached response for request {key}.")
+        return None
+
+    def put(self, key, model, result):
+        """Stores a successful LLM_output result and evicts least recently used entries when over budget."""
+        if is_failed_result(result):
+            return
+
+        value = json.dumps(list(result), ensure_ascii=False)
+        size = len(value.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, value, size, created, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, value, size, now, now)
+            )
+            self._conn.commit()
+            self._total_bytes += size - (old[0] if old else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Re-read the real total: other processes may be writing to the same file
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        target = int(self.max_bytes * 0.9)
+        cursor = self._conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC")
+        to_delete = []
+        for key, size in cursor:
+            if self._total_bytes <= target:
+                break
+            to_delete.append((key,))
+            self._total_bytes -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+        self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "mode": self.mode,
+            "entries": entries,
+            "size_mb": round(self._total_bytes / 1024 / 1024, 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def is_failed_result(result):
+    # Failed calls raise LLMError, so only malformed results are filtered here
+    content = result[3] if len(result) > 3 else None
+    return not isinstance(content, str)
+
+
+# --- Process-wide cache instance ---
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def configure_cache(mode=None, path=None, max_size_mb=None):
+    """
+    (Re)configures the process-wide cache. Arguments that are None fall back to the "Cache"
+    entry of LLM_config.json, then to the defaults.
+
+    Returns:
+        LLMResponseCache or None: The active cache, or None when caching is off.
+    """
+    global _cache, _configured
+    try:
+        cache_config = load_llm_config().get("Cache", {})
+    except FileNotFoundError:
+        cache_config = {}
+
+    mode = mode or cache_config.get("mode", "off")
+    path = path or cache_config.get("path") or DEFAULT_CACHE_PATH
+    if not os.path.isabs(path):
+        # Relative paths are resolved against the DSR_Lite root, like the other configuration paths
+        path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), path)
+    max_size_mb = max_size_mb or cache_config.get("max_size_mb", DEFAULT_MAX_SIZE_MB)
+
+    with _cache_lock:
+        if _cache is not None:
+            _cache.close()
+            _cache = None
+        if mode != "off":
+            _cache = LLMResponseCache(path=path, max_size_mb=max_size_mb, mode=mode)
+        _configured = True
+    return _cache
+
+
+_configured = False
+_init_lock = threading.Lock()
+
+
+def get_cache():
+    """Returns the active cache (configured lazily from LLM_config.json), or None when caching is off."""
+    if not _configured:
+        with _init_lock:
+            if not _configured:
+                configure_cache()
+    return _cache
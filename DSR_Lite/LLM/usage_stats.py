@@ -0,0 +1,54 @@
+import threading
+from collections import defaultdict
+
+# --- Provider prompt-cache accounting ---
+# DeepSeek reports context-cache usage as usage.prompt_cache_hit_tokens / prompt_cache_miss_tokens,
+# OpenAI-compatible servers as usage.prompt_tokens_details.cached_tokens. Both are aggregated per model
+# so the effect of the "prefix" prompt layout (utils/Prompt.py) can be measured.
+
+_stats = defaultdict(lambda: {"calls": 0, "prompt_tokens": 0, "cache_hit_tokens": 0, "cache_miss_tokens": 0})
+_lock = threading.Lock()
+
+
+def prompt_cache_tokens(usage):
+    """
+    Returns (cache_hit_tokens, cache_miss_tokens) of a usage block, or None when the provider does not report them.
+    """
+    if usage is None:
+        return None
+    hit = getattr(usage, "prompt_cache_hit_tokens", None)
+    if hit is not None:
+        miss = getattr(usage, "prompt_cache_miss_tokens", None)
+        return hit, miss if miss is not None else max(0, (usage.prompt_tokens or 0) - hit)
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details is not None else None
+    if cached is not None:
+        return cached, max(0, (usage.prompt_tokens or 0) - cached)
+    return None
+
+
+def record_prompt_cache(model, usage):
+    """Adds the prompt-cache usage of one call. Returns (hit, miss) or None."""
+    tokens = prompt_cache_tokens(usage)
+    if tokens is None:
+        return None
+    with _lock:
+        entry = _stats[model]
+        entry["calls"] += 1
+        entry["prompt_tokens"] += usage.prompt_tokens or 0
+        entry["cache_hit_tokens"] += tokens[0]
+        entry["cache_miss_tokens"] += tokens[1]
+    return tokens
+
+
+def get_prompt_cache_stats():
+    """
+    Returns the prompt-cache usage per model, e.g.
+    {"deepseek-reasoner": {"calls": 120, "prompt_tokens": 2.1e6, "cache_hit_tokens": 1.6e6, "cache_miss_tokens": 0.5e6, "hit_rate": 0.76}}
+    """
+    with _lock:
+        stats = {model: dict(entry) for model, entry in _stats.items()}
+    for entry in stats.values():
+        total = entry["cache_hit_tokens"] + entry["cache_miss_tokens"]
+        entry["hit_rate"] = round(entry["cache_hit_tokens"] / total, 4) if total else 0.0
+    return stats
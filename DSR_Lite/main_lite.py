@@ -1,6 +1,7 @@
 import os
 import sys
 import json
+import contextvars
 import pickle
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -12,8 +13,10 @@ import argparse
 from utils.extract_json import *
 from utils.Prompt import *
 from utils.Database_Interface import *
+from utils.schema_pruning import budgeted_mschema, get_schema_pruning_stats, linked_columns
 from utils.app_logs.logger_config import setup_logger, log_context, JsonLogger
 from LLM.LLM_OUT import *
+from LLM.client_pool import ENDPOINT_OVERRIDE_ENV
 
 
 
@@ -52,9 +55,12 @@ def save_or_load_pickle(data=None, filename='data.pkl', mode='save'):
     else:
         raise ValueError("The 'mode' argument must be 'save' or 'load'")
 
+# Exploration statements run at the same time (overridden by --exploration_workers)
+EXPLORATION_WORKERS = 4
+
 #---- Schema-aware Alignment----
 
-def Fine_grained_Exploration_func(Question_id,Question, schema_json, db_name, base_mess=[], step="Exploration Stage",db_type='sqlite'):
+def Fine_grained_Exploration_func(Question_id,Question, schema_json, db_name, base_mess=[], step="Exploration Stage",db_type='sqlite',workers=None):
     log_msg(f"\n{'-'*40}【Question_id: {Question_id}】 | 【Start Stage: {step}】{'-'*40}")
 
     # Initialize fine-grained exploration module
@@ -67,7 +73,9 @@ def Fine_grained_Exploration_func(Question_id,Question, schema_json, db_name, ba
             log_msg(f"\n[Fine-grained Exploration] Attempting to call language model for the {attempt + 1} time...")
             input_token_count, output_token_count, Thinking, LLM_return = LLM_output(messages=FGE_mess,
                                         model=FGE.model,
-                                        temperature=FGE.temperature
+                                        temperature=FGE.temperature,
+                                        stop_when="json",
+                                        stage=step
                                         )
 
             logger_status.log(
@@ -83,94 +91,127 @@ def Fine_grained_Exploration_func(Question_id,Question, schema_json, db_name, ba
             log_msg(f"\n[【Question_id: {Question_id}】 | Fine-grained Exploration] LLM output content:\n{LLM_return}")
             ge_sql = extract_and_parse_json(text=LLM_return)
             break
+        except LLMCacheMiss:
+            raise  # Replay mode must fail loudly instead of retrying
+        except LLMError as e:
+            # The provider has already retried and the fallback chain is exhausted
+            log_msg(f"[【Question_id: {Question_id}】 | Fine-grained Exploration] LLM call failed, skipping exploration: {e}")
+            return []
         except Exception as e:
             log_msg(f"[【Question_id: {Question_id}】 | Fine-grained Exploration Retry {attempt + 1}/{max_retries}] Error: {e}")
     else:
         log_msg(f"[【Question_id: {Question_id}】 | Fine-grained Exploration] Parsing failed, maximum retries reached, exiting.")
         return []
 
-    query_list = []
     sql_list = list(ge_sql.values())
 
-    for idx, original_sql in enumerate(sql_list):
-        log_msg(f"\n{'='*20} [Executing Original SQL #{idx + 1}] {'='*20}")
-        log_msg(f"[【Question_id: {Question_id}】 | Original SQL Statement]:\n{original_sql}\n")
-
-        # Execute SQL
-        status, result = db_interface(db_type=db_type, query=original_sql, conn_info=db_name)
-
-        if status == 0:
-            log_msg(f"[【Question_id: {Question_id}】 | SQL Execution Successful]\nResult:\n{result}")
-            query_list.append({"role": "user", "content": original_sql})
-            query_list.append({"role": "assistant", "content": "Execution result:\n" + result})
-            continue
+    # The statements and their repair loops are independent: run them concurrently (the number of queries
+    # hitting one database at the same time is capped in db_interface) and keep the messages in their original order
+    workers = max(1, min(workers or EXPLORATION_WORKERS, len(sql_list)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Exploration") as executor:
+        futures = [executor.submit(contextvars.copy_context().run, _explore_sql, dict(vars(log_context)), Question_id, idx,
+                                   original_sql, schema_json, db_name, base_mess, step, db_type)
+                   for idx, original_sql in enumerate(sql_list)]
+        query_list = [message for future in futures for message in future.result()]
 
-        # Start repair mechanism
-        log_msg(f"\n{'-'*40}【【Question_id: {Question_id}】 | Initiating Repair Mechanism: {step} Repair Stage】{'-'*40}")
-        fix_attempts = 0
-        current_sql = original_sql
-        accumulated_prompt = f"Original SQL:\n{original_sql}\nError Message:\n{result}\n"
-        while fix_attempts < 5:
-            SF = Simple_Fix(Error_message=result, last_SQL=current_sql, Schema=schema_json,db_type=db_type)
-            fix_prompt = accumulated_prompt + "\n" + SF.Prompt
+    log_msg(f"\n{'='*40}【【Question_id: {Question_id}】 |  {step} Stage End】{'='*40}\n")
+    return query_list
 
-            sf_mess = base_mess + [{"role": "user", "content": fix_prompt}]
-            log_msg(f"fix prompt: {sf_mess}")
-            log_msg(f"\n[【Question_id: {Question_id}】 | Repair Attempt #{fix_attempts + 1}] Calling language model to fix SQL...")
+def _explore_sql(log_fields, Question_id, idx, original_sql, schema_json, db_name, base_mess, step, db_type):
+    """
+    Executes one exploration statement, repairing it up to 5 times on failure.
+    Returns:
+        list: The user / assistant messages of the statement that succeeded (empty when it could not be repaired).
+    """
+    # log_context is thread-local: give the worker thread the question id of the instance
+    for attr, value in log_fields.items():
+        setattr(log_context, attr, value)
+    query_list = []
+    log_msg(f"\n{'='*20} [Executing Original SQL #{idx + 1}] {'='*20}")
+    log_msg(f"[【Question_id: {Question_id}】 | Original SQL Statement]:\n{original_sql}\n")
+
+    # Execute SQL
+    status, result = db_interface(db_type=db_type, query=original_sql, conn_info=db_name, capture=True)
+
+    if status == 0:
+        log_msg(f"[【Question_id: {Question_id}】 | SQL Execution Successful]\nResult:\n{result}")
+        query_list.append({"role": "user", "content": original_sql})
+        query_list.append({"role": "assistant", "content": "Execution result:\n" + result})
+        return query_list
+
+    # Start repair mechanism
+    log_msg(f"\n{'-'*40}【【Question_id: {Question_id}】 | Initiating Repair Mechanism: {step} Repair Stage】{'-'*40}")
+    fix_attempts = 0
+    current_sql = original_sql
+    accumulated_prompt = f"Original SQL:\n{original_sql}\nError Message:\n{result}\n"
+    while fix_attempts < 5:
+        SF = Simple_Fix(Error_message=result, last_SQL=current_sql, Schema=schema_json,db_type=db_type)
+        fix_prompt = accumulated_prompt + "\n" + SF.Prompt
+
+        sf_mess = base_mess + [{"role": "user", "content": fix_prompt}]
+        log_msg(f"fix prompt: {sf_mess}")
+        log_msg(f"\n[【Question_id: {Question_id}】 | Repair Attempt #{fix_attempts + 1}] Calling language model to fix SQL...")
 
+        try:
             input_token_count, output_token_count, Thinking, LLM_return = LLM_output(messages=sf_mess,
                                         temperature=SF.temperature,
-                                        model=SF.model
+                                        model=SF.model,
+                                        stop_when="json",
+                                        stage=f"{step} Repair Stage"
                                         )
-            fix_statu = {"triggering_error": result}
+        except LLMCacheMiss:
+            raise
+        except LLMError as e:
+            log_msg(f"[【Question_id: {Question_id}】 | Repair Attempt #{fix_attempts + 1}] LLM call failed, skipping current SQL: {e}")
+            break
+        fix_statu = {"triggering_error": result}
 
-            logger_status.log(
-                question_id=Question_id,
-                step=f"{step} Repair Stage",
-                if_in_fix="YES",
-                input_token_count=input_token_count,
-                output_token_count=output_token_count,
-                status=fix_statu
-            )
-            
-            log_msg(f"[【Question_id: {Question_id}】 |  Repair Stage LLM Thinking]:\n{Thinking}")
-            log_msg(f"[【Question_id: {Question_id}】 |  Repair Stage LLM Output]:\n{LLM_return}")
-
-            try:
-                fixed_sql_dict = extract_and_parse_json(LLM_return)
-                fixed_sql = list(fixed_sql_dict.values())[0]
-                log_msg(f"[【Question_id: {Question_id}】 |  Parsed Fixed SQL]:\n{fixed_sql}")
-            except Exception as e:
-                log_msg(f"[【Question_id: {Question_id}】 |  SQL Repair Parsing Error] Parsing failed for the {fix_attempts + 1} time: {e}")
-                fix_attempts += 1
-                continue
-
-            # Execute the fixed SQL
-            status, result = db_interface(db_type=db_type, query=fixed_sql, conn_info=db_name)
-
-            if status == 0:
-                log_msg(f"[【Question_id: {Question_id}】 |  Repair Successful] Execution Result:\n{result}")
-                query_list.append({"role": "user", "content": fixed_sql})
-                query_list.append({"role": "assistant", "content": "Execution result:\n" + result})
-                break
-            else:
-                log_msg(f"[【Question_id: {Question_id}】 |  Repair Failed] Failed for the {fix_attempts + 1} time, error message:\n{result}")
-                accumulated_prompt += f"\nFixed SQL attempt {fix_attempts + 1}:\n{fixed_sql}\nError Message:\n{result}\n"
-                current_sql = fixed_sql
-                fix_attempts += 1
+        logger_status.log(
+            question_id=Question_id,
+            step=f"{step} Repair Stage",
+            if_in_fix="YES",
+            input_token_count=input_token_count,
+            output_token_count=output_token_count,
+            status=fix_statu
+        )
+    
+        log_msg(f"[【Question_id: {Question_id}】 |  Repair Stage LLM Thinking]:\n{Thinking}")
+        log_msg(f"[【Question_id: {Question_id}】 |  Repair Stage LLM Output]:\n{LLM_return}")
 
-        if fix_attempts == 5:
-            log_msg(f"\n[【Question_id: {Question_id}】 |  Maximum Repair Attempts Exceeded] Skipping current SQL.\nOriginal SQL:\n{original_sql}")
+        try:
+            fixed_sql_dict = extract_and_parse_json(LLM_return)
+            fixed_sql = list(fixed_sql_dict.values())[0]
+            log_msg(f"[【Question_id: {Question_id}】 |  Parsed Fixed SQL]:\n{fixed_sql}")
+        except Exception as e:
+            log_msg(f"[【Question_id: {Question_id}】 |  SQL Repair Parsing Error] Parsing failed for the {fix_attempts + 1} time: {e}")
+            fix_attempts += 1
+            continue
+
+        # Execute the fixed SQL
+        status, result = db_interface(db_type=db_type, query=fixed_sql, conn_info=db_name, capture=True)
+
+        if status == 0:
+            log_msg(f"[【Question_id: {Question_id}】 |  Repair Successful] Execution Result:\n{result}")
+            query_list.append({"role": "user", "content": fixed_sql})
+            query_list.append({"role": "assistant", "content": "Execution result:\n" + result})
+            break
+        else:
+            log_msg(f"[【Question_id: {Question_id}】 |  Repair Failed] Failed for the {fix_attempts + 1} time, error message:\n{result}")
+            accumulated_prompt += f"\nFixed SQL attempt {fix_attempts + 1}:\n{fixed_sql}\nError Message:\n{result}\n"
+            current_sql = fixed_sql
+            fix_attempts += 1
+
+    if fix_attempts == 5:
+        log_msg(f"\n[【Question_id: {Question_id}】 |  Maximum Repair Attempts Exceeded] Skipping current SQL.\nOriginal SQL:\n{original_sql}")
 
-    log_msg(f"\n{'='*40}【【Question_id: {Question_id}】 |  {step} Stage End】{'='*40}\n")
     return query_list
 
-def Information_Summary(Question_id,Question, schema_json, DB_Exploration, step="Summarization Stage"):
+def Information_Summary(Question_id,Question, schema_json, DB_Exploration, base_mess=[], step="Summarization Stage"):
     log_msg(f"\n{'-'*40}【Question_id: {Question_id}】 |  Start Stage: {step}】{'-'*40}")
     db_exploration_str = "\n".join(str(d["content"]) for d in DB_Exploration) # Build into a string
 
     IA = Information_Aggregation(Question=Question, schema_json=schema_json, DB_Exploration=db_exploration_str)
-    IA_mess = [{"role": "user", "content": IA.Prompt}]
+    IA_mess = base_mess + [{"role": "user", "content": IA.Prompt}]
     log_msg(f"【Question_id: {Question_id}】 |  LLM Input: {IA_mess}")
     max_attempts = 3
     for attempt in range(max_attempts):
@@ -179,7 +220,9 @@ def Information_Summary(Question_id,Question, schema_json, DB_Exploration, step=
         input_token_count, output_token_count, Thinking, LLM_return = LLM_output(
             messages=IA_mess,
             model=IA.model,
-            temperature=IA.temperature
+            temperature=IA.temperature,
+            stop_when="answer",
+            stage=step
         )
 
         logger_status.log(
@@ -228,7 +271,9 @@ def GenerateSQL1(Question_id,Question, schema_json, db_name,Information_Agg, bas
             input_token_count, output_token_count, Thinking, LLM_return = LLM_output(
                 messages=GSB_mess,
                 model=GSB.model,
-                temperature=GSB.temperature
+                temperature=GSB.temperature,
+                stop_when="json",
+                stage=step
             )
             log_msg(f"[【Question_id: {Question_id}】 |  Language Model Thinking]:\n{Thinking}")
             log_msg(f"[【Question_id: {Question_id}】 |  Language Model Output]:\n{LLM_return}")
@@ -252,7 +297,7 @@ def GenerateSQL1(Question_id,Question, schema_json, db_name,Information_Agg, bas
                 # Modified: Use statu["sql"] directly instead of raw_sql
                 flag,current_subsql = SQL_completion(statu["sql"], db_type)
                 log_msg(f"【Question_id: {Question_id}】 |  \n✅ SQL structure is valid, starting SQL execution:\n{current_subsql}")
-                status, result = db_interface(db_type=db_type, query=current_subsql, conn_info=db_name)
+                status, result = db_interface(db_type=db_type, query=current_subsql, conn_info=db_name, capture=True, inject_limit=False)
 
                 if status == 0:
                     log_msg(f"[【Question_id: {Question_id}】 |  SQL Execution Successful]\nResult:\n{result}")
@@ -289,7 +334,9 @@ def GenerateSQL1(Question_id,Question, schema_json, db_name,Information_Agg, bas
                             input_token_count, output_token_count, Thinking, fix_return = LLM_output(
                                 messages=fix_mess,
                                 model=GSB.model,
-                                temperature=GSB.temperature
+                                temperature=GSB.temperature,
+                                stop_when="json",
+                                stage=f"{step} Repair"
                             )
                             log_msg(f"[【Question_id: {Question_id}】 |  Repair LLM Thinking]:\n{Thinking}")
                             log_msg(f"[【Question_id: {Question_id}】 |  Repair LLM Output]:\n{fix_return}")
@@ -313,7 +360,7 @@ def GenerateSQL1(Question_id,Question, schema_json, db_name,Information_Agg, bas
                                 # Modified: Use fix_statu["sql"] directly
                                 flag,current_subsql = SQL_completion(fix_statu["sql"], db_type)
                                 log_msg(f"[【Question_id: {Question_id}】 |  Attempting to execute repaired SQL]:\n{current_subsql}")
-                                status, result = db_interface(db_type=db_type, query=current_subsql, conn_info=db_name)
+                                status, result = db_interface(db_type=db_type, query=current_subsql, conn_info=db_name, capture=True, inject_limit=False)
 
                                 if status == 0:
                                     log_msg(f"[【Question_id: {Question_id}】 |  Repaired SQL Execution Successful]\nResult:\n{result}")
@@ -339,6 +386,11 @@ def GenerateSQL1(Question_id,Question, schema_json, db_name,Information_Agg, bas
                             else:
                                 log_msg(f"【Question_id: {Question_id}】 |  ❌ Repair attempt {fix_attempt + 1} returned incorrect format: actual keys are {set(fix_statu.keys())}")
 
+                        except LLMCacheMiss:
+                            raise
+                        except LLMError as e:
+                            log_msg(f"【Question_id: {Question_id}】 |  ❌ Repair LLM call failed, abandoning {step}: {e}")
+                            return False
                         except Exception as e:
                             log_msg(f"【Question_id: {Question_id}】 |  ❌ Repair attempt {fix_attempt + 1} parsing failed: {e}")
 
@@ -347,12 +399,21 @@ def GenerateSQL1(Question_id,Question, schema_json, db_name,Information_Agg, bas
             else:
                 log_msg(f"【Question_id: {Question_id}】 |  ❌ Initial return format error (attempt {attempt + 1}): actual keys are {set(statu.keys())}")
 
+        except LLMCacheMiss:
+            raise
+        except LLMError as e:
+            log_msg(f"【Question_id: {Question_id}】 |  ❌ Generation LLM call failed, abandoning {step}: {e}")
+            return False
         except Exception as e:
             log_msg(f"【Question_id: {Question_id}】 |  ❌ Initial parsing failed (attempt {attempt + 1}): {e}")
 
     log_msg(f"【Question_id: {Question_id}】 |  \n❌ {step} stage failed, maximum retries exceeded ({max_retries})")
     return False
 
+def is_final_answer(statu):
+    """Whether a SQL Continuation step ends the continuation loop of GenerateSQL, i.e. its SQL is the final answer."""
+    return bool(statu.get("result_acceptable")) and str(statu.get("current_state", "")).lower() == "rephrase"
+
 def GenerateSQL2(Question_id,Question, schema_json, db_name,Information_Agg, base_mess=[], db_type="sqlite", step="SQL Continuation Stage"):
     expected_keys = {
         "result_acceptable",
@@ -375,7 +436,9 @@ def GenerateSQL2(Question_id,Question, schema_json, db_name,Information_Agg, bas
             input_token_count, output_token_count, Thinking, LLM_return = LLM_output(
                 messages=CSW_mess,
                 model=CSW.model,
-                temperature=CSW.temperature
+                temperature=CSW.temperature,
+                stop_when="json",
+                stage=step
             )
             log_msg(f"[【Question_id: {Question_id}】 |  Language Model Thinking]:\n{Thinking}")
             log_msg(f"[【Question_id: {Question_id}】 |  Language Model Output]:\n{LLM_return}")
@@ -399,7 +462,8 @@ def GenerateSQL2(Question_id,Question, schema_json, db_name,Information_Agg, bas
                 # Modified: Use statu["sql"] directly
                 flag,current_subsql = SQL_completion(statu["sql"], db_type)
                 log_msg(f"【Question_id: {Question_id}】 |  \n✅ SQL structure is valid, starting SQL execution:\n{current_subsql}")
-                status, result = db_interface(db_type=db_type, query=current_subsql, conn_info=db_name)
+                # The SQL that ends the continuation loop is the final answer and is verified on the live database
+                status, result = db_interface(db_type=db_type, query=current_subsql, conn_info=db_name, capture=True, inject_limit=False, use_cache=not is_final_answer(statu))
 
                 if status == 0:
                     if flag==1:
@@ -433,7 +497,9 @@ def GenerateSQL2(Question_id,Question, schema_json, db_name,Information_Agg, bas
                             input_token_count, output_token_count, Thinking, fix_return = LLM_output(
                                 messages=fix_mess,
                                 model=CSW.model,
-                                temperature=CSW.temperature
+                                temperature=CSW.temperature,
+                                stop_when="json",
+                                stage=f"{step} Repair"
                             )
                             log_msg(f"[【Question_id: {Question_id}】 |  Repair LLM Thinking]:\n{Thinking}")
                             log_msg(f"[【Question_id: {Question_id}】 |  Repair LLM Output]:\n{fix_return}")
@@ -455,7 +521,7 @@ def GenerateSQL2(Question_id,Question, schema_json, db_name,Information_Agg, bas
                             if set(fix_statu.keys()) == expected_keys and fix_statu["current_state"].lower() in {"extend", "revise", "rephrase","explore"}:
                                 flag,current_subsql = SQL_completion(fix_statu["sql"], db_type)
                                 log_msg(f"[【Question_id: {Question_id}】 |  Attempting to execute repaired SQL]:\n{current_subsql}")
-                                status, result = db_interface(db_type=db_type, query=current_subsql, conn_info=db_name)
+                                status, result = db_interface(db_type=db_type, query=current_subsql, conn_info=db_name, capture=True, inject_limit=False, use_cache=not is_final_answer(fix_statu))
 
                                 if status == 0:
                                     log_msg(f"[【Question_id: {Question_id}】 |  Repaired SQL Execution Successful]\nResult:\n{result}")
@@ -480,6 +546,11 @@ def GenerateSQL2(Question_id,Question, schema_json, db_name,Information_Agg, bas
                             else:
                                 log_msg(f"【Question_id: {Question_id}】 |  ❌ Repair attempt {fix_attempt + 1} returned incorrect format: actual keys are {set(fix_statu.keys())}")
 
+                        except LLMCacheMiss:
+                            raise
+                        except LLMError as e:
+                            log_msg(f"【Question_id: {Question_id}】 |  ❌ Repair LLM call failed, abandoning {step}: {e}")
+                            return False
                         except Exception as e:
                             log_msg(f"【Question_id: {Question_id}】 |  ❌ Repair attempt {fix_attempt + 1} parsing failed: {e}")
 
@@ -488,6 +559,11 @@ def GenerateSQL2(Question_id,Question, schema_json, db_name,Information_Agg, bas
             else:
                 log_msg(f"【Question_id: {Question_id}】 |  ❌ Initial return format error (attempt {attempt + 1}): actual keys are {set(statu.keys())}")
 
+        except LLMCacheMiss:
+            raise
+        except LLMError as e:
+            log_msg(f"【Question_id: {Question_id}】 |  ❌ Generation LLM call failed, abandoning {step}: {e}")
+            return False
         except Exception as e:
             log_msg(f"【Question_id: {Question_id}】 |  ❌ Initial parsing failed (attempt {attempt + 1}): {e}")
 
@@ -579,7 +655,7 @@ def GenerateSQL(Question_id, Question, Col, schema_json, db_name,Information_Agg
             final_status = statu
             log_msg(f"【Question_id: {Question_id}】 |  ✅ Stage Two iteration successful. Current SQL:\n{latest_sql}")
 
-            if statu.get("result_acceptable") and statu.get("current_state", "").lower() == "rephrase":
+            if is_final_answer(statu):
                 log_msg(f"【Question_id: {Question_id}】 |  ✅ Stage Two termination condition met (state='rephrase'). Saving progress to {pkl_filename}.")
                 save_or_load_pickle(data={
                     "initial_base_mess": initial_base_mess,
@@ -608,8 +684,8 @@ def workflow(Question_id, Question, schema_json, db_name,db_type="sqlite"):
     base_pickle_filename = f"{Question_id}_DS.pkl"
     infor_ag_filename=f"{Question_id}_IA_DS.pkl"
     
-    # Initial System Prompt
-    base_messages = []
+    # Initial System Prompt ("prefix" layout: shared schema/question context reused by every stage, see utils/Prompt.py)
+    base_messages = shared_context_messages(Question, schema_json, db_type) if get_prompt_layout() == "prefix" else []
 
     # [Stage] Database Exploration
     log_msg("\n--- Starting Stage: Database Exploration ---")
@@ -631,7 +707,7 @@ def workflow(Question_id, Question, schema_json, db_name,db_type="sqlite"):
         log_msg(f"✅ Cached Information Aggregation loaded, skipping stage: {infor_ag_filename}")
     except FileNotFoundError:
         log_msg(f"⚠️ Cache not found, executing live information aggregation and saving to: {infor_ag_filename}")
-        infor_ag = Information_Summary(Question_id=Question_id,Question=Question,schema_json=schema_json,DB_Exploration=query_list_2)
+        infor_ag = Information_Summary(Question_id=Question_id,Question=Question,schema_json=schema_json,DB_Exploration=query_list_2,base_mess=base_messages)
         save_or_load_pickle(data=infor_ag, filename=infor_ag_filename, mode='save')
         log_msg("✅ Information Aggregation results saved.")
         
@@ -668,6 +744,8 @@ def process_entry(entry,MAX_MSchema_TOKEN):
     # --- Set log context (helps identify the source of log messages) ---
     log_context.question_id = question_id
     log_context.db_id = db_id
+    # Tags the LLM calls of this instance in the token ledger (LLM/ledger.py)
+    set_ledger_context(instance=question_id, db=db_id)
 
     try:
         log_msg(f"🚀 Starting task: instance_id={question_id}, db_id={db_id}")
@@ -684,12 +762,15 @@ def process_entry(entry,MAX_MSchema_TOKEN):
             user_input = f"[Question]\n{question}\n"
 
         log_msg("📨 Input constructed, invoking workflow...")
-        ## When the context exceeds a certain limit, use DDL statements directly.
-        # TODO: A hierarchical pruning approach can be adopted to maximize the score: https://github.com/Snowflake-Labs/ReFoRCE/blob/o3/methods/ReFoRCE/reconstruct_data.py
-        if get_token_count(M_Schema(SL=SL, db_id=db_id, db_type=db_type))>MAX_MSchema_TOKEN:
-            schema_json=generate_ddl_from_json(db_id=db_id,table_list=SL,db_type=db_type)
-        else:
-            schema_json=M_Schema(SL=SL, db_id=db_id, db_type=db_type)
+        ## When the context exceeds the limit, the M-Schema is pruned step by step (examples, descriptions,
+        ## columns not relevant to the question, table series) until it fits, see utils/schema_pruning.py
+        schema_json, pruning = budgeted_mschema(db_id=db_id, SL=SL, db_type=db_type, budget=MAX_MSchema_TOKEN,
+                                                relevant_columns=linked_columns(entry.get("col"), entry.get("sample_history")),
+                                                question=f"{question}\n{evidence}")
+        if pruning["removed"]:
+            log_msg(f"✂️ Schema pruned to {pruning['tokens']} tokens (budget {MAX_MSchema_TOKEN}): {pruning['removed']}")
+        if not pruning["within_budget"]:
+            log_msg(f"⚠️ Schema still has {pruning['tokens']} tokens after pruning (budget {MAX_MSchema_TOKEN}).")
         # Execute core logic (SQL inference)
         Pre_SQL, step_counter = workflow(
             Question_id=question_id,
@@ -708,18 +789,23 @@ def process_entry(entry,MAX_MSchema_TOKEN):
 
         end_time= time.time()
         time_cost = end_time - init_time
+        usage = get_ledger_totals(**get_ledger_context())
 
         logger_status.log(
                 question_id=question_id,
                 step="Time Cost",
                 if_in_fix="NO",
-                input_token_count=init_time,
-                output_token_count=end_time,
-                status=time_cost  
+                input_token_count=usage["prompt_tokens"],
+                output_token_count=usage["completion_tokens"],
+                status={"start_time": init_time, "end_time": end_time, "time_cost": time_cost,
+                        "llm_calls": usage["calls"], "reasoning_tokens": usage["reasoning_tokens"],
+                        "cached_tokens": usage["cached_tokens"], "cost": usage["cost"]}
             )
 
         return entry
 
+    except LLMCacheMiss:
+        raise
     except Exception as e:
         logger.error(f"❌ Exception occurred while processing task {question_id}: {e}", exc_info=True)
         return None
@@ -729,6 +815,7 @@ def process_entry(entry,MAX_MSchema_TOKEN):
         for attr in ['question_id', 'db_id']:
             if hasattr(log_context, attr):
                 delattr(log_context, attr)
+        set_ledger_context(instance=None, db=None)
 
 def save_result_safely(result, output_path):
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
@@ -785,8 +872,72 @@ if __name__ == "__main__":
         help="Enable multi-path execution (Run 1-5 times). Default is 1 time."
     )
 
+    # LLM response cache (Optional, defaults to the "Cache" entry of LLM/LLM_config.json)
+    parser.add_argument(
+        "--llm_cache",
+        type=str,
+        choices=["off", "on", "record", "replay"],
+        default=None,
+        help="LLM response cache mode. 'record' stores every call, 'replay' re-executes a recorded run offline."
+    )
+
+    # Database result cache (Optional, defaults to the "Result_cache" item of utils/DBsetup/DB.json)
+    parser.add_argument(
+        "--db_cache",
+        type=str,
+        choices=["off", "on"],
+        default=None,
+        help="Reuse the stored result of a query that was already executed on the same database."
+    )
+
+    # Pre-execution validation (Optional, defaults to the "Validation" item of utils/DBsetup/DB.json: SQLite only)
+    parser.add_argument(
+        "--validate",
+        type=str,
+        nargs="+",
+        choices=["sqlite", "snow", "bigquery"],
+        default=None,
+        help="Database types whose SELECTs are compiled (EXPLAIN / dry run) before they are executed."
+    )
+
+    # Concurrent fine-grained exploration (Optional, defaults to 4 statements at a time)
+    parser.add_argument(
+        "--exploration_workers",
+        type=int,
+        default=EXPLORATION_WORKERS,
+        help="Exploration statements (and their repair loops) run at the same time. 1 runs them one after another."
+    )
+
+    # Hedged LLM requests (Optional, defaults to the "Hedging" entry of LLM/LLM_config.json)
+    parser.add_argument(
+        "--llm_hedging",
+        action="store_true",
+        help="Send a duplicate request when a reasoning call runs past its latency percentile, and use the first answer."
+    )
+
+    # Prompt layout (Optional): "prefix" shares a byte-identical schema/question prefix across stages for provider-side context caching
+    parser.add_argument(
+        "--prompt_layout",
+        type=str,
+        choices=["inline", "prefix"],
+        default="inline",
+        help="'inline' embeds the schema in every stage prompt; 'prefix' sends it once as a shared system message."
+    )
+
     args = parser.parse_args()
 
+    if args.llm_cache:
+        configure_cache(mode=args.llm_cache)
+    if args.db_cache:
+        configure_result_cache(enabled=args.db_cache == "on")
+    if args.validate:
+        configure_validation(args.validate)
+    if args.llm_hedging:
+        configure_hedging(enabled=True)
+    set_prompt_layout(args.prompt_layout)
+    # Sandbox workers are started now, while the process has no worker threads yet
+    start_sqlite_workers()
+
     # --- 2. Configuration & Path Management ---
     
     # ROOT_DIR: Automatically set to the directory containing this script
@@ -805,6 +956,7 @@ if __name__ == "__main__":
     # Execution Flags
     IF_MULTI_PATH = args.multi_path
     MAX_MSCHEMA_TOKEN = 55535
+    EXPLORATION_WORKERS = args.exploration_workers
     WAIT_MINUTES_BEFORE_EXIT = 0
     
     # Database IDs to exclude
@@ -814,6 +966,9 @@ if __name__ == "__main__":
     if not WORK_DIR.exists():
         os.makedirs(WORK_DIR, exist_ok=True)
 
+    # Every LLM call of the run is appended to the token ledger
+    configure_ledger(path=str(WORK_DIR / "log" / "llm_ledger.jsonl"))
+
     # --- 3. Get Task List ---
     # Note: get_instance_ids must be defined in your imports
     all_list = [
@@ -824,6 +979,8 @@ if __name__ == "__main__":
     # --- 4. Main Loop ---
     # Determine loop range based on IF_MULTI_PATH
     run_range = range(1, 6) if IF_MULTI_PATH else range(1, 2)
+    run_start = time.time()
+    processed_count = 0
 
     for sql_item in all_list:
         for run_id in run_range:
@@ -900,15 +1057,72 @@ if __name__ == "__main__":
                 waited_once = False
                 
                 # Execute processing
+                set_ledger_context(run=run_key)
                 for entry in entries_to_process:
                     question_id = entry['instance_id']
                     try:
                         # process_entry must be defined
                         result = process_entry(entry, MAX_MSCHEMA_TOKEN)
+                        processed_count += 1
                         
                         if result:
                             save_result_safely(result, output_path_str)
                         else:
                             log_msg(f"[{question_id}] ⚠️ Null result returned.")
+                    except LLMCacheMiss:
+                        raise
                     except Exception as e:
                         log_msg(f"[{question_id}] ❌ Exception: {e}")
+
+    # --- 5. Summary ---
+    elapsed = time.time() - run_start
+    if processed_count:
+        print(f"Processed {processed_count} questions in {elapsed:.1f}s ({processed_count / elapsed * 3600:.2f} questions/hour)")
+    if os.environ.get(ENDPOINT_OVERRIDE_ENV):
+        # Compare with the injected latency reported by the replay server's /stats to get the per-stage overhead
+        print(f"LLM latency per stage: {get_hedging_stats()['latency']}")
+    llm_cache = get_cache()
+    if llm_cache is not None:
+        print(f"LLM response cache: {llm_cache.stats()}")
+    limiter_stats = get_limiter_stats()
+    if limiter_stats:
+        print(f"LLM rate limiter: {limiter_stats}")
+    early_stop_stats = get_early_stop_stats()
+    if early_stop_stats["streams"]:
+        print(f"LLM streaming early stop: {early_stop_stats}")
+    hedging_stats = get_hedging_stats()
+    if hedging_stats["hedges_fired"] or hedging_stats["skipped_budget"]:
+        print(f"LLM hedged requests: {hedging_stats}")
+    breaker_stats = get_breaker_stats()
+    if any(b["trips"] or b["rejected"] for b in breaker_stats.values()):
+        print(f"LLM circuit breakers: {breaker_stats}")
+    prompt_cache_stats = get_prompt_cache_stats()
+    if prompt_cache_stats:
+        print(f"Provider prompt cache: {prompt_cache_stats}")
+    db_cache = get_result_cache()
+    if db_cache is not None:
+        print(f"Database result cache: {db_cache.stats()}")
+    schema_pruning_stats = get_schema_pruning_stats()
+    if schema_pruning_stats:
+        print(f"Schema pruning: {schema_pruning_stats}")
+    schema_catalog_stats = get_schema_catalog_stats()
+    if schema_catalog_stats:
+        print(f"Schema catalog: {schema_catalog_stats}")
+    sqlite_pool_stats = get_sqlite_pool_stats()
+    if sqlite_pool_stats:
+        print(f"SQLite connection pools: {sqlite_pool_stats}")
+    sqlite_sandbox_stats = get_sqlite_sandbox_stats()
+    if sqlite_sandbox_stats:
+        print(f"SQLite sandbox workers: {sqlite_sandbox_stats}")
+    snowflake_pool_stats = get_snowflake_pool_stats()
+    if snowflake_pool_stats:
+        print(f"Snowflake session pools: {snowflake_pool_stats}")
+    bigquery_stats = get_bigquery_stats()
+    if bigquery_stats["queries"] or bigquery_stats["dry_runs"]:
+        print(f"BigQuery jobs: {bigquery_stats}")
+    validation_stats = get_validation_stats()
+    if validation_stats:
+        print(f"Query compile / execute latency: {validation_stats}")
+    ledger_summary = get_ledger_summary(by="stage")
+    if ledger_summary:
+        print(f"LLM token ledger per stage: {ledger_summary}")
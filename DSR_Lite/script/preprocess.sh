@@ -24,4 +24,12 @@ python -m utils.preprocessor.Get_table_mes_snow \
   --model "$MODEL_NAME" \
   --workers "$WORKERS"
 
+echo "Compiling schema stores..."
+# 4. Binary schema stores read by the schema catalog
+python -m utils.schema_store
+
+echo "Counting schema tokens..."
+# 5. Token cost sidecars of schema files written before the preprocessors produced them
+python -m utils.schema_tokens
+
 echo "All tasks completed."
\ No newline at end of file
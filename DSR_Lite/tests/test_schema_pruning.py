@@ -0,0 +1,42 @@
+from utils.schema_format import layout_table, render_mschema
+from utils.schema_pruning import _Pruner, DEFAULT_PRUNING_OPTIONS
+from utils.schema_tokens import compute_token_costs
+
+# One token per character and two per newline: counts add up exactly, so the estimate must equal the count
+# of the rendered text
+exact_count = lambda text: len(text) + text.count("\n")
+count = lambda texts: [exact_count(text) for text in texts]
+
+DB_ID = "DB1"
+SCHEMA = {"PUBLIC": {**{f"PUBLIC.T{t}": [[f"COL{c}", "NUMBER", f"column {c}" if c % 2 else "", f"examples: {c}, {c + 1}"]
+                                        for c in range(8)] for t in range(10)},
+                     "table_description_summary": {"PUBLIC.T0": "First table"}}}
+
+
+def snow_layout():
+    tables = [layout_table("snow", f"{DB_ID}.{key}", columns, SCHEMA["PUBLIC"]["table_description_summary"].get(key),
+                           key=key, top="PUBLIC")
+              for key, columns in SCHEMA["PUBLIC"].items() if isinstance(columns, list)]
+    return {"db_type": "snow", "header": [f"【DB_ID】 {DB_ID}"], "foreign_keys": [], "tables": tables}
+
+
+def test_estimate_matches_rendered_schema():
+    layout = snow_layout()
+    expected = exact_count(render_mschema(layout))
+    costs = compute_token_costs("snow", DB_ID, SCHEMA, count=count)["PUBLIC"]
+
+    without_sidecar = _Pruner(layout, None, DEFAULT_PRUNING_OPTIONS, count)
+    with_sidecar = _Pruner(layout, None, DEFAULT_PRUNING_OPTIONS, count, lambda key, top: costs[key])
+
+    assert without_sidecar.precomputed_tables == 0
+    assert with_sidecar.precomputed_tables == len(layout["tables"])
+    assert without_sidecar.estimate == expected
+    assert with_sidecar.estimate == expected
+
+
+def test_estimate_matches_rendered_schema_after_series():
+    layout = snow_layout()
+    pruner = _Pruner(layout, None, {**DEFAULT_PRUNING_OPTIONS, "stages": ["series"]}, count)
+    for _ in pruner.actions():
+        assert pruner.estimate == exact_count(pruner.render())
+    assert pruner.removed == {"series": len(layout["tables"]) - 1}
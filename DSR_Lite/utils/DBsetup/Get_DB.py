@@ -69,6 +69,21 @@ def read_db_config():
     
     return sqlite_path, snow_path, bigquery_path, snow_auth, bigquery_auth
 
+def read_db_options(db_type):
+    """
+    Returns the "Options" entry of a database item in DB.json (e.g. db_type="sqlite"), or {} when it has none.
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    json_path = os.path.join(current_dir, "DB.json")
+
+    with open(json_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    for item in data:
+        if item.get("DB_type", "").lower() == db_type.lower():
+            return item.get("Options", {})
+    return {}
+
 # Usage example
 if __name__ == "__main__":
     sqlite, snow, bigquery, snow_auth, bigquery_auth = read_db_config()
@@ -4,36 +4,39 @@ import sys
 import time
 import json
 import sqlite3
+import threading
 from typing import List, Optional
 import multiprocessing
 from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
-import pandas as pd
 from func_timeout import func_timeout, FunctionTimedOut
 
 # Snowflake
-import snowflake.connector
-from snowflake.connector.errors import DatabaseError, ProgrammingError
+from snowflake.connector.errors import DatabaseError, ProgrammingError, OperationalError, InterfaceError
 
 # BigQuery
-from google.oauth2 import service_account
 from google.cloud import bigquery
 
 # Local imports
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from utils.mytoken.deepseek_tokenizer import *
-from LLM.LLM_OUT import LLM_output
+from LLM.LLM_OUT import LLM_output, LLMCacheMiss, LLMError
 from utils.Prompt import TOOL_LLM
 from utils.DBsetup.Get_DB import read_db_config
+from utils.sqlite_pool import get_sqlite_pool, get_sqlite_pool_stats, get_sqlite_options, open_readonly_connection
+from utils.sqlite_sandbox import get_sqlite_sandbox, start_sqlite_sandbox, get_sqlite_sandbox_stats, worker_context
+from utils.snowflake_pool import get_snowflake_pool, get_snowflake_pool_stats, get_snowflake_options, wait_for_query
+from utils.bigquery_client import get_bigquery_client, get_bigquery_options, get_bigquery_stats, check_query_cost, max_bytes_billed, record_job
+from utils.result_renderer import render_table
+from utils.result_capture import get_capture_options, capture_rows, capture_footer, inject_limit as _inject_limit
+from utils.db_result_cache import get_result_cache, configure_result_cache
+from utils.schema_catalog import get_schema_catalog, get_schema_catalog_stats
+from utils.schema_format import clean_table_name, layout_table, render_mschema, snow_table_ddl, bigquery_table_ddl
+from utils.query_validation import validation_enabled, configure_validation, explain_statement, timed_phase, take_phase_stats, merge_phase_stats, get_validation_stats
 
 # Import database information
 sqlite_DB_dir, snow_DB_dir, bigquery_DB_dir, snow_auth, Credentials_Path = read_db_config()
 default_credentials = json.load(open(snow_auth, 'r')) if snow_auth and os.path.exists(snow_auth) else {}
 
-# Set maximum display rows to 20
-pd.set_option('display.max_rows', 20)
-# Set maximum display columns to 10
-pd.set_option('display.max_columns', 10)
-
 SQL_prompt='''
 You are an agent specialized in completing repetitive code. Your job is to:
 
@@ -74,265 +77,339 @@ def extract_sql_block(text):
         return match.group(1).strip()
     return None
 
-def clean_table_name(table_name):
-    table_name = str(table_name)
-    table_name = table_name.replace('"', '')
-    table_name = re.sub(r'\d+', '', table_name)
-    table_name = table_name.lower()
-    return table_name
-
-def _execute_snowflake_query_inner(query, credentials, fetch_results=True, timeout=200):
+def _execute_snowflake_query_inner(query, pool, session, fetch_results=True, timeout=200, max_rows=None, limited=False, validate=False):
     """
-    Internal execution function: runs in a separate process.
+    Runs a query asynchronously on a pooled session and formats its result.
+    A query still running after `timeout` seconds is cancelled on the server.
+    With validate, the query is compiled with EXPLAIN first and compile errors are raised without running it.
     """
-    conn = None
-    cursor = None
+    cursor = session.cursor()
     try:
-        # Establish an independent connection within the child process
-        conn = snowflake.connector.connect(
-            user=credentials["user"],
-            password=credentials["password"],
-            account=credentials["account"],
-            role=credentials["role"],
-            warehouse=credentials["warehouse"],
-        )
-        cursor = conn.cursor()
-        
-        start_time = time.time()
-        cursor.execute(query)
+        explain = explain_statement("snow", query) if validate else None
+        if explain:
+            # Compiled by the cloud services layer: no warehouse time and no queueing behind running queries
+            with timed_phase("snow", "compile"):
+                cursor.execute(explain, timeout=timeout)
 
-        if fetch_results:
-            results = cursor.fetchall()
-            columns = [desc[0] for desc in cursor.description]
-            if results:
-                df = pd.DataFrame(results, columns=columns)
-                # Simple formatting for DataFrame display
-                df_str = df.to_string(index=True, show_dimensions=True, max_rows=20)
-                execution_time = time.time() - start_time
-                df_str_no_empty_lines = re.sub(r'\n\s*\n', '\n', df_str)
-                
-                return 0, truncate_text_by_tokens(df_str_no_empty_lines) + f"\nQuery Time: {execution_time:.2f} s"
+        start_time = time.time()
+        with timed_phase("snow", "execute") as phase:
+            cursor.execute_async(query)
+            query_id = cursor.sfqid
+
+            if not wait_for_query(pool, session, query_id, timeout):
+                phase["failed"] = True
+                return 3, f"Timeout: query {query_id} exceeded {timeout:g} seconds and was cancelled."
+            cursor.get_results_from_sfqid(query_id)
+
+            footer = None
+            if not fetch_results:
+                session.commit()
+                return 0, None
+            if max_rows:
+                # Bounded capture (utils/result_capture.py); rowcount is the size of the whole result set
+                results = cursor.fetchmany(max_rows + 1)
+                if len(results) > max_rows:
+                    total = None if limited else cursor.rowcount
+                    results = results[:max_rows]
+                    footer = capture_footer(max_rows, total, len(cursor.description), limited)
             else:
-                return 0, '[]'
+                results = cursor.fetchall()
+
+        columns = [desc[0] for desc in cursor.description]
+        if results:
+            # Plain-text table within the token budget (utils/result_renderer.py)
+            table = render_table(results, columns, max_rows=max_rows or 20, footer=footer)
+            execution_time = time.time() - start_time
+            
+            return 0, table + f"\nQuery Time: {execution_time:.2f} s"
         else:
-            conn.commit()
-            return 0, None
-
-    except snowflake.connector.errors.ProgrammingError as pe:
-        error_str = str(pe)
-        if "000630" in error_str or "timed out" in error_str.lower():
-            return 3, f"Timeout: {error_str}"
-        return 1, f"Snowflake Programming Error: {pe}"
-        
-    except snowflake.connector.errors.DatabaseError as de:
-        error_str = str(de)
-        if "000630" in error_str or "timed out" in error_str.lower():
-            return 3, f"Timeout: {error_str}"
-        return 2, f"Snowflake Database Error: {de}"
-        
-    except Exception as e:
-        return 3, f"Unknown Error: {e}"
+            return 0, '[]'
     finally:
-        try:
-            if cursor: cursor.close()
-            if conn: conn.close()
-        except:
-            pass
+        cursor.close()
+
+SQLITE_PROGRESS_STEPS = 10000  # SQLite VM instructions between two deadline checks
 
-def _execute_sqlite_query_inner(query, db_path, fetch_results=True):
+def _sqlite_timeout_message(timeout):
+    return f"SQLite Database Error: execution exceeded {timeout:g} seconds."
+
+def _execute_sqlite_query_inner(query, db_path, fetch_results=True, timeout=None, use_pool=True, max_rows=None, limited=False, validate=False):
     
     conn = None
     cursor = None
+    # Reads run on a pooled read-only connection (utils/sqlite_pool.py); writes keep a private read-write one
+    pool = get_sqlite_pool(db_path) if (fetch_results and use_pool) else None
+    discard = False
+    deadline = time.monotonic() + timeout if timeout else None
     try:
-        conn = sqlite3.connect(db_path)
+        if pool:
+            conn = pool.acquire()
+        else:
+            conn = open_readonly_connection(db_path) if fetch_results else sqlite3.connect(db_path)
+        if deadline is not None:
+            # Cooperative cancellation: SQLite calls the handler every SQLITE_PROGRESS_STEPS instructions and
+            # aborts the running statement (like Connection.interrupt()) as soon as it returns True
+            conn.set_progress_handler(lambda: time.monotonic() > deadline, SQLITE_PROGRESS_STEPS)
         cursor = conn.cursor()
-        start_time = time.perf_counter()
-
-        cursor.execute(query)
 
-        if fetch_results:
-            results = cursor.fetchall()
-            end_time = time.perf_counter()
-            execution_time = end_time - start_time
+        explain = explain_statement("sqlite", query) if validate else None
+        if explain:
+            # Prepares the statement without running it: syntax errors and unknown tables / columns raise here
+            with timed_phase("sqlite", "compile"):
+                cursor.execute(explain).fetchall()
 
-            if results:
-                columns = [desc[0] for desc in cursor.description]
-                results_pd = pd.DataFrame(results, columns=columns)
-                df_str = results_pd.to_string(index=True, show_dimensions=True, max_rows=10)
+        start_time = time.perf_counter()
+        with timed_phase("sqlite", "execute"):
+            cursor.execute(query)
+
+            footer = None
+            if not fetch_results:
+                conn.commit()
+            elif max_rows:
+                # Bounded capture (utils/result_capture.py): one extra row tells whether the result was cut
+                results = cursor.fetchmany(max_rows + 1)
+                if len(results) > max_rows:
+                    total = None
+                    if not limited and get_capture_options()["count_rows"]:
+                        # Steps through the remaining rows without keeping them; the deadline still applies
+                        total = len(results) + sum(1 for _ in cursor)
+                    results = results[:max_rows]
+                    footer = capture_footer(max_rows, total, len(cursor.description), limited)
+            else:
+                results = cursor.fetchall()
+        end_time = time.perf_counter()
+        execution_time = end_time - start_time
 
-                # Remove empty lines
-                lines = df_str.splitlines()
-                non_empty_lines = [line for line in lines if line.strip()]
-                cleaned_df_str = '\n'.join(non_empty_lines)
+        if not fetch_results:
+            return 0, f"Operation successful.\nExecution Time: {execution_time:.4f} s"
+        if results:
+            columns = [desc[0] for desc in cursor.description]
+            # Plain-text table within the token budget (utils/result_renderer.py)
+            table = render_table(results, columns, max_rows=max_rows or 10, footer=footer)
 
-                return 0, cleaned_df_str + f"\nQuery Time: {execution_time:.4f} s"
-            else:
-                return 0, f"[]\n\nQuery Time: {execution_time:.4f} s"
+            return 0, table + f"\nQuery Time: {execution_time:.4f} s"
         else:
-            conn.commit()
-            end_time = time.perf_counter()
-            execution_time = end_time - start_time
-            return 0, f"Operation successful.\nExecution Time: {execution_time:.4f} s"
+            return 0, f"[]\n\nQuery Time: {execution_time:.4f} s"
 
     except sqlite3.ProgrammingError as pe:
         return 1, f"SQLite Programming Error: {pe}"
     except sqlite3.DatabaseError as de:
+        if deadline is not None and time.monotonic() > deadline and "interrupted" in str(de):
+            return 2, _sqlite_timeout_message(timeout)
+        # e.g. a corrupt page: do not hand the connection to the next query
+        discard = not isinstance(de, sqlite3.OperationalError)
         return 2, f"SQLite Database Error: {de}"
+    except MemoryError:
+        # SQLITE_NOMEM, e.g. the hard_heap_limit of the sandbox (utils/sqlite_sandbox.py)
+        discard = True
+        return 2, "SQLite Database Error: out of memory"
     except Exception as e:
+        discard = True
         return 3, f"Unknown Error: {e}"
     finally:
         if cursor:
             cursor.close()
         if conn:
-            conn.close()
+            if deadline is not None:
+                conn.set_progress_handler(None, 0)
+            if pool:
+                pool.release(conn, discard=discard)
+            else:
+                conn.close()
 
-def execute_sqlite_query(query, db_path, fetch_results=True):
+def _sqlite_worker(sender, query, db_path, fetch_results, timeout, max_rows, limited, validate):
+    # Runs in a child started from the forkserver, without the connection pools of the runner: open a private one.
+    # The compile / execute timings are sent back with the result (the inherited counters are dropped first).
+    take_phase_stats()
+    result = _execute_sqlite_query_inner(query, db_path, fetch_results, timeout, False, max_rows, limited, validate)
+    sender.send((result, take_phase_stats()))
+    sender.close()
+
+def _execute_sqlite_query_in_process(query, db_path, fetch_results, timeout, grace, max_rows=None, limited=False, validate=False):
+    """
+    Runs the query in a child process that is killed `grace` seconds after the cooperative deadline,
+    for statements that do not reach a progress-handler check in time. The child comes from the forkserver
+    of the sandbox (utils/sqlite_sandbox.py), never from a fork of the threaded runner.
+    """
+    ctx = worker_context(_sqlite_worker)
+    receiver, sender = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_sqlite_worker, args=(sender, query, db_path, fetch_results, timeout, max_rows, limited, validate), daemon=True)
+    process.start()
+    sender.close()
     try:
-        return func_timeout(30, _execute_sqlite_query_inner, args=(query, db_path, fetch_results))
-    except FunctionTimedOut:
-        # If the first 30 seconds are exceeded, try again with another 30-second grace period.
-        try:
-            return func_timeout(30, _execute_sqlite_query_inner, args=(query, db_path, fetch_results))
-        except FunctionTimedOut:
-            return 2, "SQLite Database Error: execution exceeded 30 seconds."
+        if receiver.poll(timeout + grace):
+            result, phase_stats = receiver.recv()
+            merge_phase_stats(phase_stats)
+            return result
+        return 2, _sqlite_timeout_message(timeout)
+    except EOFError:
+        process.join()
+        return 3, f"Unknown Error: SQLite worker exited with code {process.exitcode}."
+    finally:
+        if process.is_alive():
+            process.kill()
+        process.join()
+        receiver.close()
 
-def execute_snowflake_query(query, credentials, db_id, fetch_results=True, timeout=200):
+def execute_sqlite_query(query, db_path, fetch_results=True, max_rows=None, limited=False, validate=False):
     """
-    ⚠️⚠️⚠️ WARNING/警告 ⚠️⚠️⚠️
-    !!!Using this function in real-world scenarios is a rather expensive and risky endeavor; this paper is constrained by the latency of the shared database and is solely aimed at maximizing the score.!!!
-    !!!在真实场景中使用此函数是个相当昂贵并且冒险的行为，本文受限于共享数据库的延迟并且仅为了分数最大化!!!
-    
-    Aggressive concurrent query execution:
-    1. Run 5 threads in parallel; use the result from the first to finish.
-    2. Return immediately upon receiving a valid result, without waiting for other threads (using shutdown(wait=False)).
-    3. Cost-agnostic mode: background threads are allowed to run to completion or terminate on their own.
+    Executes a SQLite query with a deadline. A query that runs past the "timeout" of the SQLite
+    "Options" in DB.json is aborted by SQLite itself; it is then re-run "timeout_retries" times with the
+    deadline multiplied by "retry_timeout_factor". With "sandbox", the query runs in a resource-limited
+    worker process (utils/sqlite_sandbox.py); with "hard_kill", in a child process that is killed
+    "hard_kill_grace" seconds after the deadline.
+    With max_rows, at most max_rows rows are fetched (see utils/result_capture.py).
+    With validate, a SELECT is compiled with EXPLAIN QUERY PLAN first (see utils/query_validation.py).
+    Returns:
+        tuple: (status_code, query_result_or_error_message)
     """
-    max_retries = 10
-    concurrency = 1
-    
-    for attempt in range(max_retries):
-        pool = None
+    options = get_sqlite_options()
+    timeout = options["timeout"]
+    for _ in range(int(options["timeout_retries"]) + 1):
+        if options["sandbox"]:
+            status, result = get_sqlite_sandbox(_execute_sqlite_query_inner).execute(
+                (query, db_path, fetch_results, timeout, True, max_rows, limited, validate), timeout, options["hard_kill_grace"])
+        elif options["hard_kill"]:
+            status, result = _execute_sqlite_query_in_process(query, db_path, fetch_results, timeout, options["hard_kill_grace"], max_rows, limited, validate)
+        else:
+            status, result = _execute_sqlite_query_inner(query, db_path, fetch_results, timeout, True, max_rows, limited, validate)
+        if result != _sqlite_timeout_message(timeout):
+            return status, result
+        timeout *= options["retry_timeout_factor"]
+    return status, result
+
+def start_sqlite_workers():
+    """Pre-forks the SQLite sandbox workers when the "sandbox" option is on (call before starting worker threads)."""
+    return start_sqlite_sandbox(_execute_sqlite_query_inner)
+
+def execute_snowflake_query(query, credentials, db_id, fetch_results=True, timeout=None, max_rows=None, limited=False, validate=False):
+    """
+    Executes a Snowflake query on a pooled, already authenticated session (utils/snowflake_pool.py).
+    The query is submitted with execute_async and polled by query id. After the "timeout" of the
+    Snowflake "Options" in DB.json it is cancelled server-side and re-run "timeout_retries" times with
+    the deadline multiplied by "retry_timeout_factor". A session that fails on the connection level is
+    replaced and the query is tried again, up to "max_retries" times.
+    With max_rows, at most max_rows rows are fetched (see utils/result_capture.py).
+    With validate, a SELECT is compiled with EXPLAIN first (see utils/query_validation.py).
+    Returns:
+        tuple: (status_code, query_result_or_error_message)
+    """
+    options = get_snowflake_options()
+    timeout = timeout or options["timeout"]
+    timeout_retries = int(options["timeout_retries"])
+    pool = get_snowflake_pool(credentials)
+    status, result = 3, "Snowflake query was not executed."
+
+    attempt = 0
+    while attempt < options["max_retries"]:
         try:
-            # Start multiprocessing pool
-            pool = multiprocessing.Pool(processes=concurrency)
-            async_results = []
-            
-            # Submit tasks
-            for _ in range(concurrency):
-                # Note: apply_async is non-blocking
-                res = pool.apply_async(
-                    _execute_snowflake_query_inner, 
-                    args=(query, credentials, fetch_results, timeout)
-                )
-                async_results.append(res)
-            
-            # Polling for results
-            # We need to get the first result and kill the pool, so we can't use simple pool.map
-            loop_start = time.time()
-            finished_count = 0
-            
-            while True:
-                any_success = False
-                
-                # Check status of all tasks
-                for i, res in enumerate(async_results):
-                    if res.ready():
-                        try:
-                            # The timeout here is for getting results, not query timeout
-                            code, msg = res.get(timeout=0.1)
-                            
-                            # Judgment logic:
-                            # code != 3 (not timeout) -> considered a valid result (whether success 0 or error 1,2), adopt it directly
-                            if code != 3:
-                                # 【Core Nuke】Found valid result, immediately terminate process pool
-                                pool.terminate() 
-                                pool.join() # Wait for OS to clean up zombie processes
-                                return code, msg
-                            
-                            # If timeout (3), mark this task as abandoned, continue waiting for others
-                            # To avoid duplicate checks, can remove it from list, or simply count
-                            # Simple handling here: if result is 3, do nothing, wait for loop to end to judge if all failed
-                            
-                        except Exception as e:
-                            # Process communication exception, ignore, check next one
-                            pass
-                
-                # Count how many tasks have completed (even if failed/timed out)
-                finished_count = sum(1 for res in async_results if res.ready())
-                
-                # If all concurrent tasks have finished, and code reaches here, it means none had code != 3
-                # Then this batch all timed out/failed
-                if finished_count == concurrency:
-                    print(f"Batch {attempt + 1} all timed out or failed. Retrying...")
-                    pool.terminate()
-                    pool.join()
-                    break # Break out of while, enter outer for for next retry
-                
-                # Avoid CPU busy-waiting
-                time.sleep(0.1)
-                
-                # Additional total timeout protection (prevent processes from hanging)
-                if time.time() - loop_start > timeout + 10:
-                    print(f"Batch {attempt + 1} hard timeout limit reached.")
-                    pool.terminate()
-                    pool.join()
-                    break
+            session = pool.acquire()
+        except Exception as e:
+            attempt += 1
+            print(f"Snowflake connection attempt {attempt} failed: {e}")
+            status, result = 3, f"Unknown Error: {e}"
+            continue
 
+        discard = False
+        try:
+            status, result = _execute_snowflake_query_inner(query, pool, session, fetch_results, timeout, max_rows, limited, validate)
+        except ProgrammingError as pe:
+            error_str = str(pe)
+            if "000630" in error_str or "timed out" in error_str.lower():
+                return 3, f"Timeout: {error_str}"
+            return 1, f"Snowflake Programming Error: {pe}"
+        except (OperationalError, InterfaceError) as ce:
+            # Lost or expired session: replace it and submit the query again
+            discard = True
+            attempt += 1
+            print(f"Snowflake session failed (attempt {attempt}): {ce}")
+            status, result = 3, f"Unknown Error: {ce}"
+            continue
+        except DatabaseError as de:
+            error_str = str(de)
+            if "000630" in error_str or "timed out" in error_str.lower():
+                return 3, f"Timeout: {error_str}"
+            return 2, f"Snowflake Database Error: {de}"
         except Exception as e:
-            print(f"Critical error in batch execution: {e}")
-            if pool:
-                pool.terminate()
-                pool.join()
+            discard = True
+            return 3, f"Unknown Error: {e}"
         finally:
-            # Fallback: ensure pool is definitely closed
-            if pool:
-                # close() waits for tasks to complete, terminate() kills immediately. Here use terminate to ensure no residue
-                try:
-                    pool.terminate() 
-                    pool.join()
-                except:
-                    pass
+            pool.release(session, discard=discard)
 
-    return 3, f"Execution timed out after {max_retries} attempts."
+        if status == 3 and timeout_retries > 0:
+            timeout_retries -= 1
+            timeout *= options["retry_timeout_factor"]
+            print(f"Snowflake query cancelled after the deadline. Retrying with {timeout:g} s...")
+            continue
+        return status, result
+
+    return status, result
 
-def _execute_bigquery_query_inner(query, credentials_path, fetch_results=True):
+def _execute_bigquery_query_inner(query, credentials_path, fetch_results=True, max_rows=None, limited=False, validate=False):
 
     try:
-        t0 = time.time()
-        credentials = service_account.Credentials.from_service_account_file(credentials_path)
-        client = bigquery.Client(credentials=credentials)
-        t1 = time.time()
-        print(f"Connection time: {t1 - t0:.2f} S")
+        client = get_bigquery_client(credentials_path)
+        options = get_bigquery_options()
+
+        if options["dry_run"] or validate:
+            # The free dry run compiles the query and estimates its scan; status 2 lets the repair loop
+            # rewrite an over-budget query (and keeps it out of the result cache)
+            with timed_phase("bigquery", "compile"):
+                rejection = check_query_cost(client, query)
+            if rejection:
+                return 2, rejection
 
         start_time = time.time()
-        query_job = client.query(query)
-
-        if fetch_results:
-            results = query_job.result()
-            df = pd.DataFrame([dict(row.items()) for row in results])
-            end_time = time.time()
-            execution_time = end_time - start_time
-            print(f"BigQuery job complete. Cache hit: {query_job.cache_hit}. Data billed: {(query_job.total_bytes_billed or 0) / 1024 / 1024:.2f} MB")
-            if not df.empty:
-                df_str = df.to_string(index=True, show_dimensions=True, max_rows=20)
-                df_str_no_empty_lines = re.sub(r'\n\s*\n', '\n', df_str)
-                return 0, truncate_text_by_tokens(df_str_no_empty_lines) + f"\nQuery Time: {execution_time:.2f} s"
-            else:
-                return 0, '[]'
+        with timed_phase("bigquery", "execute"):
+            query_job = client.query(query, job_config=bigquery.QueryJobConfig(maximum_bytes_billed=max_bytes_billed()))
+            if not fetch_results:
+                query_job.result()
+                record_job(query_job)
+                return 0, None
+            # Only the rendered rows are downloaded; total_rows still reports the full result size
+            max_results = int(max_rows or options["max_results"])
+            results = query_job.result(max_results=max_results, page_size=max_results)
+            fetched = list(results)
+
+        columns = list(fetched[0].keys()) if fetched else []
+        rows = [tuple(row.values()) for row in fetched]
+        end_time = time.time()
+        execution_time = end_time - start_time
+        record_job(query_job)
+        print(f"BigQuery job complete. Cache hit: {query_job.cache_hit}. Data billed: {(query_job.total_bytes_billed or 0) / 1024 / 1024:.2f} MB")
+        if rows:
+            total_rows = results.total_rows or len(rows)
+            footer = None
+            if total_rows > len(rows):
+                footer = capture_footer(len(rows), None if limited else total_rows, len(columns), limited)
+            table = render_table(rows, columns, max_rows=max_results, footer=footer)
+            return 0, table + f"\nQuery Time: {execution_time:.2f} s"
         else:
-            query_job.result()
-            return 0, None
+            return 0, '[]'
     except Exception as e:
         return 3, f"BigQuery programming Error: {e}"
 
-def execute_bigquery_query(query, credentials_path, fetch_results=True, timeout=200):
+def execute_bigquery_query(query, credentials_path, fetch_results=True, timeout=None, max_rows=None, limited=False, validate=False):
+    timeout = timeout or get_bigquery_options()["timeout"]
     try:
         return func_timeout(timeout, _execute_bigquery_query_inner,
-                            args=(query, credentials_path, fetch_results))
+                            args=(query, credentials_path, fetch_results, max_rows, limited, validate))
     except FunctionTimedOut:
         return 3, f"Execution timed out after {timeout} seconds."
 
-def db_interface(db_type, query, conn_info, fetch_results=True):
+# SQLite errors that depend on the load of the machine or the sandbox limits, not on the query
+SQLITE_RESOURCE_ERRORS = ("execution exceeded", "out of memory", "disk I/O error", "sandbox CPU limit",
+                          "database is locked", "interrupted", "unable to open database")
+
+def _is_cacheable(db_type, status, result):
+    # Timeouts and resource-limit failures are always re-run; only compile and semantic errors are stored.
+    # Snowflake DatabaseErrors (status 2) include connection failures; SQLite ones are e.g. "no such column".
+    if status == 3 or not isinstance(result, str):
+        return False
+    if status == 2:
+        return db_type == "sqlite" and not any(error in result for error in SQLITE_RESOURCE_ERRORS)
+    return True
+
+def db_interface(db_type, query, conn_info, fetch_results=True, use_cache=True, capture=False, inject_limit=None, validate=None):
     """
     Unified database interface that selects the appropriate execution function based on the database type.
     Args:
@@ -343,22 +420,81 @@ def db_interface(db_type, query, conn_info, fetch_results=True):
             - For snowflake, this should be the database ID.
             - For BigQuery, this is not used as the JSON credential path is handled globally.
         fetch_results (bool): Whether to fetch query results (default is True).
+        use_cache (bool): Whether a read may be answered from the result cache (utils/db_result_cache.py).
+            Pass False where the live database must be queried, e.g. final-answer verification.
+        capture (bool): Fetch only the rows that are shown (utils/result_capture.py), for exploration
+            and intermediate steps. The result reports the shown rows next to the true row count.
+        inject_limit (bool): With capture, add a LIMIT to the outermost SELECT so the database can stop
+            early. None uses the "inject_limit" option of the Result_capture item in DB.json.
+        validate (bool): Compile the query first (EXPLAIN QUERY PLAN / EXPLAIN / dry run) and return a
+            compile error without executing it (utils/query_validation.py). None uses the "enabled" option
+            of the Validation item in DB.json.
     Returns:
         tuple: (status_code, query_result_or_error_message)
     """
     db_type = db_type.lower()
+    max_rows, limited, variant = None, False, ""
+    if capture and fetch_results:
+        max_rows = capture_rows(db_type)
+        if inject_limit is None:
+            inject_limit = get_capture_options()["inject_limit"]
+        if inject_limit:
+            limited_query = _inject_limit(query, max_rows + 1)
+            limited, query = limited_query != query, limited_query
+        # A captured result differs from the full one, so it is cached separately
+        variant = f"capture:{max_rows}"
+
+    cache = get_result_cache() if (use_cache and fetch_results) else None
+    if cache is not None:
+        db_id = os.path.basename(conn_info)[:-len(".sqlite")] if str(conn_info).endswith(".sqlite") else conn_info
+        cached = cache.get(db_type, db_id, query, variant)
+        if cached is not None:
+            return cached
+
+    if validate is None:
+        validate = validation_enabled(db_type)
+    status, result = _db_interface_uncached(db_type, query, conn_info, fetch_results, max_rows, limited, validate)
+    if cache is not None and _is_cacheable(db_type, status, result):
+        cache.put(db_type, db_id, query, status, result, variant)
+    return status, result
+
+_query_slots = {}
+_query_slots_lock = threading.Lock()
+
+def _query_slot(db_type, conn_info):
+    """
+    Per-database semaphore that caps the concurrent queries (e.g. of parallel exploration) at the
+    "max_concurrent_queries" option of the backend in DB.json.
+    """
+    key = (db_type, str(conn_info))
+    slot = _query_slots.get(key)
+    if slot is None:
+        with _query_slots_lock:
+            slot = _query_slots.get(key)
+            if slot is None:
+                options = {"sqlite": get_sqlite_options, "snow": get_snowflake_options, "bigquery": get_bigquery_options}
+                limit = options[db_type]()["max_concurrent_queries"] if db_type in options else 1
+                slot = threading.BoundedSemaphore(max(1, int(limit)))
+                _query_slots[key] = slot
+    return slot
+
+def _db_interface_uncached(db_type, query, conn_info, fetch_results=True, max_rows=None, limited=False, validate=False):
+    with _query_slot(db_type, conn_info):
+        return _dispatch_query(db_type, query, conn_info, fetch_results, max_rows, limited, validate)
+
+def _dispatch_query(db_type, query, conn_info, fetch_results=True, max_rows=None, limited=False, validate=False):
     if db_type == 'sqlite':
         # Base path for SQLite DBs
         if not conn_info.endswith(".sqlite"):
             # If only the database name is provided, construct the path automatically.
             conn_info = os.path.join(sqlite_DB_dir, conn_info, f"{conn_info}.sqlite")
-        return execute_sqlite_query(query, conn_info, fetch_results)
+        return execute_sqlite_query(query, conn_info, fetch_results, max_rows, limited, validate)
     
     if db_type == "snow":#Snowflake
-        return execute_snowflake_query(query, credentials=default_credentials, db_id=conn_info)
+        return execute_snowflake_query(query, credentials=default_credentials, db_id=conn_info, max_rows=max_rows, limited=limited, validate=validate)
     
     if db_type == "bigquery":
-        return execute_bigquery_query(query, credentials_path=Credentials_Path)
+        return execute_bigquery_query(query, credentials_path=Credentials_Path, max_rows=max_rows, limited=limited, validate=validate)
     
     return 3, "Support for other database types is not yet implemented."
 
@@ -387,6 +523,8 @@ def SQL_completion(text, db_type="snow"):
                     messages=SQL_mess,
                     model=TOOL_LLM,
                     temperature=0,
+                    stop_when="sql",
+                    stage="SQL Completion",
                     # enable_thinking=False
                 )
                 SQL = extract_sql_block(text=LLM_return)
@@ -394,6 +532,12 @@ def SQL_completion(text, db_type="snow"):
                     return 0, SQL
                 else:
                     print(f"⚠️ Attempt {attempt} failed: Failed to extract SQL.")
+            except LLMCacheMiss:
+                raise  # Replay mode must fail loudly instead of retrying
+            except LLMError as e:
+                # The provider has already retried and the fallback chain is exhausted
+                print(f"❌ SQL completion LLM call failed, returning the original text: {e}")
+                return 1, text
             except Exception as e:
                 print(f"⚠️ An exception occurred on attempt {attempt}: {e}")
         
@@ -402,33 +546,54 @@ def SQL_completion(text, db_type="snow"):
     else:
         return 1, text
     
+def schema_json_path(db_id, db_type="snow"):
+    """
+    Path of the {db}_M-Schema.json of a database. BigQuery directories are matched case-insensitively.
+    """
+    if db_type == "sqlite":
+        return os.path.join(sqlite_DB_dir, db_id, f"{db_id}_M-Schema.json")
+    if db_type == "bigquery":
+        dirname = _bigquery_dirnames.get(db_id.lower())
+        if dirname is None:
+            if not os.path.isdir(bigquery_DB_dir):
+                raise FileNotFoundError(f"Base directory not found: {bigquery_DB_dir}")
+            for name in os.listdir(bigquery_DB_dir):
+                if name.lower() == db_id.lower() and os.path.isdir(os.path.join(bigquery_DB_dir, name)):
+                    dirname = _bigquery_dirnames[db_id.lower()] = name
+                    break
+            if not dirname:
+                raise FileNotFoundError(
+                    f"Directory for db_id '{db_id}' not found (case-insensitive search) in '{bigquery_DB_dir}'."
+                )
+        return os.path.join(bigquery_DB_dir, dirname, f"{dirname}_M-Schema.json")
+    return os.path.join(snow_DB_dir, db_id, f"{db_id}_M-Schema.json")
+
+_bigquery_dirnames = {}
+
+def get_catalog(db_id, db_type="snow"):
+    """The SchemaCatalog of a database (utils/schema_catalog.py), loaded once and kept in an LRU."""
+    json_path = schema_json_path(db_id, db_type)
+    if not os.path.exists(json_path):
+        raise FileNotFoundError(f"Database schema file not found for db_id '{db_id}' at {json_path}.")
+    return get_schema_catalog(db_type, db_id, json_path)
+
 def M_Schema_sqlite(SL, db_id, level='table'):
     """
     Generates a formatted database schema string based on the given database ID (db_id),
     table/column selection list (SL), and level.
     """
+    return render_mschema(_mschema_layout_sqlite(SL, db_id, level))
+
+def _mschema_layout_sqlite(SL, db_id, level='table'):
     if db_id is None:
         raise ValueError("The db_id parameter must be provided.")
 
-    # Assume sqlite_DB_dir is a defined path variable
-    db_dir = os.path.join(sqlite_DB_dir, db_id)
-    json_path = os.path.join(db_dir, f"{db_id}_M-Schema.json")
-
-    if not os.path.exists(json_path):
-        raise FileNotFoundError(f"Schema file not found: {json_path}")
-
-    try:
-        with open(json_path, 'r', encoding='utf-8') as f:
-            schema_data = json.load(f)
-    except Exception as e:
-        raise RuntimeError(f"Failed to load schema file: {str(e)}")
-
-    all_tables_info = schema_data.get(db_id, {})
-    all_foreign_keys = schema_data.get("foreign_keys", {})
-    table_name_map = {name.lower(): name for name in all_tables_info.keys()}
+    catalog = get_catalog(db_id, "sqlite")
+    all_foreign_keys = catalog.foreign_keys
+    table_name_map = catalog.table_map
 
     if SL is None:
-        SL = list(all_tables_info.keys())
+        SL = catalog.table_names(non_empty=False)
         level = 'table'
 
     tables_to_process = []
@@ -457,12 +622,11 @@ def M_Schema_sqlite(SL, db_id, level='table'):
     else:
         raise ValueError(f"Invalid level parameter: '{level}'. Only 'table' or 'column' is supported.")
 
-    lines = [f"Note that the 'Examples' are actual values from the column. Some column might contain the values that are directly related to the question. Use it to help you justify which columns or values to use.\n[DB_ID] {db_id}"]
+    header = f"Note that the 'Examples' are actual values from the column. Some column might contain the values that are directly related to the question. Use it to help you justify which columns or values to use.\n[DB_ID] {db_id}"
+    layout = {"db_type": "sqlite", "header": [header], "tables": [], "foreign_keys": []}
 
     for original_table_name in tables_to_process:
-        columns_data = all_tables_info.get(original_table_name, [])
-        lines.append(f"# Table: {original_table_name}")
-        lines.append("[")
+        columns_data = catalog.columns(original_table_name)
 
         cols_to_render = []
         if level == 'table':
@@ -474,47 +638,29 @@ def M_Schema_sqlite(SL, db_id, level='table'):
                     requested_cols = [c.lower() for c in sl_val]
                     break
 
-            table_col_map = {col[0].lower(): col for col in columns_data}
+            table_col_map = catalog.column_map(original_table_name)
             for req_col_lower in requested_cols:
                 if req_col_lower in table_col_map:
                     cols_to_render.append(table_col_map[req_col_lower])
                 else:
                     print(f"Warning: Column '{req_col_lower}' does not exist in table '{original_table_name}', skipping.")
 
-        col_lines = []
-        for col_list in cols_to_render:
-            col_name, pk_info, col_type, col_desc, col_examples = col_list
-            col_parts = [f"{col_name}: {col_type}"]
-            if pk_info == "Primary Key":
-                col_parts.append("Primary Key")
-            if col_desc:
-                col_parts.append(col_desc)
-            if col_examples:
-                col_parts.append(f"Examples: [{col_examples}]")
-
-            col_str = f"({', '.join(col_parts)})"
-            col_lines.append(col_str)
-
-        for i, line in enumerate(col_lines):
-            lines.append(line + ("," if i < len(col_lines) - 1 else ""))
-        lines.append("]")
+        layout["tables"].append(layout_table("sqlite", original_table_name, cols_to_render, key=original_table_name))
 
     if len(tables_to_process) > 1:
-        relevant_fks = []
         tables_to_process_lower = {t.lower() for t in tables_to_process}
         for source_col, target_col in all_foreign_keys.items():
             source_table = source_col.split('.')[0].lower()
             target_table = target_col.split('.')[0].lower()
             if source_table in tables_to_process_lower and target_table in tables_to_process_lower:
-                relevant_fks.append(f"{source_col} = {target_col}")
+                layout["foreign_keys"].append(f"{source_col} = {target_col}")
 
-        if relevant_fks:
-            lines.append("[Foreign keys]")
-            lines.extend(relevant_fks)
-
-    return "\n".join(lines)
+    return layout
 
 def M_Schema_bigquery(db_id, SL=None) -> str:
+    return render_mschema(_mschema_layout_bigquery(db_id, SL))
+
+def _mschema_layout_bigquery(db_id, SL=None):
 
     if SL is None:
         SL = []
@@ -531,98 +677,20 @@ def M_Schema_bigquery(db_id, SL=None) -> str:
         return result
     
     SL = _simplify_list_series(SL)
-    try:
-        if not os.path.isdir(bigquery_DB_dir):
-            raise FileNotFoundError(f"Base directory not found: {bigquery_DB_dir}")
-
-        correct_cased_dirname = None
-        for dirname in os.listdir(bigquery_DB_dir):
-            if dirname.lower() == db_id.lower():
-                if os.path.isdir(os.path.join(bigquery_DB_dir, dirname)):
-                    correct_cased_dirname = dirname
-                    break
-
-        if not correct_cased_dirname:
-            raise FileNotFoundError(
-                f"Directory for db_id '{db_id}' not found (case-insensitive search) in '{bigquery_DB_dir}'."
-            )
+    catalog = get_catalog(db_id, "bigquery")
 
-        db_dir = os.path.join(bigquery_DB_dir, correct_cased_dirname)
-        json_path = os.path.join(db_dir, f"{correct_cased_dirname}_M-Schema.json")
-
-    except NameError:
-        raise NameError("Global variable 'bigquery_DB_dir' is not defined.")
-
-    if not os.path.exists(json_path):
-        raise FileNotFoundError(f"Database schema file not found for db_id '{db_id}' at {json_path}.")
-
-    try:
-        with open(json_path, 'r', encoding='utf-8') as f:
-            all_data = json.load(f)
-    except Exception as e:
-        raise RuntimeError(f"Failed to load or parse JSON from {json_path}: {str(e)}")
-    if not all_data:
-        raise ValueError(f"JSON file {json_path} is empty or invalid.")
-
-    def _format_table_details(full_table_name, column_details, table_description=None) -> list[str]:
-        table_lines = [f"# Table: {full_table_name}", "["]
-        if not column_details:
-            table_lines.append(f"  (Detailed column information not found for table)")
-        else:
-            formatted_columns = []
-            for col_info in column_details:
-                if len(col_info) < 4: continue
-                col_name, col_type, col_desc, col_examples = col_info
-                column_parts = [f"{col_name}: {col_type}"]
-                if col_desc and col_desc.strip(): column_parts.append(col_desc.strip())
-                if col_examples:
-                    example_text = col_examples.replace("examples:", "").strip()
-                    if example_text: column_parts.append(f"Examples: {example_text}")
-                parts_str = f"({', '.join(column_parts)})"
-                formatted_columns.append(parts_str)
-            for i, line in enumerate(formatted_columns):
-                table_lines.append("  " + line + ("," if i < len(formatted_columns) - 1 else ""))
-        table_lines.append("]")
-        if table_description:
-            table_lines.append(f"# Table Description: {table_description}")
-        return table_lines
-    
-    lines = [f"【TASK_ID】{db_id}"]
+    layout = {"db_type": "bigquery", "header": [f"【TASK_ID】{db_id}"], "tables": [], "foreign_keys": []}
 
     if not SL:
-        for top_level_key, db_content in all_data.items():
-            if not isinstance(db_content, dict): continue
-            
-            for dataset_name, dataset_content in db_content.items():
-                if not isinstance(dataset_content, dict): continue
-                
-                desc_summary_dict = dataset_content.get("table_description_summary", {})
-                
-                for table_key_original, column_details in dataset_content.items():
-                    if table_key_original in ["table_Information", "table_description_summary"]:
-                        continue
-                    
-                    full_table_name = f"{top_level_key}.{table_key_original}"
-                    table_desc = desc_summary_dict.get(table_key_original)
-                    
-                    table_formatted_lines = _format_table_details(full_table_name, column_details, table_desc)
-                    lines.extend(table_formatted_lines)
+        for top_level_key, _, table_key_original, column_details in catalog.iter_tables():
+            full_table_name = f"{top_level_key}.{table_key_original}"
+            table_desc = catalog.description(table_key_original, top_level_key)
+
+            layout["tables"].append(layout_table("bigquery", full_table_name, column_details, table_desc, key=table_key_original, top=top_level_key))
     else:
-        full_dataset_map = {} 
-        full_table_map = {}  
-        
-        for top_level_key, db_content in all_data.items():
-            if not isinstance(db_content, dict): continue
-            for dataset_original, dataset_content in db_content.items():
-                if not isinstance(dataset_content, dict): continue
-                
-                full_dataset_map[dataset_original.lower()] = dataset_original
-                
-                for table_key_original in dataset_content.keys():
-                    if table_key_original not in ["table_Information", "table_description_summary"]:
-                        # a short table id is like 'bbc_news.fulltext'
-                        short_table_id_lower = table_key_original.lower()
-                        full_table_map[short_table_id_lower] = table_key_original
+        # a short table id is like 'bbc_news.fulltext'
+        full_dataset_map = catalog.dataset_map
+        full_table_map = catalog.table_map
         
         displayed_surrogate_descriptions = set()
 
@@ -633,13 +701,11 @@ def M_Schema_bigquery(db_id, SL=None) -> str:
                 print(f"Warning: Skipping invalid table name format: {full_table_name_input}")
                 continue
             current_top_level_key_lower, dataset_name_lower, table_name_part_lower = parts[0], parts[1], '.'.join(parts[2:])
-            original_top_level_key = next((k for k in all_data.keys() if k.lower() == current_top_level_key_lower), None)
+            original_top_level_key = catalog.top_map.get(current_top_level_key_lower)
             if not original_top_level_key:
                 print(f"Warning: Table '{full_table_name_input}' top-level key '{current_top_level_key_lower}' not found in JSON. Skipping.")
                 continue
 
-            db_content = all_data[original_top_level_key]
-            
             table_id_short_lower = f"{dataset_name_lower}.{table_name_part_lower}"
             key_for_lookup, surrogate_key, is_found = None, None, False
 
@@ -650,46 +716,42 @@ def M_Schema_bigquery(db_id, SL=None) -> str:
 
             if not is_found:
                 dataset_name_original = full_dataset_map.get(dataset_name_lower)
-                if dataset_name_original and dataset_name_original in db_content:
-                    dataset_content = db_content[dataset_name_original]
-                    table_info = dataset_content.get("table_Information", {})
-                    for surrogate, similar_tables in table_info.items():
-                        tables = []
-                        if isinstance(similar_tables, dict): tables = similar_tables.get("similar_tables", [])
-                        elif isinstance(similar_tables, list): tables = similar_tables
-                        if table_id_short_lower in [t.lower() for t in tables]:
-                            key_for_lookup, surrogate_key, is_found = surrogate, surrogate, True
-                            break
+                if dataset_name_original:
+                    # Reverse index similar table -> surrogate, built once per schema file
+                    surrogate = catalog.resolve_surrogate(table_id_short_lower, dataset_name_original, original_top_level_key)
+                    if surrogate:
+                        key_for_lookup, surrogate_key, is_found = surrogate, surrogate, True
             
             if not is_found:
                 print(f"Warning: Table '{full_table_name_input}' not found. Skipping.")
                 continue
 
             display_full_table_name = f"{original_top_level_key}.{key_for_lookup}"
-            lookup_dataset_name = key_for_lookup.split('.')[0]
-            
-            dataset_data = db_content.get(lookup_dataset_name, {})
-            column_details = dataset_data.get(key_for_lookup, [])
+            column_details = catalog.columns(key_for_lookup, original_top_level_key)
             
             table_desc = None
             if surrogate_key and surrogate_key not in displayed_surrogate_descriptions:
-                desc_dataset_name = surrogate_key.split('.')[0]
-                desc_summary_dict = db_content.get(desc_dataset_name, {}).get("table_description_summary", {})
-                table_desc = desc_summary_dict.get(surrogate_key)
+                table_desc = catalog.description(surrogate_key, original_top_level_key)
                 if table_desc:
                     displayed_surrogate_descriptions.add(surrogate_key)
 
-            table_formatted_lines = _format_table_details(display_full_table_name, column_details, table_desc)
-            lines.extend(table_formatted_lines)
+            layout["tables"].append(layout_table("bigquery", display_full_table_name, column_details, table_desc,
+                                                key=key_for_lookup, top=original_top_level_key))
 
-    return "\n".join(lines)
+    return layout
 
 def M_Schema(db_id, SL=None, db_type="snow", Level="table") -> str:
+    return render_mschema(M_Schema_layout(db_id, SL, db_type))
 
+def M_Schema_layout(db_id, SL=None, db_type="snow"):
+    """
+    The tables M_Schema would render, before formatting (see render_mschema). Schema pruning
+    (utils/schema_pruning.py) shrinks this layout instead of the rendered text.
+    """
     if db_type=="sqlite":
-        return M_Schema_sqlite(db_id=db_id, SL=SL)
+        return _mschema_layout_sqlite(db_id=db_id, SL=SL)
     if db_type=="bigquery":
-        return M_Schema_bigquery(db_id=db_id, SL=SL)
+        return _mschema_layout_bigquery(db_id=db_id, SL=SL)
 
     # If SL is None, initialize it as an empty list for later processing
     if SL is None:
@@ -706,92 +768,26 @@ def M_Schema(db_id, SL=None, db_type="snow", Level="table") -> str:
         return result
     SL=_simplify_list_series(SL)
     
-    # --- 1. Loading and Initialization ---
-    try:
-        # Ensure the global variable exists
-        db_dir = os.path.join(snow_DB_dir, db_id)
-    except NameError:
-        raise NameError("Global variable 'snow_DB_dir' is not defined. Please define it before calling this function.")
-
-    json_path_options = [os.path.join(db_dir, f"{db_id}_M-Schema.json")]
-    json_path = next((path for path in json_path_options if os.path.exists(path)), None)
-
-    if not json_path:
-        raise FileNotFoundError(f"Database schema file not found for db_id '{db_id}' in expected locations.")
-
-    try:
-        with open(json_path, 'r', encoding='utf-8') as f:
-            all_schemas_data = json.load(f)
-    except Exception as e:
-        raise RuntimeError(f"Failed to load or parse JSON from {json_path}: {str(e)}")
+    # --- 1. Loading and Initialization (parsed once per file, see utils/schema_catalog.py) ---
+    catalog = get_catalog(db_id, "snow")
         
-    # --- Helper function: Format details for a single table ---
-    def _format_table_details(full_table_name, column_details, table_description=None) -> list[str]:
-        """Generate a list of formatted strings for a single table."""
-        table_lines = [f"# Table: {full_table_name}", "["]
-        
-        if not column_details:
-            table_lines.append(f"  (Detailed column information not found for table)")
-        else:
-            formatted_columns = []
-            for col_info in column_details:
-                if len(col_info) < 4: continue
-                col_name, col_type, col_desc, col_examples = col_info
-                
-                column_parts = [f"{col_name}: {col_type}"]
-                if col_desc and col_desc.strip():
-                    column_parts.append(col_desc.strip())
-                if col_examples:
-                    example_text = col_examples.replace("examples:", "").strip()
-                    if example_text:
-                        column_parts.append(f"Examples: {example_text}")
-                
-                parts_str = f"({', '.join(column_parts)})"
-                formatted_columns.append(parts_str)
-            
-            for i, line in enumerate(formatted_columns):
-                table_lines.append("  " + line + ("," if i < len(formatted_columns) - 1 else ""))
-        
-        table_lines.append("]")
-        
-        if table_description:
-            table_lines.append(f"# Table Description: {table_description}")
-            
-        return table_lines
-
     # --- 2. Main Logic: Behavior depends on whether SL is empty ---
-    lines = [f"[DB_ID] {db_id}", "[Schema]"]
+    layout = {"db_type": "snow", "header": [f"[DB_ID] {db_id}", "[Schema]"], "tables": [], "foreign_keys": []}
 
     # Branch A: SL is empty, output the schema for the entire database
     if not SL:
-        for schema_original, schema_content in all_schemas_data.items():
-            if not isinstance(schema_content, dict): continue
-            
-            desc_summary_dict = schema_content.get("table_description_summary", {})
+        # Iterate through all tables of all schemas (metadata keys are not tables)
+        for schema_original, _, table_key_original, column_details in catalog.iter_tables():
+            full_table_name = f"{db_id}.{table_key_original}"
+            table_desc = catalog.description(table_key_original, schema_original)
             
-            # Iterate through all tables in the schema
-            for table_key_original, column_details in schema_content.items():
-                # Ignore metadata keys
-                if table_key_original in ["table_Information", "table_description_summary"]:
-                    continue
-                
-                full_table_name = f"{db_id}.{table_key_original}"
-                table_desc = desc_summary_dict.get(table_key_original)
-                
-                table_formatted_lines = _format_table_details(full_table_name, column_details, table_desc)
-                lines.extend(table_formatted_lines)
+            layout["tables"].append(layout_table("snow", full_table_name, column_details, table_desc, key=table_key_original, top=schema_original))
     
     # Branch B: SL is not empty, find and output the specified tables
     else:
-        # Create case-insensitive lookup maps (only when needed)
-        schema_map = {s.lower(): s for s in all_schemas_data.keys()}
-        table_map = {}
-        for schema_lower, schema_original in schema_map.items():
-            schema_content = all_schemas_data[schema_original]
-            if isinstance(schema_content, dict):
-                for table_key_original in schema_content.keys():
-                    if table_key_original not in ["table_Information", "table_description_summary"]:
-                        table_map[table_key_original.lower()] = table_key_original
+        # Case-insensitive lookup maps, prebuilt by the catalog
+        schema_map = catalog.dataset_map
+        table_map = catalog.table_map
         
         displayed_surrogate_descriptions = set()
 
@@ -823,22 +819,13 @@ def M_Schema(db_id, SL=None, db_type="snow", Level="table") -> str:
             # Step 2: If direct match fails, check if it's a similar table of a surrogate
             if not is_found:
                 schema_name_original = schema_map.get(schema_name_lower)
-                if schema_name_original and schema_name_original in all_schemas_data:
-                    table_info = all_schemas_data[schema_name_original].get("table_Information", {})
-                    for surrogate, similar_tables in table_info.items():
-                        # Compatible with both list and dict formats
-                        if isinstance(similar_tables, dict):
-                            tables = similar_tables.get("similar_tables", [])
-                        elif isinstance(similar_tables, list):
-                            tables = similar_tables
-                        else:
-                            tables = []
-
-                        if table_id_short_lower in [t.lower() for t in tables]:
-                            key_for_lookup = surrogate
-                            surrogate_key = surrogate
-                            is_found = True
-                            break
+                if schema_name_original:
+                    # Reverse index similar table -> surrogate, built once per schema file (utils/schema_catalog.py)
+                    surrogate = catalog.resolve_surrogate(table_id_short_lower, schema_name_original)
+                    if surrogate:
+                        key_for_lookup = surrogate
+                        surrogate_key = surrogate
+                        is_found = True
 
             if not is_found:
                 print(f"Warning: Table '{full_table_name_input}' not found directly or as a similar table. Skipping.")
@@ -846,23 +833,17 @@ def M_Schema(db_id, SL=None, db_type="snow", Level="table") -> str:
 
             # Get and format the table details
             display_full_table_name = f"{db_id}.{key_for_lookup}"
-            lookup_schema_name = key_for_lookup.split('.')[0]
-            
-            schema_data = all_schemas_data.get(lookup_schema_name, {})
-            column_details = schema_data.get(key_for_lookup, [])
+            column_details = catalog.columns(key_for_lookup)
             
             table_desc = None
             if surrogate_key and surrogate_key not in displayed_surrogate_descriptions:
-                desc_schema_name = surrogate_key.split('.')[0]
-                desc_summary_dict = all_schemas_data.get(desc_schema_name, {}).get("table_description_summary", {})
-                table_desc = desc_summary_dict.get(surrogate_key)
+                table_desc = catalog.description(surrogate_key)
                 if table_desc:
                     displayed_surrogate_descriptions.add(surrogate_key)
 
-            table_formatted_lines = _format_table_details(display_full_table_name, column_details, table_desc)
-            lines.extend(table_formatted_lines)
+            layout["tables"].append(layout_table("snow", display_full_table_name, column_details, table_desc, key=key_for_lookup))
 
-    return "\n".join(lines)
+    return layout
 
 def generate_ddl_from_json(db_id, table_list=None, db_type="snow"):
     # Delegate to specific functions for sqlite or bigquery
@@ -871,25 +852,8 @@ def generate_ddl_from_json(db_id, table_list=None, db_type="snow"):
     if db_type == "bigquery":
         return generate_ddl_from_json_bigquery(db_id, table_list)
     
-    # Construct the path to the database directory
-    db_dir = os.path.join(snow_DB_dir, db_id)
-
-    # Define potential paths for the schema file
-    json_path_options = [
-        os.path.join(db_dir, f"{db_id}_M-Schema.json")
-    ]
-    # Find the first existing schema file from the options
-    json_path = next((path for path in json_path_options if os.path.exists(path)), None)
-
-    if not json_path:
-        raise FileNotFoundError(f"Database schema file not found for db_id '{db_id}' in expected locations.")
-
-    try:
-        # Load the schema data from the JSON file
-        with open(json_path, 'r', encoding='utf-8') as f:
-            all_schemas_data = json.load(f)
-    except Exception as e:
-        raise RuntimeError(f"Failed to load or parse JSON from {json_path}: {str(e)}")
+    # Parsed schema of the database (loaded once per file, see utils/schema_catalog.py)
+    catalog = get_catalog(db_id, "snow")
 
     # --- Create a set of cleaned table names for robust matching ---
     cleaned_tables_to_include_set = None
@@ -899,66 +863,25 @@ def generate_ddl_from_json(db_id, table_list=None, db_type="snow"):
 
     ddl_statements = []
 
-    # Mapping from schema types to SQL types
-    type_mapping = {
-        "TEXT": "TEXT",
-        "NUMBER": "INTEGER",
-        "FLOAT": "REAL",
-        "DATE": "DATE",
-        "TIME": "TIME"
-    }
-
-    # Iterate through each schema in the loaded data
-    for schema_name, schema_content in all_schemas_data.items():
-        if not isinstance(schema_content, dict):
+    # Iterate through each table of each schema
+    for schema_name, _, table_name, columns in catalog.iter_tables():
+        if not isinstance(columns, list):
             continue
-
-        table_summaries = schema_content.get("table_description_summary", {})
-
-        # Iterate through each table within the schema
-        for table_name, columns in schema_content.items():
-            if not isinstance(columns, list):
+        
+        # --- Clean the table name from JSON for comparison ---
+        if cleaned_tables_to_include_set:
+            # 1. Construct the original full table name
+            original_full_name = f"{db_id}.{table_name}"
+            # 2. Clean the name for comparison
+            cleaned_full_name_for_check = clean_table_name(original_full_name)
+            # 3. Look for it in the cleaned set
+            if cleaned_full_name_for_check not in cleaned_tables_to_include_set:
+                # If the cleaned name doesn't match, skip this table
                 continue
-            
-            # --- Clean the table name from JSON for comparison ---
-            if cleaned_tables_to_include_set:
-                # 1. Construct the original full table name
-                original_full_name = f"{db_id}.{table_name}"
-                # 2. Clean the name for comparison
-                cleaned_full_name_for_check = clean_table_name(original_full_name)
-                # 3. Look for it in the cleaned set
-                if cleaned_full_name_for_check not in cleaned_tables_to_include_set:
-                    # If the cleaned name doesn't match, skip this table
-                    continue
-            
-            # --- DDL generation logic remains unchanged, always using original names ---
-            # Note: We use the original db_id and table_name here to generate the DDL
-            fully_qualified_table_name_quoted = f'"{db_id}.{table_name}"'
-            create_statement = f'CREATE TABLE {fully_qualified_table_name_quoted} (\n'
-            
-            column_definitions = []
-            # Iterate through columns to define them
-            for col_info in columns:
-                if not isinstance(col_info, list) or len(col_info) < 2:
-                    continue
-
-                col_name = col_info[0]
-                col_type = col_info[1]
-                sql_type = type_mapping.get(col_type.upper(), col_type)
-                
-                col_def = f'    "{col_name}" {sql_type}'
-                column_definitions.append(col_def)
-
-            create_statement += ',\n'.join(column_definitions)
-            create_statement += '\n);\n'
-            
-            # Add table summary as a comment if it exists
-            summary_text = table_summaries.get(table_name)
-            if summary_text:
-                summary_comment = f"\n/*\n{summary_text.strip()}\n*/\n"
-                create_statement += summary_comment
-
-            ddl_statements.append(create_statement)
+        
+        # --- DDL generation always uses the original names (utils/schema_format.py) ---
+        create_statement = snow_table_ddl(f"{db_id}.{table_name}", columns, catalog.description(table_name, schema_name))
+        ddl_statements.append(create_statement)
 
     # Join all generated DDL statements into a single string
     return "\n".join(ddl_statements)
@@ -1004,101 +927,28 @@ def get_tables_ddl_sqlite(db_id: str, table_list: Optional[List[str]] = None) ->
 
 def generate_ddl_from_json_bigquery(db_id, table_list=None):
 
-    try:
-        if not os.path.isdir(bigquery_DB_dir):
-            raise FileNotFoundError(f"Base directory not found: {bigquery_DB_dir}")
-
-        correct_cased_dirname = None
-        for dirname in os.listdir(bigquery_DB_dir):
-            if dirname.lower() == db_id.lower() and os.path.isdir(os.path.join(bigquery_DB_dir, dirname)):
-                correct_cased_dirname = dirname
-                break
-
-        if not correct_cased_dirname:
-            raise FileNotFoundError(
-                f"Directory for db_id '{db_id}' not found (case-insensitive search) in '{bigquery_DB_dir}'."
-            )
-
-        db_dir = os.path.join(bigquery_DB_dir, correct_cased_dirname)
-        json_path = os.path.join(db_dir, f"{correct_cased_dirname}_M-Schema.json")
-    
-    except NameError:
-        raise NameError("Global variable 'bigquery_DB_dir' is not defined.")
-
-    if not os.path.exists(json_path):
-        raise FileNotFoundError(f"Database schema file not found for db_id '{db_id}' at {json_path}.")
-
-    try:
-        with open(json_path, 'r', encoding='utf-8') as f:
-            all_data = json.load(f)
-    except Exception as e:
-        raise RuntimeError(f"Failed to load or parse JSON from {json_path}: {str(e)}")
-    if not all_data:
-        raise ValueError(f"JSON file {json_path} is empty or invalid.")
+    catalog = get_catalog(db_id, "bigquery")
     cleaned_tables_to_include_set = None
     if table_list:
         cleaned_tables_to_include_set = {clean_table_name(t) for t in table_list}
 
     ddl_statements = []
-    type_mapping = {
-        "STRING": "STRING", "TEXT": "STRING",
-        "NUMBER": "INT64", "INTEGER": "INT64",
-        "FLOAT": "FLOAT64", "REAL": "FLOAT64",
-        "DATE": "DATE", "TIME": "TIME",
-        "TIMESTAMP": "TIMESTAMP", "DATETIME": "DATETIME",
-        "BOOLEAN": "BOOL", "GEOGRAPHY": "GEOGRAPHY",
-    }
-    COMPLEX_TYPE_LENGTH_THRESHOLD = 50
-    PLACEHOLDER_COMPLEX_TYPE = "COMPLEX_TYPE" #Nested types are uniformly referred to as COMPLEX_TYPE.
-
-    for top_level_key, db_content in all_data.items():
-        if not isinstance(db_content, dict):
+
+    for top_level_key, dataset_name, table_key, columns in catalog.iter_tables():
+        if not isinstance(columns, list): continue
+
+        original_full_name = f"{top_level_key}.{table_key}"
+        
+        if cleaned_tables_to_include_set:
+            cleaned_full_name_for_check = clean_table_name(original_full_name)
+            if cleaned_full_name_for_check not in cleaned_tables_to_include_set:
+                continue
+        
+        create_statement = bigquery_table_ddl(original_full_name, columns, catalog.description(table_key, top_level_key))
+        if create_statement is None:
             continue
-        for dataset_name, dataset_content in db_content.items():
-            if not isinstance(dataset_content, dict): continue
-
-            table_summaries = dataset_content.get("table_description_summary", {})
-            for table_key, columns in dataset_content.items():
-                if not isinstance(columns, list): continue
-
-                original_full_name = f"{top_level_key}.{table_key}"
-                
-                if cleaned_tables_to_include_set:
-                    cleaned_full_name_for_check = clean_table_name(original_full_name)
-                    if cleaned_full_name_for_check not in cleaned_tables_to_include_set:
-                        continue
-                
-                fully_qualified_table_name_quoted = f'`{original_full_name}`'
-                create_statement = f'CREATE TABLE {fully_qualified_table_name_quoted} (\n'
-                
-                column_definitions = []
-                for col_info in columns:
-                    if not isinstance(col_info, list) or len(col_info) < 2: continue
-
-                    col_name = col_info[0]
-                    col_type = col_info[1]
-                    sql_type = "" 
-
-                    if col_type and len(col_type) > COMPLEX_TYPE_LENGTH_THRESHOLD:
-                        sql_type = PLACEHOLDER_COMPLEX_TYPE
-                    else:
-                        sql_type = type_mapping.get(col_type.upper(), col_type.upper()) if col_type else "UNKNOWN"
-
-                    col_def = f'    `{col_name}` {sql_type}'
-                    column_definitions.append(col_def)
-
-                if not column_definitions:
-                    continue
-
-                create_statement += ',\n'.join(column_definitions)
-                create_statement += '\n);\n'
-                
-                summary_text = table_summaries.get(table_key)
-                if summary_text:
-                    summary_comment = f"\n/*\n{summary_text.strip()}\n*/\n"
-                    create_statement += summary_comment
-
-                ddl_statements.append(create_statement)
+
+        ddl_statements.append(create_statement)
 
     return "\n".join(ddl_statements)
 
@@ -2,6 +2,45 @@ BASE_MODEL='deepseek-ai/DeepSeek-R1-0528'#
 Reasoning_model='deepseek-ai/DeepSeek-R1-0528'
 TOOL_LLM=BASE_MODEL#"Qwen/Qwen3-Coder-480B-A35B-Instruct" #Regarding Snowflake, the current function's pure output length must reach 65535. Such tasks do not seem to exist in spider2.0-lite.
 
+# Prompt layout:
+# - "inline": every stage prompt embeds the database schema and the question (original layout).
+# - "prefix": the schema, evidence and question live in one byte-identical system message placed first in
+#   the messages of every stage of an instance (see shared_context_messages), so provider prefix caches
+#   (e.g. DeepSeek context caching) can serve the large schema part across stages.
+PROMPT_LAYOUTS = ("inline", "prefix")
+PROMPT_LAYOUT = "inline"
+SHARED_CONTEXT_REFERENCE = "【Database Schema】\n(The database schema and the user's question are given in the shared context at the beginning of this conversation.)"
+
+def set_prompt_layout(layout):
+    global PROMPT_LAYOUT
+    if layout not in PROMPT_LAYOUTS:
+        raise ValueError(f"Invalid prompt layout: '{layout}'. Supported layouts: {PROMPT_LAYOUTS}")
+    PROMPT_LAYOUT = layout
+
+def get_prompt_layout():
+    return PROMPT_LAYOUT
+
+def schema_block(schema_json, Question=None, header="【Database Schema】", layout=None):
+    """
+    Returns the schema (and question) section of a stage prompt. In "prefix" layout the section only points to the
+    shared context, which keeps the stage prompts small and the shared prefix identical.
+    """
+    if (layout or PROMPT_LAYOUT) == "prefix":
+        return SHARED_CONTEXT_REFERENCE
+    return "\n".join([header, schema_json] + ([Question] if Question is not None else []))
+
+def shared_context_messages(Question, schema_json, db_type="sqlite"):
+    """
+    Builds the shared system message of the "prefix" layout: a fixed preamble, the database schema and the
+    question (including its evidence). It must stay byte-identical for all stages of one instance.
+    """
+    dialect = {"snow": "Snowflake", "bigquery": "BigQuery", "sqlite": "SQLite"}.get(db_type, db_type)
+    content = f"""You are a professional {dialect} data analyst and SQL expert. All tasks in this conversation refer to the following database and user question.
+【Database Schema】
+{schema_json}
+{Question}"""
+    return [{"role": "system", "content": content}]
+
 '''
 # The Prompt section references some open-source projects:
 - https://github.com/HKUSTDial/Alpha-SQL
@@ -222,10 +261,11 @@ Exploration_bigquery_prompt='''
 '''
        
 class Fine_grained_Exploration: 
-    def __init__(self, Question, schema_json, db_type="sqlite") -> None:
+    def __init__(self, Question, schema_json, db_type="sqlite", layout=None) -> None:
         self.temperature = 1
         self.model = Reasoning_model
         self.messages = []
+        self.layout = layout or PROMPT_LAYOUT
         self.db_type = db_type
         self.Question = Question
         self.schema_json = schema_json
@@ -274,9 +314,7 @@ class Fine_grained_Exploration:
         return f"""
 ## Task({self.db_type} dialect)
 {self.Task}
-【Database Schema】
-{self.schema_json}
-{self.Question}
+{schema_block(self.schema_json, self.Question, layout=self.layout)}
 {self._db_admin_instructions()}
 
 ## **Output Format(Strictly follow, markdown)**  
@@ -292,7 +330,7 @@ Analyze and summarize, including reasons for exploration, considerations for met
 """
    
 class Information_Aggregation:
-   def __init__(self,Question,schema_json,DB_Exploration,db_type="snow") -> None:
+   def __init__(self,Question,schema_json,DB_Exploration,db_type="snow",layout=None) -> None:
       self.temperature=0
       self.model=Reasoning_model
       self.messages=[]
@@ -300,9 +338,7 @@ class Information_Aggregation:
       self.node ="""<Analysis Process>\nPlease elaborate in detail the consideration and analysis process for each step of the problem here.\n</Analysis Process>"""
       self.Prompt=f"""
 You are a professional data analyst responsible for inferring key information for SQL generation based on user questions and the corresponding database exploration.
-**【Database Schema】**
-{schema_json}
-{Question}
+{schema_block(schema_json, Question, header="**【Database Schema】**", layout=layout)}
 
 **【Database Exploration】**
 {DB_Exploration}  
@@ -368,7 +404,7 @@ our experiments have shown that the JSON-only output format indeed achieves high
 The reason remains unclear.
 """
 class GenerateSQLBeginning:#
-    def __init__(self, Question, schema_json, Information_Agg, db_type="sqlite") -> None:
+    def __init__(self, Question, schema_json, Information_Agg, db_type="sqlite", layout=None) -> None:
         self.temperature = 0.2
         self.model = Reasoning_model
         self.messages = []
@@ -429,9 +465,7 @@ Your primary objective is to determine the most confidently solvable sub-questio
 - **Step 4:** Rehearse the generation process of the current sub-SQL, and please generate the SQL in the order of one or more steps from (set goals → find the data source → initial screening → re-grouping → post-screening → sorting → take partial data).  
 - **Step 5:** Check whether the above SQL meets the restrictive conditions and requirements in the above text, and output the answer as required.
 
-【Database Schema】
-{schema_json}
-{Question}
+{schema_block(schema_json, Question, layout=layout)}
 
 ## Output Format (Strictly follow Markdown):  
 {self.node}  
@@ -447,7 +481,7 @@ Summarize the reasoning behind selecting the most confident sub-question based o
 """
 
 class ContinueSQLWriting:
-   def __init__(self,Question,schema_json,Information_Agg,history_context=None,db_type="sqlite") -> None:
+   def __init__(self,Question,schema_json,Information_Agg,history_context=None,db_type="sqlite",layout=None) -> None:
       self.temperature=0.2
       self.model=Reasoning_model
       self.node = """<Analysis Process>\nPlease elaborate in detail the consideration and analysis process for each step of the problem here.\n</Analysis Process>"""
@@ -502,9 +536,7 @@ Your main task is to determine the most confident next sub-question and correspo
 - **Step 5:** Generate the SQL corresponding to the current sub-question by continuing to write (or modify) the previous sub-SQL (check and correct whether the previous SQL has produced "hallucinatory" outputs). Please generate the SQL in the order of one or more steps from (set goals → find data sources → initial screening → regrouping → secondary screening → sorting → obtain partial data).
 - **Step 6:** Check whether the above SQL meets the restrictive conditions and requirements mentioned above, and output the answer as required.
 
-【Database Schema】
-{schema_json}
-{Question}
+{schema_block(schema_json, Question, layout=layout)}
 {history_context}
 
 ## Output format (Strictly follow, markdown):  
@@ -523,7 +555,7 @@ Hint: There are 4 options for "current_state": "Extend" means the sub-question i
 """
       
 class Simple_Fix:
-    def __init__(self,Error_message,last_SQL,Schema,db_type="sqlite") -> None:
+    def __init__(self,Error_message,last_SQL,Schema,db_type="sqlite",layout=None) -> None:
       self.temperature=1
       self.model=BASE_MODEL
       self.messages=[]
@@ -537,8 +569,7 @@ class Simple_Fix:
 {self.last_SQL}
 **Specific error information:**
 {self.Error_message}
-【Database Schema】
-{self.Schema}
+{schema_block(self.Schema, layout=layout)}
 Now, please modify this SQL and follow the following requirements:
 {self.Task}
 - Follow the syntax rules of {db_type} data.
@@ -10,7 +10,7 @@ sys.path.append(
     os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
 )
 
-from LLM.LLM_OUT import LLM_output
+from LLM.LLM_OUT import LLM_output, LLMCacheMiss
 from utils.extract_json import *
 from utils.Database_Interface import snow_DB_dir,sqlite_DB_dir
 
@@ -73,7 +73,9 @@ def Get_SL_func_snow(SQL, db_name, model="deepseek-chat",
             messages=SQL_mess,
             model=model,
             temperature=0,
-            max_token=4096
+            max_token=4096,
+            stop_when="json",
+            stage="Table Extraction"
         )
         print(LLM_return)
         return LLM_return
@@ -116,6 +118,8 @@ def Get_SL_func_snow(SQL, db_name, model="deepseek-chat",
                 break
             print(f"[Get_SL] Attempt {attempt}: Some columns not matched {unmatched_cols}, retrying...")
 
+        except LLMCacheMiss:
+            raise  # Replay mode must fail loudly instead of retrying
         except Exception as e:
             traceback.print_exc()
             print(f"[Get_SL] Attempt {attempt}: Error during processing - {e}")
@@ -210,7 +214,9 @@ def Get_SL_func_sqlite(SQL, db_name, model="deepseek-chat",
             messages=SQL_mess,
             model=model,
             temperature=0,
-            max_token=2048
+            max_token=2048,
+            stop_when="json",
+            stage="Table Extraction"
         )
         print("LLM_return_str: ", LLM_return_str)
         return LLM_return_str
@@ -273,6 +279,8 @@ def Get_SL_func_sqlite(SQL, db_name, model="deepseek-chat",
                 print("All tables or columns returned by LLM are invalid, retrying...")
                 time.sleep(1)
 
+        except LLMCacheMiss:
+            raise  # Replay mode must fail loudly instead of retrying
         except Exception as e:
             print(f"Exception occurred during attempt: {e}, retrying...")
             time.sleep(1)
@@ -36,9 +36,12 @@ from typing import List, Optional
 sys.path.append(
     os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
 )
-from utils.Database_Interface import snow_DB_dir,M_Schema,generate_ddl_from_json,detect_db_type,sqlite_DB_dir,bigquery_DB_dir
+from utils.Database_Interface import snow_DB_dir,M_Schema,generate_ddl_from_json,detect_db_type,sqlite_DB_dir,bigquery_DB_dir,get_catalog
+from utils.schema_pruning import measured_mschema, ddl_token_count
+from LLM.LLM_OUT import LLMCacheMiss
 from utils.app_logs.logger_config import setup_logger, log_context,JsonLogger
 from utils.mytoken.deepseek_tokenizer import *
+from LLM.ledger import configure_ledger, set_ledger_context, get_ledger_summary
 
 def log_llm_io(model_name: str, prompt: str, output: str, think, qid, log_file=None):
     """
@@ -147,33 +150,19 @@ def get_table_mess_snow(db_name):
 
     # Construct path
     db_json_path = f"{snow_DB_dir}/{db_name}/{db_name}_M-Schema.json"
-    
-    all_tables = []
 
     try:
-        with open(db_json_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        # Shared parsed schema (utils/schema_catalog.py); metadata keys are not listed as tables
+        catalog = get_catalog(db_name, "snow")
     except FileNotFoundError:
         print(f"Error: File not found at '{db_json_path}'")
         return []
-    except json.JSONDecodeError:
+    except (RuntimeError, ValueError):
         print(f"Error: Unable to parse JSON file '{db_json_path}'")
         return []
 
-    # Iterate through schema
-    for schema_name, schema_content in data.items():
-        for key, value in schema_content.items():
-            if key in ["table_Information", "table_description_summary"]:
-                continue  # Skip metadata keys
-            
-            # Skip empty tables (could be [] or {})
-            if not value:  # Empty list, empty dict, or None will be skipped
-                continue
-
-            full_table_name = f"{db_name}.{key}"
-            all_tables.append(full_table_name)
-
-    return all_tables
+    # Skip empty tables (could be [] or {})
+    return [f"{db_name}.{key}" for key in catalog.table_names(non_empty=True)]
 
 # --- New Function: Specifically extract table information for BigQuery ---
 def get_table_mess_bigquery(db_name):
@@ -194,42 +183,29 @@ def get_table_mess_bigquery(db_name):
     all_tables = []
 
     try:
-        with open(db_json_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        catalog = get_catalog(db_name, "bigquery")
     except FileNotFoundError:
         print(f"Error: File not found at '{db_json_path}'")
         return []
-    except json.JSONDecodeError:
+    except (RuntimeError, ValueError):
         print(f"Error: Unable to parse JSON file '{db_json_path}'")
         return []
 
-    # 1. Dynamically get the top-level key (project_id)
-    if not data or len(data) != 1:
+    # 1. The top-level key (project_id) must be unique
+    if len(catalog.top_map) != 1:
         print(f"Warning: JSON file structure '{db_json_path}' unexpected (should have only one top-level key).")
         return []
-    
-    top_level_key = list(data.keys())[0]
-    db_content = data[top_level_key]
 
-    # 2. Iterate through datasets
-    for dataset_name, dataset_content in db_content.items():
-        if not isinstance(dataset_content, dict):
+    # 2. Iterate through the tables of all datasets
+    for top_level_key, _, table_key, value in catalog.iter_tables():
+        # Skip empty tables (value is [], {}, None, etc.)
+        if not value:
             continue
 
-        # 3. Iterate through tables in the dataset
-        for table_key, value in dataset_content.items():
-            # Skip metadata keys
-            if table_key in ["table_Information", "table_description_summary"]:
-                continue
-            
-            # Skip empty tables (value is [], {}, None, etc.)
-            if not value:
-                continue
-
-            # 4. Construct the full physical table name
-            # table_key format is already "dataset_name.table_name"
-            full_table_name = f"{top_level_key}.{table_key}"
-            all_tables.append(full_table_name)
+        # 3. Construct the full physical table name
+        # table_key format is already "dataset_name.table_name"
+        full_table_name = f"{top_level_key}.{table_key}"
+        all_tables.append(full_table_name)
 
     return all_tables
 
@@ -246,44 +222,24 @@ def get_table_sqlite(db_name):
               Returns an empty list if the file does not exist or parsing fails.
     """
     db_json_path = f"{sqlite_DB_dir}/{db_name}/{db_name}_M-Schema.json"
-    all_tables = []
 
     try:
-        with open(db_json_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        catalog = get_catalog(db_name, "sqlite")
     except FileNotFoundError:
         print(f"❌ Error: File not found at '{db_json_path}'")
         return []
-    except json.JSONDecodeError:
+    except (RuntimeError, ValueError):
         print(f"❌ Error: Unable to parse JSON file '{db_json_path}'")
         return []
 
-    # Some JSON structures are {"AdventureWorks": {...}, "foreign_keys": {...}}
-    # So first find the database layer
-    db_content = None
-    if db_name in data:
-        db_content = data[db_name]
-    else:
-        # Some file structures are different, automatically find the first key that is not "foreign_keys"
-        for k, v in data.items():
-            if k != "foreign_keys" and isinstance(v, dict):
-                db_content = v
-                break
-
-    if not db_content:
+    # Some JSON structures are {"AdventureWorks": {...}, "foreign_keys": {...}}; the catalog uses the
+    # database key, or else the first key that is not "foreign_keys"
+    if not catalog.top_map:
         print(f"⚠️ Warning: Database structure not found in file '{db_name}'")
         return []
 
-    # Iterate through tables under this database
-    for table_name, table_content in db_content.items():
-        # Skip empty tables and foreign_keys
-        if table_name == "foreign_keys" or not table_content:
-            continue
-
-        full_table_name = f"{table_name}"
-        all_tables.append(full_table_name)
-
-    return all_tables
+    # Tables under this database, without the empty ones
+    return [table_name for table_name in catalog.table_names(non_empty=True) if table_name != "foreign_keys"]
 
 def merge_table_schemas(dict_list):
     merged_result = defaultdict(set)
@@ -481,7 +437,8 @@ def SL_workflow_old(Question_id, Question, db_id,Tool_model, model="deepseek-cha
                 input_token_count, output_token_count, Thinking, LLM_return = LLM_output(
                     messages=[{"role": "user", "content": Prompt}],
                     model=model,
-                    temperature=temperature
+                    temperature=temperature,
+                    stage="Schema Linking"
                 )
                 end_time = time.time()
                 elapsed_time1 = end_time - start_time
@@ -517,6 +474,8 @@ def SL_workflow_old(Question_id, Question, db_id,Tool_model, model="deepseek-cha
                 all_table_results.append(table_x)
                 success = True
 
+            except LLMCacheMiss:
+                raise  # Replay mode must fail loudly instead of retrying
             except Exception as e:
                 retry_count += 1
                 traceback.print_exc()
@@ -551,23 +510,21 @@ def SL_workflow_min(Question_id, Question, db_id, table_list,Tool_model,
         print(f"[Info] Database {db_id} has only one table, skipping SQL/LLM due to use_single_table=False")
         return table_list, {table_list[0]: []}, {0: {table_list[0]: []}}   # Return empty schema and sample_history
 
-    # Get table structure information (JSON format)
-    table_mess = M_Schema(db_id=db_id, SL=table_list, db_type=db_type, Level="table")
-    # Get table structure DDL information
+    # Get table structure information (JSON format) with its token count, summed from the precomputed
+    # costs of {db}_M-Schema.tokens.json (the tokenizer only confirms counts near max_token)
+    table_mess, len_table_mess = measured_mschema(db_id=db_id, SL=table_list, db_type=db_type, threshold=max_token)
+    # Get table structure DDL information (rendered only when it replaces the schema)
     if db_type=="snow" or db_type=="bigquery":
-        table_mess_ddl = generate_ddl_from_json(db_id,table_list,db_type=db_type)
+        render_ddl = lambda: generate_ddl_from_json(db_id,table_list,db_type=db_type)
     elif db_type=="sqlite":
-        table_mess_ddl = get_tables_ddl_sqlite(db_id,table_list,db_type)
-
-    # Calculate token count for JSON schema
-    len_table_mess = get_token_count(table_mess)
+        render_ddl = lambda: get_tables_ddl_sqlite(db_id,table_list,db_type)
 
     # If JSON schema exceeds token limit
     if len_table_mess > max_token:
         print(f"[Info] Schema(token count: {len_table_mess}) exceeds max_token ({max_token}). Checking DDL schema as an alternative.")
 
         # Calculate token count for DDL schema
-        len_table_mess_ddl = get_token_count(table_mess_ddl)
+        len_table_mess_ddl = ddl_token_count(db_id, table_list, db_type, threshold=max_token, render=render_ddl)
 
         # If DDL also exceeds token limit, switch to the old workflow
         if len_table_mess_ddl > max_token:
@@ -583,7 +540,7 @@ def SL_workflow_min(Question_id, Question, db_id, table_list,Tool_model,
         else:
             # Use DDL schema as an alternative to the original schema
             print(f"[Info] Using DDL schema (token count: {len_table_mess_ddl}) as it is within the limit.")
-            table_mess = table_mess_ddl
+            table_mess = render_ddl()
 
     # Construct Prompt input content
     Prompt = get_prompt_SQL4(Question, table_mess, str(table_list),db_type=db_type)
@@ -608,7 +565,8 @@ def SL_workflow_min(Question_id, Question, db_id, table_list,Tool_model,
                 input_token_count, output_token_count, Thinking, LLM_return = LLM_output(
                     messages=[{"role": "user", "content": Prompt}],
                     model=model,
-                    temperature=temperature
+                    temperature=temperature,
+                    stage="Schema Linking"
                 )
 
                 print(LLM_return)
@@ -647,6 +605,8 @@ def SL_workflow_min(Question_id, Question, db_id, table_list,Tool_model,
                 sample_history[sample_index] = table_x
                 success = True
 
+            except LLMCacheMiss:
+                raise  # Replay mode must fail loudly instead of retrying
             except Exception as e:
                 retry_count += 1
                 traceback.print_exc()
@@ -703,24 +663,22 @@ def SL_workflow(Question_id, Question, db_id, Tool_model,
         print(f"[Info] Database {db_id} has only one table, skipping SQL/LLM due to use_single_table=False")
         return table_list, {table_list[0]: []}, {0: {table_list[0]: []}}   # Return empty schema and sample_history
 
-    # Get table structure information (JSON format)
-    table_mess = M_Schema(db_id=db_id, SL=table_list, db_type=db_type, Level="table")
+    # Get table structure information (JSON format) with its token count, summed from the precomputed
+    # costs of {db}_M-Schema.tokens.json (the tokenizer only confirms counts near max_token)
+    table_mess, len_table_mess = measured_mschema(db_id=db_id, SL=table_list, db_type=db_type, threshold=max_token)
     #print(db_type,"\n",table_mess)
-    # Get table structure DDL information
+    # Get table structure DDL information (rendered only when it replaces the schema)
     if db_type=="snow" or db_type=="bigquery":
-        table_mess_ddl = generate_ddl_from_json(db_id,db_type=db_type)
+        render_ddl = lambda: generate_ddl_from_json(db_id,db_type=db_type)
     elif db_type=="sqlite":
-        table_mess_ddl = get_tables_ddl_sqlite(db_id,db_type=db_type)
-
-    # Calculate token count for JSON schema
-    len_table_mess = get_token_count(table_mess)
+        render_ddl = lambda: get_tables_ddl_sqlite(db_id,db_type=db_type)
 
     # If JSON schema exceeds token limit
     if len_table_mess > max_token:
         print(f"[Info] Schema(token count: {len_table_mess}) exceeds max_token ({max_token}). Checking DDL schema as an alternative.")
 
         # Calculate token count for DDL schema
-        len_table_mess_ddl = get_token_count(table_mess_ddl)
+        len_table_mess_ddl = ddl_token_count(db_id, None, db_type, threshold=max_token//2, render=render_ddl)
 
         # If DDL also exceeds token limit, switch to the old workflow
         if len_table_mess_ddl > max_token//2:
@@ -745,7 +703,7 @@ def SL_workflow(Question_id, Question, db_id, Tool_model,
         else:
             # Use DDL schema as an alternative to the original schema
             print(f"[Info] Using DDL schema (token count: {len_table_mess_ddl}) as it is within the limit.")
-            table_mess = table_mess_ddl
+            table_mess = render_ddl()
 
     # Construct Prompt input content
     Prompt = get_prompt_SQL4(Question, table_mess, str(table_list),db_type=db_type)
@@ -770,7 +728,8 @@ def SL_workflow(Question_id, Question, db_id, Tool_model,
                 input_token_count, output_token_count, Thinking, LLM_return = LLM_output(
                     messages=[{"role": "user", "content": Prompt}],
                     model=model,
-                    temperature=temperature
+                    temperature=temperature,
+                    stage="Schema Linking"
                 )
                 print("LLM_return:",LLM_return)
                 log_llm_io(model_name=model, prompt=Prompt, output=LLM_return, think=Thinking, qid=Question_id)
@@ -807,6 +766,8 @@ def SL_workflow(Question_id, Question, db_id, Tool_model,
                 sample_history[sample_index] = table_x
                 success = True
 
+            except LLMCacheMiss:
+                raise  # Replay mode must fail loudly instead of retrying
             except Exception as e:
                 retry_count += 1
                 traceback.print_exc()
@@ -837,6 +798,8 @@ def SL_workflow(Question_id, Question, db_id, Tool_model,
                 max_retries=max_retries,
                 db_type=db_type
             )
+    except LLMCacheMiss:
+        raise
     except Exception as e:
         traceback.print_exc()
         print(f"[Error] Failed to merge table schemas from {len(all_samples)} samples: {e}")
@@ -864,6 +827,8 @@ if __name__ == "__main__":
 
     # --- Original logic (only modified log_file_path variable reference) ---
     logger_status = JsonLogger(log_file_path=log_file_path)
+    # Every LLM call (schema linking and table extraction) is appended to the token ledger
+    configure_ledger(path=os.path.join(log_dir, "SL_ledger.jsonl"))
     MAX_TOKEN = 65536
     all_results = []
     processed_ids = set()
@@ -910,6 +875,7 @@ if __name__ == "__main__":
                     user_input = f"[Question]\n{question}\n"
                 
                 db_type = detect_db_type(instance_id)
+                set_ledger_context(instance=instance_id, db=db_name)
                 
                 # Note: If SL_workflow requires the model parameter, pass model=model_name here
                 table, col, sample_history = SL_workflow(
@@ -941,9 +907,12 @@ if __name__ == "__main__":
                 print(f"  -> Saved {len(all_results)} item(s) to '{output_file_path}'")
 
         print(f"\nProcessing finished successfully. Final output is in '{output_file_path}'")
+        print(f"LLM token ledger per stage: {get_ledger_summary(by='stage')}")
 
     except json.JSONDecodeError as e:
         print(f"\nError decoding JSON from a line in the input file: {e}")
+    except LLMCacheMiss:
+        raise
     except Exception as e:
         traceback.print_exc()
         print(f"\nAn unexpected error occurred: {e}")
@@ -70,7 +70,8 @@ def setup_logger(log_file_path, logger_name):
     # Assuming you have a custom JsonFormatter
     # file_handler.setFormatter(JsonFormatter())
     # If not, you can use the standard Formatter
-    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    # The thread name separates the interleaved records of concurrent workers (e.g. parallel exploration)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(threadName)s - %(message)s'))
 
     # --- Console Handler ---
     # Outputs logs to standard output (e.g., the terminal).
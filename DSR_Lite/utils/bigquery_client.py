@@ -0,0 +1,103 @@
+import os
+import threading
+
+from google.oauth2 import service_account
+from google.cloud import bigquery
+
+from utils.DBsetup.Get_DB import read_db_options
+
+# --- Cached BigQuery client with cost gating ---
+# Loading the service-account file and building a bigquery.Client costs a round of I/O and auth setup,
+# so one client per credentials file is created and shared by all threads (the client is thread-safe).
+# Every query first goes through a free dry run that reports the bytes it would scan; queries above the
+# budget are rejected with a message the repair loop can act on, and the real job carries
+# maximum_bytes_billed so BigQuery itself refuses to bill more. Only the rows that are rendered are fetched.
+#
+# Options come from the "Options" entry of the Bigquery item in utils/DBsetup/DB.json:
+#   dry_run          - estimate total_bytes_processed before running a query
+#   max_gb_billed    - byte budget per query in GiB (dry-run gate and maximum_bytes_billed; 0 disables both)
+#   max_results      - rows fetched from the result (the total row count is still reported)
+#   timeout          - seconds before the query is given up
+#   max_concurrent_queries - queries db_interface runs at the same time against one database
+
+DEFAULT_BIGQUERY_OPTIONS = {
+    "dry_run": True,
+    "max_gb_billed": 100,
+    "max_results": 20,
+    "timeout": 200,
+    "max_concurrent_queries": 4
+}
+
+GIB = 1024 ** 3
+
+_options = None
+_clients = {}
+_lock = threading.Lock()
+_stats = {"queries": 0, "dry_runs": 0, "rejected": 0, "bytes_processed": 0, "bytes_billed": 0, "cache_hits": 0}
+
+
+def get_bigquery_options():
+    global _options
+    if _options is None:
+        _options = {**DEFAULT_BIGQUERY_OPTIONS, **read_db_options("bigquery")}
+    return _options
+
+
+def get_bigquery_client(credentials_path):
+    """Returns the process-wide client of a service-account file, creating it on first use."""
+    key = os.path.abspath(credentials_path)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                credentials = service_account.Credentials.from_service_account_file(key)
+                client = bigquery.Client(credentials=credentials)
+                _clients[key] = client
+    return client
+
+
+def max_bytes_billed():
+    """The per-query byte budget, or None when it is disabled."""
+    max_gb = get_bigquery_options()["max_gb_billed"]
+    return int(max_gb * GIB) if max_gb else None
+
+
+def check_query_cost(client, query):
+    """
+    Dry-runs a query and checks its estimated scan against the byte budget. Syntax and schema errors are
+    raised by the dry run like they would be by the real job, without starting it.
+
+    Returns:
+        str or None: A rejection message for the repair loop, or None when the query may run.
+    """
+    job = client.query(query, job_config=bigquery.QueryJobConfig(dry_run=True))
+    processed = job.total_bytes_processed or 0
+    limit = max_bytes_billed()
+    with _lock:
+        _stats["dry_runs"] += 1
+        rejected = bool(limit) and processed > limit
+        _stats["rejected"] += int(rejected)
+    if not rejected:
+        return None
+    return (f"BigQuery Cost Error: the query would process {processed / GIB:.2f} GiB, above the budget of "
+            f"{limit / GIB:.2f} GiB per query. Select only the needed columns, filter on partition or "
+            f"_TABLE_SUFFIX columns, or restrict the date range instead of scanning whole tables.")
+
+
+def record_job(query_job):
+    """Adds the bytes of a finished job to the counters."""
+    with _lock:
+        _stats["queries"] += 1
+        _stats["bytes_processed"] += query_job.total_bytes_processed or 0
+        _stats["bytes_billed"] += query_job.total_bytes_billed or 0
+        _stats["cache_hits"] += int(bool(query_job.cache_hit))
+
+
+def get_bigquery_stats():
+    """Returns the job counters, with the byte totals in GiB."""
+    with _lock:
+        stats = dict(_stats)
+    for field in ("bytes_processed", "bytes_billed"):
+        stats[field.replace("bytes", "gb")] = round(stats.pop(field) / GIB, 3)
+    return stats
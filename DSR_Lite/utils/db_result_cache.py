@@ -0,0 +1,221 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from utils.DBsetup.Get_DB import read_db_options
+
+# --- Normalized-SQL result cache ---
+# Multi-path runs re-run identical exploration SQL, repair loops re-execute SQL the model re-emits
+# unchanged and GenerateSQL2 re-runs the previous CTE chain. db_interface stores the
+# (status, formatted_result) tuple of every read query in a local SQLite file, keyed on
+# (db_type, db id, normalized SQL), so each of them only reaches the database once - across runs too.
+#
+# Normalization only removes what cannot change the result: comments, runs of whitespace and trailing
+# semicolons outside of string literals and quoted identifiers. Letter case is kept.
+#
+# Options come from the "Options" entry of the Result_cache item in utils/DBsetup/DB.json:
+#   enabled      - turn the cache on or off
+#   path         - cache file, relative paths are resolved against the DSR_Lite root
+#   max_size_mb  - least recently used entries are evicted above this size
+#   ttl_seconds  - per db_type, seconds an entry stays valid (0 never expires)
+#
+# Only reads with a deterministic outcome are stored: timeouts, unknown errors (status 3) and SQLite
+# resource-limit failures (out of memory, sandbox limits) are not. Callers that must see the live database
+# pass use_cache=False: main_lite.py does so for the SQL that ends SQL continuation (the final answer).
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "db_result_cache.sqlite")
+DEFAULT_RESULT_CACHE_OPTIONS = {
+    "enabled": False,
+    "path": None,
+    "max_size_mb": 1024,
+    "ttl_seconds": {"sqlite": 0, "snow": 604800, "bigquery": 604800}
+}
+
+# String literals and quoted identifiers are matched first, so comment markers and whitespace inside them are kept
+_SQL_TOKENS = re.compile(r"""
+    (?P<literal>'(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`)
+  | (?P<gap>(?:--[^\n]*|/\*.*?\*/|\s)+)
+""", re.VERBOSE | re.DOTALL)
+
+
+def normalize_sql(query):
+    """
+    Returns the cache form of a query: comments dropped, whitespace collapsed, trailing semicolons removed.
+    Literals and quoted identifiers are kept verbatim.
+    """
+    normalized = _SQL_TOKENS.sub(lambda m: m.group("literal") or " ", query)
+    return normalized.strip().rstrip("; ").strip()
+
+
+class DBResultCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_size_mb=1024, ttl_seconds=None):
+        self.path = path
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.ttl_seconds = ttl_seconds or {}
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.stored = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # One shared connection guarded by a lock; WAL lets several runner processes share the file
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                db_type TEXT,
+                db_id TEXT,
+                status INTEGER,
+                value TEXT,
+                size INTEGER,
+                created REAL,
+                last_access REAL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_results_last_access ON results(last_access)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    @staticmethod
+    def make_key(db_type, db_id, query, variant=""):
+        # `variant` separates differently shaped results of the same query (e.g. bounded captures)
+        payload = json.dumps([db_type.lower(), str(db_id), normalize_sql(query)] + ([variant] if variant else []), ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, db_type, db_id, query, variant=""):
+        """Returns the cached (status, result) tuple, or None on a miss or an expired entry."""
+        key = self.make_key(db_type, db_id, query, variant)
+        ttl = self.ttl_seconds.get(db_type.lower(), 0)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT status, value, created FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None and ttl and now - row[2] > ttl:
+                self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._conn.commit()
+                self.expired += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return row[0], json.loads(row[1])
+
+    def put(self, db_type, db_id, query, status, result, variant=""):
+        """Stores the outcome of a query and evicts least recently used entries when over budget."""
+        key = self.make_key(db_type, db_id, query, variant)
+        value = json.dumps(result, ensure_ascii=False)
+        size = len(value.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, db_type, db_id, status, value, size, created, last_access) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, db_type.lower(), str(db_id), status, value, size, now, now)
+            )
+            self._conn.commit()
+            self.stored += 1
+            self._total_bytes += size - (old[0] if old else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Re-read the real total: other processes may be writing to the same file
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        target = int(self.max_bytes * 0.9)
+        cursor = self._conn.execute("SELECT key, size FROM results ORDER BY last_access ASC")
+        to_delete = []
+        for key, size in cursor:
+            if self._total_bytes <= target:
+                break
+            to_delete.append((key,))
+            self._total_bytes -= size
+        self._conn.executemany("DELETE FROM results WHERE key = ?", to_delete)
+        self._conn.commit()
+
+    def invalidate(self, db_type=None, db_id=None):
+        """Drops every entry of a database (or of a db_type, or all entries). Returns the number removed."""
+        clauses, params = [], []
+        if db_type is not None:
+            clauses.append("db_type = ?")
+            params.append(db_type.lower())
+        if db_id is not None:
+            clauses.append("db_id = ?")
+            params.append(str(db_id))
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            removed = self._conn.execute(f"DELETE FROM results{where}", params).rowcount
+            self._conn.commit()
+            self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        return removed
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "entries": entries,
+            "size_mb": round(self._total_bytes / 1024 / 1024, 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "stored": self.stored,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# --- Process-wide cache instance ---
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def configure_result_cache(enabled=None, path=None, max_size_mb=None, ttl_seconds=None):
+    """
+    (Re)configures the process-wide result cache. Arguments that are None fall back to the
+    Result_cache options of DB.json, then to the defaults.
+
+    Returns:
+        DBResultCache or None: The active cache, or None when the cache is disabled.
+    """
+    global _cache, _configured
+    options = {**DEFAULT_RESULT_CACHE_OPTIONS, **read_db_options("result_cache")}
+    enabled = options["enabled"] if enabled is None else enabled
+    path = path or options["path"] or DEFAULT_CACHE_PATH
+    if not os.path.isabs(path):
+        # Relative paths are resolved against the DSR_Lite root, like the other configuration paths
+        path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), path)
+    max_size_mb = max_size_mb or options["max_size_mb"]
+    ttl_seconds = {**DEFAULT_RESULT_CACHE_OPTIONS["ttl_seconds"], **options["ttl_seconds"], **(ttl_seconds or {})}
+
+    with _cache_lock:
+        if _cache is not None:
+            _cache.close()
+            _cache = None
+        if enabled:
+            _cache = DBResultCache(path=path, max_size_mb=max_size_mb, ttl_seconds=ttl_seconds)
+        _configured = True
+    return _cache
+
+
+_configured = False
+_init_lock = threading.Lock()
+
+
+def get_result_cache():
+    """Returns the active result cache (configured lazily from DB.json), or None when it is disabled."""
+    if not _configured:
+        with _init_lock:
+            if not _configured:
+                configure_result_cache()
+    return _cache
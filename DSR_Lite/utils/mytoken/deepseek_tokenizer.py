@@ -5,9 +5,20 @@ os.environ['TRANSFORMERS_VERBOSITY'] = 'error'
 from transformers import AutoTokenizer, logging
 import os
 import glob
+from functools import lru_cache
 
 logging.set_verbosity_error()
 
+@lru_cache(maxsize=None)
+def load_tokenizer(tokenizer_dir=None):
+    """
+    Loads the tokenizer once per process (the tokenizer files live next to this script by default).
+    Fast tokenizers are thread-safe for encoding, so the instance is shared by all threads.
+    """
+    if tokenizer_dir is None:
+        tokenizer_dir = os.path.dirname(os.path.abspath(__file__))
+    return AutoTokenizer.from_pretrained(tokenizer_dir, trust_remote_code=False)
+
 def truncate_text_by_tokens(text, max_tokens=4096):
     """
     Truncates the text so that its token count does not exceed max_tokens, and returns the truncated string.
@@ -20,12 +31,8 @@ def truncate_text_by_tokens(text, max_tokens=4096):
     Returns:
         str: The truncated string.
     """
-    # Get the directory of the current Python script
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    chat_tokenizer_dir = current_dir  # The tokenizer path is the current directory
-
-    # Load the tokenizer
-    tokenizer = AutoTokenizer.from_pretrained(chat_tokenizer_dir, trust_remote_code=False)
+    # Load the tokenizer (cached after the first call)
+    tokenizer = load_tokenizer()
 
     # Use truncation=True to truncate the input
     inputs = tokenizer(
@@ -53,20 +60,8 @@ def get_token_count(text: str) -> int:
     Returns:
         int: The number of tokens corresponding to the text.
     """
-    # Get the directory of the current Python script
-    # Note: In an interactive environment (like Jupyter), __file__ may not be defined.
-    # In such cases, you might need to specify the path manually or use os.getcwd().
-    try:
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-    except NameError:
-        # If running in an interactive environment where __file__ is not defined, use the current working directory
-        current_dir = os.getcwd()
-        
-    tokenizer_dir = current_dir  # The tokenizer path is the current directory
-
-    # Load the tokenizer
-    # Ensure tokenizer files (tokenizer.json, etc.) exist in this directory
-    tokenizer = AutoTokenizer.from_pretrained(tokenizer_dir, trust_remote_code=False)
+    # Load the tokenizer (cached after the first call)
+    tokenizer = load_tokenizer()
 
     # Use tokenizer.encode() to encode the text, which returns a list of token IDs
     token_ids = tokenizer.encode(text)
@@ -75,6 +70,25 @@ def get_token_count(text: str) -> int:
     return len(token_ids)
 
 
+def get_token_counts(texts) -> list:
+    """
+    Calculates the number of tokens of each text in one batch call, without special tokens, so the counts
+    of the fragments of a document add up to roughly the count of the document.
+
+    Args:
+        texts (list[str]): The fragments to count.
+
+    Returns:
+        list[int]: The token count of each fragment.
+    """
+    texts = list(texts)
+    if not texts:
+        return []
+    tokenizer = load_tokenizer()
+    encoded = tokenizer(texts, add_special_tokens=False, return_attention_mask=False, return_token_type_ids=False)
+    return [len(ids) for ids in encoded["input_ids"]]
+
+
 SL='''
 We are given a problem and a previous SQL query that was executed. We need to analyze the SQL based on the given steps and the reference columns.
 '''
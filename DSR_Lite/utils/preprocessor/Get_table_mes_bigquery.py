@@ -15,6 +15,7 @@ sys.path.append(project_root)
 from LLM.LLM_OUT import LLM_output
 from utils.extract_json import extract_and_parse_json
 from utils.DBsetup.Get_DB import read_db_config
+from utils.schema_tokens import write_token_costs_safely
 
 
 # --- Basic I/O Functions ---
@@ -347,6 +348,8 @@ def main(task_folder_path, model):
 
     output_file_path = task_path / f"{task_name}_M-Schema.json"
     write_json_file(final_output, output_file_path)
+    # Token counts of every table, column, description and example block, read by the budget checks
+    write_token_costs_safely("bigquery", task_name, output_file_path, final_output)
     print(f"--- Finished processing for task: {task_name} ---")
 
 
@@ -21,6 +21,7 @@ sys.path.append(project_root)
 from LLM.LLM_OUT import LLM_output
 from utils.extract_json import extract_and_parse_json
 from utils.DBsetup.Get_DB import read_db_config
+from utils.schema_tokens import write_token_costs_safely
 
 _, snow_DB_dir, _, SNOWFLAKE_CREDENTIALS, _=read_db_config()
 
@@ -998,6 +999,8 @@ def process_and_save_database(db_name, db_root, model,credentials=SNOWFLAKE_CRED
             json.dump(dist5, f, indent=4, ensure_ascii=False)
 
         print(f"✅ File saved successfully: {output_path}")
+        # Token counts of every table, column, description and example block, read by the budget checks
+        write_token_costs_safely("snow", db_name, output_path, dist5)
 
     except Exception as e:
         # Do not swallow the exception here; raise it for the outer layer to catch
@@ -19,6 +19,7 @@ project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')
 sys.path.append(project_root)
 
 from utils.DBsetup.Get_DB import read_db_config
+from utils.schema_tokens import sqlite_table_ddl, write_token_costs_safely
 
 sqlite_path, _, _, _, _=read_db_config()
 
@@ -119,8 +120,8 @@ def load_descriptions_from_table_json(db_dir_path):
     json_files = glob.glob(os.path.join(db_dir_path, '*.json'))
     
     for file_path in json_files:
-        # Skip the schema file generated by us to prevent duplicate runs
-        if "_M-Schema.json" in os.path.basename(file_path):
+        # Skip the schema file generated by us and its sidecars (e.g. _M-Schema.tokens.json) to prevent duplicate runs
+        if "_M-Schema." in os.path.basename(file_path):
             continue
             
         try:
@@ -226,6 +227,8 @@ def process_database(db_dir_path, overwrite_existing=False, include_descriptions
             json.dump(final_json_data, f, indent=4, ensure_ascii=False)
             
         print(f"Successfully generated Schema JSON file: {output_json_path}")
+        # Token counts of every table, column, example block and CREATE statement, read by the budget checks
+        write_token_costs_safely("sqlite", db_name, output_json_path, final_json_data, sqlite_table_ddl(conn))
 
     except Exception as e:
         print(f"Severe error occurred while processing database '{db_name}': {e}")
@@ -0,0 +1,162 @@
+import os
+import re
+import time
+import threading
+from contextlib import contextmanager
+
+from utils.DBsetup.Get_DB import read_db_options
+
+# --- Pre-execution validation ---
+# Most failures in the repair loops are compile-time errors (unknown identifiers, quoting, dialect syntax)
+# that used to surface only after paying for a full execution, on Snowflake and BigQuery including the
+# queueing. With validation on, db_interface first compiles a SELECT without running it and returns the
+# compile error right away; only queries that compile are executed:
+#   sqlite   - EXPLAIN QUERY PLAN on the same pooled connection
+#   snow     - EXPLAIN USING TEXT (compiled by the cloud services layer, no warehouse time)
+#   bigquery - the dry run of utils/bigquery_client.py, which also checks the byte budget
+#
+# Compile and execute latencies are recorded separately per db_type (get_validation_stats); a phase counts
+# as failed when it raised, so the compile failures are the queries that never reached execution.
+#
+# On SQLite the compile step is a local EXPLAIN and costs next to nothing, so it is on by default. On
+# Snowflake and BigQuery it is an extra round trip in front of every valid query, which only pays off when
+# many queries fail to compile (e.g. repair-heavy runs); there it is opt-in (--validate or configure_validation).
+#
+# Options come from the "Options" entry of the Validation item in utils/DBsetup/DB.json:
+#   enabled - per db_type, default of db_interface(..., validate=None)
+
+DEFAULT_VALIDATION_OPTIONS = {
+    "enabled": {"sqlite": True, "snow": False, "bigquery": False}
+}
+
+EXPLAIN_PREFIX = {
+    "sqlite": "EXPLAIN QUERY PLAN ",
+    "snow": "EXPLAIN USING TEXT "
+}
+
+_FIRST_KEYWORD = re.compile(r"^(?:\s+|--[^\n]*(?:\n|$)|/\*.*?\*/|\()*([A-Za-z]+)", re.DOTALL)
+
+_options = None
+_stats = {}
+_lock = threading.Lock()
+
+
+def _reset_lock_after_fork():
+    # A thread of the parent may hold the lock at fork time; forked SQLite workers start with a fresh one
+    global _lock
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_lock_after_fork)
+
+
+def get_validation_options():
+    global _options
+    if _options is None:
+        options = read_db_options("validation")
+        _options = {**DEFAULT_VALIDATION_OPTIONS, **options,
+                    "enabled": {**DEFAULT_VALIDATION_OPTIONS["enabled"], **options.get("enabled", {})}}
+    return _options
+
+
+def configure_validation(enabled=None):
+    """
+    Overrides the "enabled" option, e.g. configure_validation({"sqlite": False}); a list such as ["snow", "bigquery"]
+    turns validation on for those database types and leaves the others as configured. Returns the active options.
+    """
+    global _options
+    options = dict(get_validation_options())
+    if enabled is not None:
+        if not isinstance(enabled, dict):
+            enabled = {db_type: True for db_type in enabled}
+        options["enabled"] = {**options["enabled"], **enabled}
+    _options = options
+    return _options
+
+
+def validation_enabled(db_type):
+    return bool(get_validation_options()["enabled"].get(db_type.lower(), False))
+
+
+def is_read_query(query):
+    """Whether the query is a single SELECT / WITH statement, the only kind that is validated."""
+    match = _FIRST_KEYWORD.match(query)
+    return bool(match) and match.group(1).upper() in ("SELECT", "WITH")
+
+
+def explain_statement(db_type, query):
+    """
+    The statement that compiles `query` without running it on this db_type, or None when it is not
+    validated (not a SELECT / WITH, or a backend without an EXPLAIN form such as BigQuery).
+    """
+    prefix = EXPLAIN_PREFIX.get(db_type.lower())
+    if prefix is None or not is_read_query(query):
+        return None
+    # A trailing semicolon would end the EXPLAIN before the query does on some backends
+    return prefix + query.strip().rstrip(";")
+
+
+def record_phase(db_type, phase, seconds, failed=False):
+    """
+    Adds one compile or execute measurement.
+
+    Args:
+        db_type (str): sqlite, snow or bigquery.
+        phase (str): "compile" or "execute".
+        seconds (float): Elapsed time of the phase.
+        failed (bool): Whether the phase ended with an error (a rejected query for "compile").
+    """
+    with _lock:
+        stats = _stats.setdefault(db_type, {})
+        phase_stats = stats.setdefault(phase, {"count": 0, "failed": 0, "seconds": 0.0})
+        phase_stats["count"] += 1
+        phase_stats["failed"] += int(failed)
+        phase_stats["seconds"] += seconds
+
+
+@contextmanager
+def timed_phase(db_type, phase):
+    """
+    Records the duration of the enclosed block as `phase`. It counts as failed when the block raises or
+    sets outcome["failed"] on the yielded dict (e.g. a query cancelled at its deadline).
+    """
+    outcome = {"failed": False}
+    start = time.perf_counter()
+    try:
+        yield outcome
+    except BaseException:
+        outcome["failed"] = True
+        raise
+    finally:
+        record_phase(db_type, phase, time.perf_counter() - start, outcome["failed"])
+
+
+def take_phase_stats():
+    """Returns the raw counters and clears them, e.g. to send the timings of a worker process back."""
+    global _stats
+    with _lock:
+        stats, _stats = _stats, {}
+    return stats
+
+
+def merge_phase_stats(stats):
+    """Adds raw counters returned by take_phase_stats() in another process."""
+    with _lock:
+        for db_type, phases in stats.items():
+            for phase, values in phases.items():
+                phase_stats = _stats.setdefault(db_type, {}).setdefault(phase, {"count": 0, "failed": 0, "seconds": 0.0})
+                for field in phase_stats:
+                    phase_stats[field] += values[field]
+
+
+def get_validation_stats():
+    """
+    Returns the compile / execute counters per db_type, e.g.
+    {"snow": {"compile": {"count": 40, "failed": 9, "seconds": 12.1, "mean": 0.3}, "execute": {...}}}
+    """
+    with _lock:
+        return {db_type: {phase: {**values, "seconds": round(values["seconds"], 3),
+                                  "mean": round(values["seconds"] / values["count"], 4) if values["count"] else 0.0}
+                          for phase, values in phases.items()}
+                for db_type, phases in _stats.items()}
@@ -0,0 +1,104 @@
+import re
+
+from utils.DBsetup.Get_DB import read_db_options
+
+# --- Bounded result capture ---
+# Exploration and intermediate SQL only show the first rows of a result to the model, yet the executors
+# used to download every row and build a full DataFrame, so an exploratory SELECT * on a multi-million-row
+# table could exhaust memory or stall for minutes. With db_interface(..., capture=True) the executors
+# fetch at most max_rows + 1 rows (fetchmany / max_results) and report the rows shown next to the true
+# row count when it is cheap to get: cursor.rowcount on Snowflake, total_rows on BigQuery and, with
+# count_rows, by stepping through the rest of a SQLite cursor without keeping the rows.
+#
+# With inject_limit, the outermost SELECT of a captured query without its own LIMIT / FETCH / TOP is
+# rewritten to LIMIT max_rows + 1 so the database can stop early; the true row count is then unknown.
+#
+# Options come from the "Options" entry of the Result_capture item in utils/DBsetup/DB.json:
+#   max_rows      - per db_type, rows fetched and shown
+#   count_rows    - count the remaining SQLite rows (costs execution time, not memory)
+#   inject_limit  - default of db_interface(..., inject_limit=None)
+
+DEFAULT_CAPTURE_OPTIONS = {
+    "max_rows": {"sqlite": 10, "snow": 20, "bigquery": 20},
+    "count_rows": True,
+    "inject_limit": False
+}
+
+_options = None
+
+_SQL_TOKENS = re.compile(r"""
+    (?P<literal>'(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`)
+  | (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<open>\()
+  | (?P<close>\))
+  | (?P<semi>;)
+  | (?P<word>[A-Za-z_][A-Za-z_0-9$]*)
+  | (?P<space>\s+)
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+_ROW_LIMIT_KEYWORDS = {"LIMIT", "FETCH", "TOP"}
+
+
+def get_capture_options():
+    global _options
+    if _options is None:
+        options = read_db_options("result_capture")
+        _options = {**DEFAULT_CAPTURE_OPTIONS, **options,
+                    "max_rows": {**DEFAULT_CAPTURE_OPTIONS["max_rows"], **options.get("max_rows", {})}}
+    return _options
+
+
+def capture_rows(db_type):
+    """Rows fetched and shown for a captured query on this db_type."""
+    return int(get_capture_options()["max_rows"].get(db_type.lower(), 20))
+
+
+def inject_limit(query, limit):
+    """
+    Appends LIMIT `limit` to the outermost SELECT of a query.
+
+    The query is returned unchanged when it is not a single SELECT / WITH statement or when its outermost
+    level already restricts the row count (LIMIT, FETCH or TOP). Literals, quoted identifiers, comments
+    and subqueries are skipped while looking for those keywords.
+    """
+    depth = 0
+    first_word = None
+    end = None            # end of the last significant token of the first statement
+    statement_closed = False
+    for match in _SQL_TOKENS.finditer(query):
+        kind = match.lastgroup
+        if kind in ("comment", "space"):
+            continue
+        if kind == "semi" and depth == 0:
+            statement_closed = True
+            continue
+        if statement_closed:
+            # A second statement: leave the script alone
+            return query
+        if kind == "open":
+            depth += 1
+        elif kind == "close":
+            depth -= 1
+        elif kind == "word":
+            word = match.group().upper()
+            if first_word is None:
+                first_word = word
+            if depth == 0 and word in _ROW_LIMIT_KEYWORDS:
+                return query
+        end = match.end()
+
+    if first_word not in ("SELECT", "WITH") or end is None or depth != 0:
+        return query
+    return f"{query[:end]}\nLIMIT {int(limit)}"
+
+
+def capture_footer(shown, total, columns, limited=False):
+    """
+    The dimension line of a captured result, e.g. "[1532 rows x 4 columns] (first 10 rows shown)".
+    `total` None means the true count is unknown (more than `shown` rows exist).
+    """
+    if total is None:
+        reason = ", LIMIT injected" if limited else ""
+        return f"[more than {shown} rows x {columns} columns] (first {shown} rows shown{reason})"
+    return f"[{total} rows x {columns} columns] (first {shown} rows shown)"
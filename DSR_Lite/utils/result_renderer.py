@@ -0,0 +1,180 @@
+import math
+
+# --- Lightweight result renderer ---
+# The executors used to build a pandas DataFrame for every successful query only to call to_string,
+# strip the blank lines and, for Snowflake and BigQuery, run the text through the tokenizer to cut it
+# at 4096 tokens. render_table produces the same layout straight from the row tuples:
+#
+#        name  total
+#   0   Alice   12.5
+#   1     Bob    3.0
+#   ..    ...    ...
+#   [1532 rows x 2 columns]
+#
+# - like DataFrame.to_string(max_rows=...), long results show the first and last rows around a "..." row;
+#   every column is shown, as to_string does, unless max_columns is set (then the first and last columns
+#   are shown around a "..." column) - the token budget bounds the width of wide results;
+# - floats share the number of decimals of their column (at most 6), NaN prints as NaN; None prints as
+#   None, also in a float column, where pandas printed NaN;
+# - cells longer than max_cell_width are cut with "...", line breaks inside a cell are escaped;
+# - rendering stops once the text reaches the token budget (estimated at CHARS_PER_TOKEN characters per
+#   token), so wide results never build strings that are thrown away afterwards.
+#
+# python -m utils.result_renderer runs a micro-benchmark against the pandas path.
+
+CHARS_PER_TOKEN = 3
+FLOAT_PRECISION = 6
+TRUNCATION_NOTE = "... (output truncated to fit the token budget)"
+
+
+def _format_float(value, decimals):
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "inf" if value > 0 else "-inf"
+    if abs(value) >= 1e16:
+        return f"{value:.{FLOAT_PRECISION}e}"
+    return f"{value:.{decimals}f}"
+
+
+def _float_decimals(values):
+    """Decimals needed by the most precise float of a column, between 1 and FLOAT_PRECISION."""
+    decimals = 1
+    for value in values:
+        if isinstance(value, float) and math.isfinite(value):
+            fraction = f"{value:.{FLOAT_PRECISION}f}".rstrip("0").split(".")[1]
+            decimals = max(decimals, len(fraction))
+    return decimals
+
+
+def _format_column(values, max_cell_width):
+    decimals = _float_decimals(values) if any(isinstance(v, float) for v in values) else None
+    cells = []
+    for value in values:
+        if value is None:
+            text = "None"
+        elif isinstance(value, float):
+            text = _format_float(value, decimals)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            text = repr(bytes(value))
+        else:
+            text = str(value)
+        if "\n" in text or "\r" in text:
+            text = text.replace("\r", "\\r").replace("\n", "\\n")
+        if max_cell_width and len(text) > max_cell_width:
+            text = text[:max(max_cell_width - 3, 1)] + "..."
+        cells.append(text)
+    return cells
+
+
+def _split(count, limit):
+    """(head, tail) sizes of a truncated axis, or (count, 0) when it fits."""
+    if not limit or count <= limit:
+        return count, 0
+    tail = limit // 2
+    return limit - tail, tail
+
+
+def render_table(rows, columns, max_rows=20, max_columns=0, max_cell_width=50, max_tokens=4096,
+                 total_rows=None, footer=None):
+    """
+    Renders query rows as text in the layout of DataFrame.to_string(index=True, show_dimensions=True).
+
+    Args:
+        rows (Sequence[tuple]): The fetched rows.
+        columns (list[str]): Column names.
+        max_rows (int): Rows shown; longer results show the first and last rows (0 shows all).
+        max_columns (int): Columns shown; wider results show the first and last columns (0 shows all).
+        max_cell_width (int): Longest cell text before it is cut with "..." (0 disables the limit).
+        max_tokens (int): Token budget of the returned text (0 disables the limit).
+        total_rows (int): Row count for the dimension line when it differs from len(rows).
+        footer (str): Replaces the dimension line (e.g. the note of a bounded capture).
+
+    Returns:
+        str: The table without blank lines.
+    """
+    rows = rows if isinstance(rows, (list, tuple)) else list(rows)
+    n_rows, n_cols = len(rows), len(columns)
+    head_rows, tail_rows = _split(n_rows, max_rows)
+    head_cols, tail_cols = _split(n_cols, max_columns)
+
+    row_ids = list(range(head_rows)) + list(range(n_rows - tail_rows, n_rows))
+    col_ids = list(range(head_cols)) + list(range(n_cols - tail_cols, n_cols))
+
+    # Cells are column-major so each column can share its float format and width
+    table = []
+    for c in col_ids:
+        cells = _format_column([rows[r][c] for r in row_ids], max_cell_width)
+        header = str(columns[c])
+        if max_cell_width and len(header) > max_cell_width:
+            header = header[:max(max_cell_width - 3, 1)] + "..."
+        table.append((header, cells))
+    if tail_cols:
+        table.insert(head_cols, ("...", ["..."] * len(row_ids)))
+
+    index = [str(r) for r in row_ids]
+    if tail_rows:
+        index.insert(head_rows, "..")
+        table = [(header, cells[:head_rows] + ["..."] + cells[head_rows:]) for header, cells in table]
+    index_width = max((len(i) for i in index), default=0)
+    widths = [max([len(header)] + [len(cell) for cell in cells]) for header, cells in table]
+
+    budget = max_tokens * CHARS_PER_TOKEN if max_tokens else None
+    lines = [" " * index_width + "".join("  " + header.rjust(w) for (header, _), w in zip(table, widths))]
+    used = len(lines[0]) + 1
+    for i, label in enumerate(index):
+        line = label.ljust(index_width) + "".join("  " + cells[i].rjust(w) for (_, cells), w in zip(table, widths))
+        if budget is not None and used + len(line) + 1 > budget:
+            lines.append(TRUNCATION_NOTE)
+            break
+        lines.append(line)
+        used += len(line) + 1
+
+    if footer is None:
+        footer = f"[{n_rows if total_rows is None else total_rows} rows x {n_cols} columns]"
+    lines.append(footer)
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # Micro-benchmark: render_table against DataFrame(...).to_string + blank-line removal, per result shape
+    import random
+    import re
+    import timeit
+
+    try:
+        import pandas as pd
+    except ImportError:
+        pd = None
+
+    random.seed(0)
+
+    def make_rows(n_rows, n_cols):
+        kinds = [int, float, str]
+        def cell(kind):
+            if kind is int:
+                return random.randint(0, 10 ** 6)
+            if kind is float:
+                return random.random() * 1000
+            return "".join(random.choice("abcdefghij") for _ in range(random.randint(3, 40)))
+        col_kinds = [kinds[c % 3] for c in range(n_cols)]
+        return [tuple(cell(k) for k in col_kinds) for _ in range(n_rows)], [f"col_{c}" for c in range(n_cols)]
+
+    def pandas_path(rows, columns):
+        df = pd.DataFrame(rows, columns=columns)
+        df_str = df.to_string(index=True, show_dimensions=True, max_rows=20)
+        return re.sub(r'\n\s*\n', '\n', df_str)
+
+    shapes = [("1 row x 3 cols", 1, 3), ("20 rows x 5 cols", 20, 5), ("21 rows x 40 cols", 21, 40),
+              ("1000 rows x 8 cols", 1000, 8), ("100000 rows x 4 cols", 100000, 4)]
+    print(f"{'shape':<22}{'render_table':>16}{'pandas':>16}{'speed-up':>10}")
+    for name, n_rows, n_cols in shapes:
+        rows, columns = make_rows(n_rows, n_cols)
+        number = max(1, 2000 // max(1, n_rows // 50))
+        ours = min(timeit.repeat(lambda: render_table(rows, columns), number=number, repeat=3)) / number
+        if pd is not None:
+            theirs = min(timeit.repeat(lambda: pandas_path(rows, columns), number=number, repeat=3)) / number
+            print(f"{name:<22}{ours * 1e6:>13.1f} us{theirs * 1e6:>13.1f} us{theirs / ours:>9.1f}x")
+        else:
+            print(f"{name:<22}{ours * 1e6:>13.1f} us{'(pandas not installed)':>26}")
+    print("\nExample:\n" + render_table(*make_rows(25, 4), max_rows=10))
@@ -0,0 +1,390 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from utils.DBsetup.Get_DB import read_db_options
+from utils.schema_store import META_KEYS, build_skeleton, compile_schema_store, open_schema_store
+from utils.schema_tokens import load_token_costs
+
+# --- In-memory schema catalog ---
+# M_Schema, M_Schema_sqlite, M_Schema_bigquery and the DDL generators used to json.load the whole
+# {db}_M-Schema.json and rebuild their lowercase name maps on every call, although process_entry and
+# SL_workflow render the same database several times per instance. A SchemaCatalog is loaded once per
+# schema file and kept in a bounded LRU; it holds the tables of the file together with prebuilt
+# case-insensitive indexes that every renderer reads:
+#   top_map     - top-level keys (SQLite database key, Snowflake schemas, BigQuery projects)
+#   dataset_map - Snowflake schemas / BigQuery datasets
+#   table_map   - table keys as they appear in the file ("SCHEMA.TABLE", "dataset.table" or "table")
+#   column_map  - per table, built on first use
+# A catalog whose file changed on disk is reloaded.
+#
+# Sharded series (TCGA, GA4 date partitions, ...) are stored once under a surrogate table whose
+# table_Information lists the similar tables. The reverse index (similar table -> surrogate) is built when
+# a catalog is loaded and persisted next to the schema as {db}_M-Schema.surrogates.json, stamped with the
+# size and mtime of the schema file; resolving a similar table is then a single dict lookup.
+#
+# With binary_store, a catalog is opened from the compiled {db}_M-Schema.bin of utils/schema_store.py
+# instead: only the directory (names, foreign keys) is parsed, and each table is decoded from the mapped
+# file the first time a renderer asks for it, so schema linking over a few tables of a 40 MB schema no
+# longer parses the rest. Stale or missing stores fall back to the JSON (and are compiled with
+# compile_on_load).
+#
+# token_costs serves the per-table token counts that the preprocessors store in
+# {db}_M-Schema.tokens.json (utils/schema_tokens.py); budget checks add them up instead of tokenizing.
+#
+# Options come from the "Options" entry of the Schema_catalog item in utils/DBsetup/DB.json:
+#   max_entries   - catalogs kept in memory
+#   max_memory_mb - estimated memory of all kept catalogs; least recently used ones are dropped above it
+#   binary_store    - open catalogs from the compiled schema store when it is up to date
+#   compile_on_load - write the store of a schema file that had to be parsed from JSON
+
+DEFAULT_CATALOG_OPTIONS = {
+    "max_entries": 32,
+    "max_memory_mb": 2048,
+    "binary_store": True,
+    "compile_on_load": True
+}
+
+SURROGATE_INDEX_SUFFIX = ".surrogates.json"
+MB = 1024 * 1024
+
+
+def _deep_sizeof(obj):
+    """Estimated memory of a parsed JSON document (containers and strings, shared objects counted once)."""
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+    return size
+
+
+class SchemaCatalog:
+    """
+    One {db}_M-Schema.json with case-insensitive indexes. Table records are either all in memory (parsed
+    JSON) or decoded on first access from a memory-mapped schema store.
+    """
+    def __init__(self, db_type, db_id, path, directory, records=None, store=None):
+        self.db_type = db_type
+        self.db_id = db_id
+        self.path = path
+        self.store = store
+        self.foreign_keys = directory["foreign_keys"]
+        self.top_map = {}
+        self.dataset_map = {}
+        self.table_map = {}
+        self._records = records  # every record when loaded from JSON, None when read from the store
+        self._decoded = {}       # record index -> decoded record (store only)
+        self._decoded_bytes = 0
+        self._decode_lock = threading.Lock()
+        self._tables = []        # (top_key, dataset_key, table_key, non_empty, record index) in file order
+        self._index = {}         # (top_key or None, table_key) -> record index
+        self._datasets = {}      # (top_key or None, dataset_key) -> record index of its table_Information
+        self._column_maps = {}
+        self._column_maps_lock = threading.Lock()
+        self._surrogates = {}    # (top_key or None, dataset_key) -> {similar table (lowercase): surrogate}
+        self._token_costs = None # (top_key or None, table_key) -> precomputed token counts, loaded on first use
+        self._token_costs_lock = threading.Lock()
+
+        for top_key in directory["tops"]:
+            self.top_map[top_key.lower()] = top_key
+        for i, (top_key, dataset_key, table_key, non_empty) in enumerate(directory["tables"]):
+            self.table_map[table_key.lower()] = table_key
+            self._tables.append((top_key, dataset_key, table_key, non_empty, i))
+            self._index[(top_key, table_key)] = self._index[(None, table_key)] = i
+        n_tables = len(directory["tables"])
+        for j, (top_key, dataset_key) in enumerate(directory["datasets"]):
+            self.dataset_map[dataset_key.lower()] = dataset_key
+            self._datasets[(top_key, dataset_key)] = self._datasets[(None, dataset_key)] = n_tables + j
+
+        if db_type != "sqlite":
+            self._load_surrogate_index()
+
+        self._base_bytes = _deep_sizeof(records or []) + _deep_sizeof(
+            [self.foreign_keys, self.top_map, self.dataset_map, self.table_map, self._tables,
+             list(self._index), self._surrogates])
+
+    @property
+    def memory_bytes(self):
+        """Estimated memory of the indexes and of the records held in memory (mapped store pages excluded)."""
+        return self._base_bytes + self._decoded_bytes
+
+    def _record(self, index):
+        if self._records is not None:
+            return self._records[index]
+        record = self._decoded.get(index)
+        if record is None:
+            record = self.store.record(index)
+            with self._decode_lock:
+                if index not in self._decoded:
+                    self._decoded[index] = record
+                    self._decoded_bytes += _deep_sizeof(record)
+                record = self._decoded[index]
+        return record
+
+    def _build_surrogate_index(self):
+        index = {}
+        for (top_key, dataset_key), record_index in self._datasets.items():
+            if top_key is None:
+                continue
+            reverse = {}
+            for surrogate, similar_tables in self._record(record_index).items():
+                # Compatible with both list and dict formats
+                if isinstance(similar_tables, dict):
+                    tables = similar_tables.get("similar_tables", [])
+                elif isinstance(similar_tables, list):
+                    tables = similar_tables
+                else:
+                    tables = []
+                for table in tables:
+                    # The first surrogate that lists a table wins, like the former linear scan
+                    reverse.setdefault(table.lower(), surrogate)
+            if reverse:
+                index.setdefault(top_key, {})[dataset_key] = reverse
+        return index
+
+    def _load_surrogate_index(self):
+        """Reads the persisted reverse index when it matches the schema file, otherwise builds and writes it."""
+        index_path = self.path[:-len(".json")] + SURROGATE_INDEX_SUFFIX if self.path.endswith(".json") else None
+        try:
+            stat = os.stat(self.path)
+            source = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        except OSError:
+            index_path, source = None, None
+
+        index = None
+        if index_path and os.path.exists(index_path):
+            try:
+                with open(index_path, 'r', encoding='utf-8') as f:
+                    persisted = json.load(f)
+                if persisted.get("source") == source:
+                    index = persisted["index"]
+            except (OSError, ValueError, KeyError):
+                index = None
+
+        if index is None:
+            index = self._build_surrogate_index()
+            if index_path:
+                try:
+                    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        json.dump({"source": source, "index": index}, f, ensure_ascii=False)
+                    os.replace(tmp_path, index_path)
+                except OSError as e:
+                    # A read-only dataset directory only costs the rebuild on the next run
+                    print(f"[Schema catalog] Could not persist the surrogate index {index_path}: {e}")
+
+        for top_key, datasets in index.items():
+            for dataset_key, reverse in datasets.items():
+                self._surrogates[(top_key, dataset_key)] = self._surrogates[(None, dataset_key)] = reverse
+
+    @classmethod
+    def load(cls, db_type, db_id, path, binary_store=False, compile_on_load=False):
+        """
+        Loads a schema file, from its compiled store when `binary_store` is set and the store is up to date.
+        With `compile_on_load`, a missing or stale store is written after the JSON was parsed.
+        """
+        if binary_store:
+            store = open_schema_store(path)
+            if store is not None:
+                return cls(db_type, db_id, path, store.directory, store=store)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            raise RuntimeError(f"Failed to load or parse JSON from {path}: {str(e)}")
+        if not isinstance(data, dict):
+            raise ValueError(f"JSON file {path} is empty or invalid.")
+        if binary_store and compile_on_load:
+            try:
+                compile_schema_store(db_type, db_id, path, data=data)
+            except OSError as e:
+                print(f"[Schema catalog] Could not compile the schema store of {path}: {e}")
+        directory, records = build_skeleton(db_type, db_id, data)
+        return cls(db_type, db_id, path, directory, records=records)
+
+    def iter_tables(self, top_key=None):
+        """
+        Yields (top_key, dataset_key, table_key, columns) of every table in file order, optionally of one
+        top-level key only. dataset_key is None for SQLite.
+        """
+        for top, dataset, table_key, _, index in self._tables:
+            if top_key is None or top == top_key:
+                yield top, dataset, table_key, self._record(index)["columns"]
+
+    def has_table(self, table_key, top_key=None):
+        return (top_key, table_key) in self._index
+
+    def columns(self, table_key, top_key=None):
+        """The column entries of a table (the lists of the schema file), or [] when it is unknown."""
+        index = self._index.get((top_key, table_key))
+        return self._record(index)["columns"] if index is not None else []
+
+    def column_map(self, table_key, top_key=None):
+        """Lowercase column name -> column entry of a table."""
+        key = (top_key, table_key)
+        column_map = self._column_maps.get(key)
+        if column_map is None:
+            column_map = {col[0].lower(): col for col in self.columns(table_key, top_key)
+                          if isinstance(col, list) and col}
+            with self._column_maps_lock:
+                self._column_maps[key] = column_map
+        return column_map
+
+    def description(self, table_key, top_key=None):
+        """The table_description_summary entry of a table, or None."""
+        index = self._index.get((top_key, table_key))
+        return self._record(index)["description"] if index is not None else None
+
+    def table_information(self, dataset_key, top_key=None):
+        """The table_Information (surrogate -> similar tables) of a Snowflake schema / BigQuery dataset."""
+        index = self._datasets.get((top_key, dataset_key))
+        return self._record(index) if index is not None else {}
+
+    def resolve_surrogate(self, table_id, dataset_key, top_key=None):
+        """
+        The surrogate whose table_Information lists `table_id` ("schema.table" / "dataset.table", any case)
+        in the given Snowflake schema / BigQuery dataset, or None.
+        """
+        return self._surrogates.get((top_key, dataset_key), {}).get(table_id.lower())
+
+    def iter_table_keys(self):
+        """Yields (top_key, dataset_key, table_key) of every table in file order without decoding it."""
+        for top, dataset, table_key, _, _ in self._tables:
+            yield top, dataset, table_key
+
+    def token_costs(self, table_key, top_key=None):
+        """
+        The precomputed token counts of a table ({db}_M-Schema.tokens.json, see utils/schema_tokens.py),
+        or None when the schema file has no up-to-date sidecar.
+        """
+        if self._token_costs is None:
+            with self._token_costs_lock:
+                if self._token_costs is None:
+                    index = {}
+                    for top, tables in (load_token_costs(self.path) or {}).items():
+                        for key, costs in tables.items():
+                            index[(top, key)] = index[(None, key)] = costs
+                    self._token_costs = index
+        return self._token_costs.get((top_key, table_key))
+
+    def table_names(self, non_empty=True):
+        """Table keys in file order, by default without the tables that have no columns."""
+        return [table_key for _, _, table_key, has_columns, _ in self._tables if has_columns or not non_empty]
+
+
+class SchemaCatalogCache:
+    """A bounded LRU of SchemaCatalog objects keyed by schema file."""
+    def __init__(self, max_entries=DEFAULT_CATALOG_OPTIONS["max_entries"],
+                 max_memory_mb=DEFAULT_CATALOG_OPTIONS["max_memory_mb"],
+                 binary_store=DEFAULT_CATALOG_OPTIONS["binary_store"],
+                 compile_on_load=DEFAULT_CATALOG_OPTIONS["compile_on_load"]):
+        self.binary_store = binary_store
+        self.compile_on_load = compile_on_load
+        self.max_entries = max(1, int(max_entries))
+        self.max_bytes = int(max_memory_mb * MB)
+        self._entries = OrderedDict()   # path -> (mtime, catalog)
+        self._lock = threading.Lock()
+        self._loading = {}
+        self.stats = {"hits": 0, "misses": 0, "reloads": 0, "evictions": 0, "load_seconds": 0.0, "store_loads": 0}
+
+    def get(self, db_type, db_id, path):
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == mtime:
+                self._entries.move_to_end(path)
+                self.stats["hits"] += 1
+                return entry[1]
+            self.stats["misses"] += 1
+            self.stats["reloads"] += int(entry is not None)
+            # One loader per file; concurrent callers of the same database wait for it
+            load_lock = self._loading.setdefault(path, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(path)
+                if entry is not None and entry[0] == mtime:
+                    return entry[1]
+            start = time.perf_counter()
+            catalog = SchemaCatalog.load(db_type, db_id, path, self.binary_store, self.compile_on_load)
+            with self._lock:
+                self.stats["load_seconds"] += time.perf_counter() - start
+                self.stats["store_loads"] += int(catalog.store is not None)
+                self._entries[path] = (mtime, catalog)
+                self._entries.move_to_end(path)
+                self._evict()
+        return catalog
+
+    def _evict(self):
+        # The catalog just added is kept even when it alone exceeds the memory limit
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or
+                                          self.memory_bytes() > self.max_bytes):
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def memory_bytes(self):
+        return sum(catalog.memory_bytes for _, catalog in self._entries.values())
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {**self.stats,
+                    "load_seconds": round(self.stats["load_seconds"], 3),
+                    "catalogs": len(self._entries),
+                    "memory_mb": round(self.memory_bytes() / MB, 1),
+                    "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else 0.0}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_catalog_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                options = {**DEFAULT_CATALOG_OPTIONS, **read_db_options("schema_catalog")}
+                _cache = SchemaCatalogCache(options["max_entries"], options["max_memory_mb"],
+                                            options["binary_store"], options["compile_on_load"])
+    return _cache
+
+
+def get_schema_catalog(db_type, db_id, path):
+    """
+    Returns the catalog of a schema file from the process-wide LRU, loading it on first use.
+
+    Args:
+        db_type (str): sqlite, snow or bigquery (selects the layout of the file).
+        db_id (str): The database id the file belongs to.
+        path (str): Path of the {db}_M-Schema.json file.
+
+    Returns:
+        SchemaCatalog
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Schema file not found: {path}")
+    return get_catalog_cache().get(db_type, db_id, path)
+
+
+def get_schema_catalog_stats():
+    """Returns hits, misses, evictions, load time and the estimated memory of the kept catalogs."""
+    return get_catalog_cache().get_stats() if _cache is not None else {}
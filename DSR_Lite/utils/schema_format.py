@@ -0,0 +1,173 @@
+import re
+
+# --- Schema formatting ---
+# How one table of a {db}_M-Schema.json is written into a prompt, shared by the renderers of
+# utils/Database_Interface.py (M_Schema, generate_ddl_from_json), the budgeted pruning of
+# utils/schema_pruning.py and the token costs that utils/schema_tokens.py precomputes for every table.
+# Keeping these in one dependency-free module is what lets the preprocessors count exactly the text the
+# renderers later produce.
+#
+# An M-Schema layout is {"db_type", "header": [lines], "tables": [table], "foreign_keys": [lines]}, where a
+# table is {"name", "top", "key", "found", "columns", "description", "similar_tables"} and a column
+# {"name", "head", "key", "description", "examples"} (the parts of its "(...)" line).
+
+SIMILAR_TABLES_PREFIX = "# Similar tables with the same columns: "
+
+SNOW_DDL_TYPES = {
+    "TEXT": "TEXT",
+    "NUMBER": "INTEGER",
+    "FLOAT": "REAL",
+    "DATE": "DATE",
+    "TIME": "TIME"
+}
+
+BIGQUERY_DDL_TYPES = {
+    "STRING": "STRING", "TEXT": "STRING",
+    "NUMBER": "INT64", "INTEGER": "INT64",
+    "FLOAT": "FLOAT64", "REAL": "FLOAT64",
+    "DATE": "DATE", "TIME": "TIME",
+    "TIMESTAMP": "TIMESTAMP", "DATETIME": "DATETIME",
+    "BOOLEAN": "BOOL", "GEOGRAPHY": "GEOGRAPHY",
+}
+COMPLEX_TYPE_LENGTH_THRESHOLD = 50
+PLACEHOLDER_COMPLEX_TYPE = "COMPLEX_TYPE" #Nested types are uniformly referred to as COMPLEX_TYPE.
+
+
+def clean_table_name(table_name):
+    table_name = str(table_name)
+    table_name = table_name.replace('"', '')
+    table_name = re.sub(r'\d+', '', table_name)
+    table_name = table_name.lower()
+    return table_name
+
+
+def mschema_column(db_type, col_info):
+    """
+    Splits a column entry of the schema file into the parts M-Schema renders, or None when the entry is
+    skipped. SQLite entries are [name, pk, type, description, examples], Snowflake / BigQuery entries
+    [name, type, description, examples].
+    """
+    if db_type == "sqlite":
+        col_name, pk_info, col_type, col_desc, col_examples = col_info
+        head = f"{col_name}: {col_type}"
+        if pk_info == "Primary Key":
+            head += ", Primary Key"
+        return {"name": col_name, "head": head, "key": pk_info == "Primary Key",
+                "description": col_desc or None,
+                "examples": f"Examples: [{col_examples}]" if col_examples else None}
+    if len(col_info) < 4:
+        return None
+    col_name, col_type, col_desc, col_examples = col_info
+    example_text = col_examples.replace("examples:", "").strip() if col_examples else ""
+    return {"name": col_name, "head": f"{col_name}: {col_type}", "key": False,
+            "description": col_desc.strip() if col_desc and col_desc.strip() else None,
+            "examples": f"Examples: {example_text}" if example_text else None}
+
+
+def layout_table(db_type, full_table_name, column_details, table_description=None, key=None, top=None):
+    """
+    A table of an M-Schema layout. `key` / `top` are the table key and top-level key of the schema file
+    (top None when the renderer looked the table up without it).
+    """
+    columns = [mschema_column(db_type, col_info) for col_info in column_details or []]
+    return {"name": full_table_name, "top": top, "key": key, "found": bool(column_details),
+            "columns": [col for col in columns if col is not None],
+            "description": table_description or None, "similar_tables": []}
+
+
+def mschema_indent(db_type):
+    return "" if db_type == "sqlite" else "  "
+
+
+def render_mschema_column(column, indent=""):
+    parts = [column["head"], column["description"], column["examples"]]
+    return f"{indent}({', '.join(part for part in parts if part)})"
+
+
+def render_mschema_table(db_type, table):
+    """The lines of one table of an M-Schema layout."""
+    indent = mschema_indent(db_type)
+    table_lines = [f"# Table: {table['name']}", "["]
+    if not table["found"] and db_type != "sqlite":
+        table_lines.append(f"  (Detailed column information not found for table)")
+    col_lines = [render_mschema_column(column, indent) for column in table["columns"]]
+    for i, line in enumerate(col_lines):
+        table_lines.append(line + ("," if i < len(col_lines) - 1 else ""))
+    table_lines.append("]")
+    if table["description"] and db_type != "sqlite":
+        table_lines.append(f"# Table Description: {table['description']}")
+    if table["similar_tables"]:
+        table_lines.append(SIMILAR_TABLES_PREFIX + ", ".join(table["similar_tables"]))
+    return table_lines
+
+
+def render_mschema(layout):
+    """Formats an M-Schema layout (Database_Interface.M_Schema_layout) as the text M_Schema returns."""
+    lines = list(layout["header"])
+    for table in layout["tables"]:
+        lines.extend(render_mschema_table(layout["db_type"], table))
+    if layout["foreign_keys"]:
+        lines.append("[Foreign keys]")
+        lines.extend(layout["foreign_keys"])
+    return "\n".join(lines)
+
+
+def snow_table_ddl(full_table_name, columns, summary_text=None):
+    """The CREATE TABLE statement generate_ddl_from_json writes for a Snowflake table."""
+    # Note: We use the original db_id and table_name here to generate the DDL
+    fully_qualified_table_name_quoted = f'"{full_table_name}"'
+    create_statement = f'CREATE TABLE {fully_qualified_table_name_quoted} (\n'
+
+    column_definitions = []
+    # Iterate through columns to define them
+    for col_info in columns:
+        if not isinstance(col_info, list) or len(col_info) < 2:
+            continue
+
+        col_name = col_info[0]
+        col_type = col_info[1]
+        sql_type = SNOW_DDL_TYPES.get(col_type.upper(), col_type)
+
+        col_def = f'    "{col_name}" {sql_type}'
+        column_definitions.append(col_def)
+
+    create_statement += ',\n'.join(column_definitions)
+    create_statement += '\n);\n'
+
+    # Add table summary as a comment if it exists
+    if summary_text:
+        summary_comment = f"\n/*\n{summary_text.strip()}\n*/\n"
+        create_statement += summary_comment
+    return create_statement
+
+
+def bigquery_table_ddl(full_table_name, columns, summary_text=None):
+    """The CREATE TABLE statement generate_ddl_from_json_bigquery writes, or None for a table without columns."""
+    fully_qualified_table_name_quoted = f'`{full_table_name}`'
+    create_statement = f'CREATE TABLE {fully_qualified_table_name_quoted} (\n'
+
+    column_definitions = []
+    for col_info in columns:
+        if not isinstance(col_info, list) or len(col_info) < 2: continue
+
+        col_name = col_info[0]
+        col_type = col_info[1]
+        sql_type = ""
+        if col_type and len(col_type) > COMPLEX_TYPE_LENGTH_THRESHOLD:
+            sql_type = PLACEHOLDER_COMPLEX_TYPE
+        else:
+            sql_type = BIGQUERY_DDL_TYPES.get(col_type.upper(), col_type.upper()) if col_type else "UNKNOWN"
+
+        col_def = f'    `{col_name}` {sql_type}'
+        column_definitions.append(col_def)
+
+    if not column_definitions:
+        return None
+
+    create_statement += ',\n'.join(column_definitions)
+    create_statement += '\n);\n'
+
+    if summary_text:
+        summary_comment = f"\n/*\n{summary_text.strip()}\n*/\n"
+        create_statement += summary_comment
+    return create_statement
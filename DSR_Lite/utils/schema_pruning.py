@@ -0,0 +1,457 @@
+import re
+import threading
+from functools import lru_cache
+
+from utils.DBsetup.Get_DB import read_db_options
+from utils.Database_Interface import M_Schema_layout, get_catalog, generate_ddl_from_json
+from utils.schema_format import SIMILAR_TABLES_PREFIX, clean_table_name, mschema_indent, render_mschema, render_mschema_column
+from utils.mytoken.deepseek_tokenizer import get_token_count, get_token_counts
+
+# --- Token-budgeted schema pruning ---
+# process_entry used to send the full M-Schema when it fit MAX_MSchema_TOKEN and fall back to plain DDL
+# otherwise, losing descriptions and examples of every table because of a few large ones. prune_schema
+# instead shrinks the M-Schema layout (Database_Interface.M_Schema_layout) step by step until it fits:
+#   examples     - "Examples: ..." of the columns
+#   descriptions - column descriptions, then table descriptions
+#   columns      - columns that are neither relevant to the question nor primary keys, keeping at least
+#                  min_columns per table
+#   series       - tables whose name only differs in digits and that have the same columns are listed
+#                  under the first one ("# Similar tables with the same columns: ...")
+# A column is relevant when schema linking returned it (entry["col"] or the rounds of
+# entry["sample_history"]) or when a word of its name occurs in the question or evidence; schema linking
+# often returns tables without columns, so the word overlap is what usually keeps a column. Within a step,
+# the least relevant elements go first: other columns before primary keys before relevant ones (among the
+# others, those whose description shares fewer words with the question first), tables without relevant
+# columns before the others, later tables and columns before earlier ones.
+# Tables selected by schema linking (entry["table"]) are only folded into a series after every step has
+# run out, the other tables of a series go first.
+#
+# Every line, description and example block has a token count, precomputed by the preprocessors in
+# {db}_M-Schema.tokens.json (utils/schema_tokens.py) or, for elements without one, taken in one batch
+# tokenizer call. The size is tracked as the sum of the kept elements plus what render_mschema puts
+# between them (a newline between lines, a "," after every column of a table but the last) and the
+# special tokens of the exact count, so a step stops as soon as the schema fits the budget. Only a schema whose estimate is within confirm_margin of the budget is counted
+# exactly; when the exact count is still above the budget, pruning continues by the difference (at most
+# max_rounds times).
+#
+# measured_mschema and ddl_token_count answer the max_token checks of SL_workflow the same way: a sum
+# over the selected tables, with the tokenizer only near the threshold.
+#
+# Options come from the "Options" entry of the Schema_pruning item in utils/DBsetup/DB.json:
+#   stages         - the steps above, in the order they are applied
+#   min_columns    - columns kept per table by the "columns" step
+#   confirm_margin - fraction of the budget below which the estimate is trusted without an exact count
+#   max_rounds     - exact counts per schema before the pruned schema is returned as it is
+
+DEFAULT_PRUNING_OPTIONS = {
+    "stages": ["examples", "descriptions", "columns", "series"],
+    "min_columns": 1,
+    "confirm_margin": 0.05,
+    "max_rounds": 4
+}
+
+_options = None
+_stats = {"schemas": 0, "pruned": 0, "over_budget": 0, "exact_counts": 0, "tables": 0, "precomputed_tables": 0,
+          "size_checks": 0, "removed": {}}
+_stats_lock = threading.Lock()
+
+
+def get_pruning_options():
+    global _options
+    if _options is None:
+        _options = {**DEFAULT_PRUNING_OPTIONS, **read_db_options("schema_pruning")}
+    return _options
+
+
+_STOP_WORDS = {"a", "an", "and", "are", "as", "at", "be", "by", "each", "for", "from", "how", "in", "is", "it",
+               "its", "of", "on", "or", "per", "that", "the", "their", "them", "then", "this", "to", "was",
+               "were", "what", "when", "where", "which", "who", "with"}
+
+
+def _terms(text):
+    """Lowercase words of a text or identifier (split on non-letters and camelCase), without plural "s"."""
+    words = re.findall(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+', str(text or ""))
+    terms = set()
+    for word in words:
+        word = word.lower()
+        if len(word) < 2 or word in _STOP_WORDS:
+            continue
+        terms.add(word[:-1] if len(word) > 3 and word.endswith('s') and not word.endswith('ss') else word)
+    return terms
+
+
+def linked_columns(col=None, sample_history=None):
+    """
+    Columns returned by schema linking for a question: entry["col"] merged with the {table: [columns]} of
+    every round of entry["sample_history"].
+
+    Returns:
+        dict: {table: [columns]}
+    """
+    linked = {}
+    rounds = list(sample_history.values()) if isinstance(sample_history, dict) else []
+    for tables in [col] + rounds:
+        if not isinstance(tables, dict):
+            continue
+        for table, columns in tables.items():
+            merged = linked.setdefault(table, [])
+            merged += [c for c in columns or [] if c not in merged]
+    return linked
+
+
+def _relevance_map(relevant_columns):
+    """
+    Lowercase table name -> lowercase linked columns, from the {table: [columns]} of schema linking.
+    Tables are also registered under their name without the database / project prefix.
+    """
+    relevance = {}
+    if not isinstance(relevant_columns, dict):
+        return relevance
+    for table, columns in relevant_columns.items():
+        names = {str(col).lower() for col in columns or []}
+        parts = table.lower().split('.')
+        for i in range(len(parts)):
+            relevance.setdefault('.'.join(parts[i:]), set()).update(names)
+    return relevance
+
+
+class _Pruner:
+    def __init__(self, layout, relevant_columns, options, count, table_costs=None, question=None,
+                 selected_tables=None, special_tokens=0):
+        self.options = options
+        self.count = count
+        self.db_type = layout["db_type"]
+        indent = mschema_indent(self.db_type)
+        # Copies of the tables and columns, the caller's layout is not modified
+        self.layout = {**layout, "tables": [{**table, "columns": [dict(col) for col in table["columns"]],
+                                             "similar_tables": list(table["similar_tables"])}
+                                            for table in layout["tables"]]}
+        self.removed_tables = set()
+        self.removed = {}
+        self.precomputed_tables = 0
+        # Series are grouped by the columns of the schema file, not by what is left after pruning
+        self.column_names = [tuple(col["name"].lower() for col in table["columns"]) for table in layout["tables"]]
+
+        costs, texts, pending = [], [], []
+
+        def add(text, known=None):
+            # Precomputed counts (utils/schema_tokens.py) are used as they are, the rest is counted below
+            costs.append(known or None)
+            if not known:
+                texts.append(text)
+                pending.append(len(costs) - 1)
+            return len(costs) - 1
+
+        newline, comma = add("\n"), add(",")
+        fixed = [add(line) for line in layout["header"]]
+        if layout["foreign_keys"]:
+            fixed += [add("[Foreign keys]")] + [add(line) for line in layout["foreign_keys"]]
+        table_frags, column_frags = [], []
+        for table in self.layout["tables"]:
+            entry = table_costs(table["key"], table["top"]) if table_costs and table.get("key") else None
+            self.precomputed_tables += int(entry is not None)
+            entry = entry or {"name": None, "description": None, "columns": {}}
+            base = [add(f"# Table: {table['name']}", entry["name"]), add("["), add("]")]
+            if not table["found"] and self.db_type != "sqlite":
+                base.append(add("  (Detailed column information not found for table)"))
+            if table["similar_tables"]:
+                base.append(add(SIMILAR_TABLES_PREFIX + ", ".join(table["similar_tables"])))
+            description = add(f"# Table Description: {table['description']}", entry["description"]) \
+                if table["description"] and self.db_type != "sqlite" else None
+            table_frags.append((base, description))
+            columns = []
+            for col in table["columns"]:
+                known = entry["columns"].get(col["name"]) or [None, None, None]
+                columns.append((add(render_mschema_column({**col, "description": None, "examples": None}, indent), known[0]),
+                                add(", " + col["description"], known[1]) if col["description"] else None,
+                                add(", " + col["examples"], known[2]) if col["examples"] else None))
+            column_frags.append(columns)
+        # Repeated fragments ("[", "]", common column lines) are counted once
+        unique = list(dict.fromkeys(texts))
+        counted = dict(zip(unique, count(unique)))
+        for i, text in zip(pending, texts):
+            costs[i] = counted[text]
+
+        # Every line costs the newline that joins it to the next one; the last line has none
+        self.newline_cost = costs[newline]
+
+        def line_cost(i):
+            return costs[i] + costs[newline]
+
+        self.estimate = special_tokens - costs[newline] + sum(line_cost(i) for i in fixed)
+        self.table_cost, self.description_cost, self.column_cost = [], [], []
+        for (base, description), columns in zip(table_frags, column_frags):
+            # Every column line is costed with its ",", the table gives back the one its last column has not
+            # (the "columns" step keeps at least one column per table)
+            self.table_cost.append(sum(line_cost(i) for i in base) - (costs[comma] if columns else 0))
+            self.description_cost.append(line_cost(description) if description is not None else 0)
+            self.column_cost.append([[line_cost(line) + costs[comma], costs[desc] if desc is not None else 0,
+                                      costs[examples] if examples is not None else 0]
+                                     for line, desc, examples in columns])
+            self.estimate += self.table_cost[-1] + self.description_cost[-1] + sum(map(sum, self.column_cost[-1]))
+
+        # Relevance: 2 = linked by schema linking or named in the question, 1 = primary key, 0 = other.
+        # Other columns are ordered by the question words in their description; tables with relevant
+        # columns rank higher.
+        relevance = _relevance_map(relevant_columns)
+        selected = _relevance_map({table: [] for table in selected_tables or []})
+        words = _terms(question)
+        self.column_rank, self.column_score, self.table_rank, self.selected = [], [], [], []
+        for table in self.layout["tables"]:
+            name = table["name"].lower()
+            linked = relevance.get(name)
+            if linked is None:
+                linked = relevance.get(name.split('.')[-1])
+            self.selected.append(name in selected or name.split('.')[-1] in selected)
+            ranks = [2 if (linked and col["name"].lower() in linked) or _terms(col["name"]) & words
+                     else int(col["key"]) for col in table["columns"]]
+            self.column_rank.append(ranks)
+            self.column_score.append([len(_terms(col["description"]) & words) if words and col["description"] else 0
+                                      for col in table["columns"]])
+            self.table_rank.append(int(linked is not None or 2 in ranks or bool(_terms(name.split('.')[-1]) & words)))
+
+    def _column_order(self):
+        """(table, column) positions, least relevant first."""
+        positions = [(t, c) for t, ranks in enumerate(self.column_rank) for c in range(len(ranks))]
+        return sorted(positions, key=lambda p: (self.column_rank[p[0]][p[1]], self.column_score[p[0]][p[1]],
+                                                self.table_rank[p[0]], -p[0], -p[1]))
+
+    def _count(self, stage):
+        self.removed[stage] = self.removed.get(stage, 0) + 1
+
+    def _examples(self):
+        for t, c in self._column_order():
+            column = self.layout["tables"][t]["columns"][c]
+            if column is not None and column["examples"]:
+                column["examples"] = None
+                self.estimate -= self.column_cost[t][c][2]
+                self.column_cost[t][c][2] = 0
+                self._count("examples")
+                yield
+
+    def _descriptions(self):
+        for t, c in self._column_order():
+            column = self.layout["tables"][t]["columns"][c]
+            if column is not None and column["description"]:
+                column["description"] = None
+                self.estimate -= self.column_cost[t][c][1]
+                self.column_cost[t][c][1] = 0
+                self._count("descriptions")
+                yield
+        for t in sorted(range(len(self.table_rank)), key=lambda t: (self.table_rank[t], -t)):
+            table = self.layout["tables"][t]
+            if table["description"] and self.db_type != "sqlite":
+                table["description"] = None
+                self.estimate -= self.description_cost[t]
+                self.description_cost[t] = 0
+                self._count("descriptions")
+                yield
+
+    def _columns(self):
+        min_columns = max(1, int(self.options["min_columns"]))
+        kept = [len(table["columns"]) for table in self.layout["tables"]]
+        for t, c in self._column_order():
+            if self.column_rank[t][c] > 0:
+                break
+            columns = self.layout["tables"][t]["columns"]
+            if columns[c] is None or kept[t] <= min_columns:
+                continue
+            # Dropped columns stay as None until rendering, so the positions of the others do not move
+            columns[c] = None
+            kept[t] -= 1
+            self.estimate -= sum(self.column_cost[t][c])
+            self._count("columns")
+            yield
+
+    def _series(self, selected=False):
+        """Folds the tables of a series into its head; selected tables only when `selected` is set."""
+        tables = self.layout["tables"]
+        groups = {}
+        for t, table in enumerate(tables):
+            key = (re.sub(r'\d+', '', table["name"].lower()), self.column_names[t])
+            groups.setdefault(key, []).append(t)
+        members = {}
+        for group in groups.values():
+            # The head is the first selected table of the series, or its first table
+            head = next((t for t in group if self.selected[t]), group[0])
+            members.update({t: head for t in group if t != head and t not in self.removed_tables
+                            and self.selected[t] == selected})
+        if not members:
+            return
+        names = sorted(set(members) | set(members.values()))
+        note_costs = self.count([SIMILAR_TABLES_PREFIX + tables[t]["name"] for t in names] +
+                                [", " + tables[t]["name"] for t in names])
+        position = {table["name"]: t for t, table in enumerate(tables)}
+        first_cost = dict(zip(names, note_costs[:len(names)]))
+        next_cost = dict(zip(names, note_costs[len(names):]))
+        for t in sorted(members, key=lambda t: (self.table_rank[t], -t)):
+            head = members[t]
+            self.estimate -= self.table_cost[t] + self.description_cost[t] + sum(
+                sum(cost) for c, cost in enumerate(self.column_cost[t]) if tables[t]["columns"][c] is not None)
+            self.estimate += next_cost[t] if tables[head]["similar_tables"] else first_cost[t] + self.newline_cost
+            tables[head]["similar_tables"].append(tables[t]["name"])
+            tables[head]["similar_tables"].sort(key=position.get)
+            self.removed_tables.add(t)
+            self._count("series")
+            yield
+
+    def actions(self):
+        stages = {"examples": self._examples, "descriptions": self._descriptions,
+                  "columns": self._columns, "series": self._series}
+        for stage in self.options["stages"]:
+            yield from stages[stage]()
+        # Tables selected by schema linking are only folded once nothing else is left to prune
+        if "series" in self.options["stages"]:
+            yield from self._series(selected=True)
+
+    def render(self):
+        tables = [{**table, "columns": [col for col in table["columns"] if col is not None]}
+                  for t, table in enumerate(self.layout["tables"]) if t not in self.removed_tables]
+        return render_mschema({**self.layout, "tables": tables})
+
+
+def prune_schema(layout, budget, relevant_columns=None, options=None, count=get_token_counts, exact_count=get_token_count,
+                 table_costs=None, question=None, selected_tables=None):
+    """
+    Shrinks an M-Schema layout until it fits a token budget.
+
+    Args:
+        layout (dict): The layout of Database_Interface.M_Schema_layout.
+        budget (int): Maximum token count of the rendered schema.
+        relevant_columns (dict): {table: [columns]} linked to the question (see linked_columns), or None.
+        options (dict): Overrides of the Schema_pruning options.
+        count (callable): Token counts of a list of fragments.
+        exact_count (callable): Exact token count of the rendered schema.
+        table_costs (callable): (table_key, top_key) -> precomputed counts (SchemaCatalog.token_costs), or None.
+        question (str): Question and evidence; columns named in it are kept like linked ones.
+        selected_tables (list): Tables selected by schema linking (entry["table"]), folded into a series last.
+
+    Returns:
+        tuple: (schema_text, report) where report holds the token count, whether it is exact, whether the
+        schema fits and the number of elements removed per step.
+    """
+    options = {**get_pruning_options(), **(options or {})}
+    pruner = _Pruner(layout, relevant_columns, options, count, table_costs, question, selected_tables,
+                     special_tokens=exact_count(""))
+    actions = pruner.actions()
+    target = budget
+    exhausted = False
+    exact = None
+    for _ in range(max(1, int(options["max_rounds"]))):
+        while pruner.estimate > target and not exhausted:
+            exhausted = next(actions, StopIteration) is StopIteration
+        text = pruner.render()
+        if pruner.estimate <= budget * (1 - options["confirm_margin"]):
+            exact = None
+            break
+        exact = exact_count(text)
+        with _stats_lock:
+            _stats["exact_counts"] += 1
+        if exact <= budget or exhausted:
+            break
+        # The estimate was low by (exact - budget); prune that much further
+        target = pruner.estimate - (exact - budget)
+
+    tokens = exact if exact is not None else pruner.estimate
+    report = {"tokens": tokens, "exact": exact is not None, "within_budget": tokens <= budget,
+              "removed": dict(pruner.removed), "precomputed_tables": pruner.precomputed_tables}
+    with _stats_lock:
+        _stats["schemas"] += 1
+        _stats["pruned"] += int(bool(pruner.removed))
+        _stats["over_budget"] += int(tokens > budget)
+        _stats["precomputed_tables"] += pruner.precomputed_tables
+        _stats["tables"] += len(layout["tables"])
+        for stage, n in pruner.removed.items():
+            _stats["removed"][stage] = _stats["removed"].get(stage, 0) + n
+    return text, report
+
+
+def budgeted_mschema(db_id, SL=None, db_type="snow", budget=55535, relevant_columns=None, question=None):
+    """M_Schema of the selected tables, pruned to `budget` tokens (see prune_schema)."""
+    return prune_schema(M_Schema_layout(db_id, SL, db_type), budget, relevant_columns,
+                        table_costs=get_catalog(db_id, db_type).token_costs, question=question, selected_tables=SL)
+
+
+def _near(estimate, threshold, options):
+    return threshold is None or abs(estimate - threshold) <= threshold * options["confirm_margin"]
+
+
+def measured_mschema(db_id, SL=None, db_type="snow", threshold=None):
+    """
+    M_Schema of the selected tables with its token count. The count is the sum of the precomputed costs;
+    the rendered schema is only tokenized when that sum is within confirm_margin of `threshold`.
+
+    Returns:
+        tuple: (schema_text, token_count)
+    """
+    options = get_pruning_options()
+    layout = M_Schema_layout(db_id, SL, db_type)
+    text = render_mschema(layout)
+    estimate = _Pruner(layout, None, options, get_token_counts, get_catalog(db_id, db_type).token_costs,
+                       special_tokens=get_token_count("")).estimate
+    with _stats_lock:
+        _stats["size_checks"] += 1
+        if _near(estimate, threshold, options):
+            _stats["exact_counts"] += 1
+    if _near(estimate, threshold, options):
+        return text, get_token_count(text)
+    return text, estimate
+
+
+@lru_cache(maxsize=None)
+def _ddl_joiner_costs():
+    """Special tokens of get_token_count, and the counts of the DDL separators: ";\n\n" and the final ";" of
+    get_tables_ddl_sqlite, "\n" of generate_ddl_from_json."""
+    return (get_token_count(""), *get_token_counts([";\n\n", ";", "\n"]))
+
+
+def ddl_token_count(db_id, table_list=None, db_type="snow", threshold=None, render=None):
+    """
+    Token count of the DDL of the selected tables, summed from the precomputed per-table costs (same table
+    selection as generate_ddl_from_json / get_tables_ddl_sqlite). The DDL is only rendered with
+    `render()` (default generate_ddl_from_json) and tokenized when a table has no precomputed cost or the
+    sum is within confirm_margin of `threshold`.
+    """
+    options = get_pruning_options()
+    if render is None:
+        render = lambda: generate_ddl_from_json(db_id, table_list, db_type=db_type)
+    catalog = get_catalog(db_id, db_type)
+    special, sqlite_separator, sqlite_end, newline = _ddl_joiner_costs()
+    if db_type == "sqlite":
+        wanted = set(table_list) if table_list else None
+        selected = [(top, key) for top, _, key in catalog.iter_table_keys() if wanted is None or key in wanted]
+        separator, end = sqlite_separator, sqlite_end  # ";\n\n".join(statements) + ";"
+    else:
+        cleaned = {clean_table_name(t) for t in table_list} if table_list else None
+        selected = [(top, key) for top, _, key in catalog.iter_table_keys()
+                    if cleaned is None or clean_table_name(f"{db_id if db_type == 'snow' else top}.{key}") in cleaned]
+        separator, end = newline, 0  # "\n".join(statements)
+
+    # Tables without a statement (ddl 0) are skipped by the renderers; no statement renders ""
+    estimate, statements = 0, 0
+    for top, key in selected:
+        costs = catalog.token_costs(key, top)
+        if costs is None:
+            estimate = None
+            break
+        if costs["ddl"]:
+            estimate += costs["ddl"]
+            statements += 1
+    if estimate is not None:
+        estimate += special + (((statements - 1) * separator + end) if statements else 0)
+    exact = estimate is None or _near(estimate, threshold, options)
+    with _stats_lock:
+        _stats["size_checks"] += 1
+        _stats["exact_counts"] += int(exact)
+    if exact:
+        return get_token_count(render())
+    return estimate
+
+
+def get_schema_pruning_stats():
+    """
+    Returns the number of schemas pruned and still over budget, the removals per step, the tables served
+    from precomputed costs and the size checks that needed the exact tokenizer.
+    """
+    with _stats_lock:
+        return {**_stats, "removed": dict(_stats["removed"])} if _stats["schemas"] or _stats["size_checks"] else {}
@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import argparse
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# --- Compiled binary schema store ---
+# The Snowflake and BigQuery {db}_M-Schema.json files reach tens of MB, while an instance usually needs a
+# handful of tables. compile_schema_store turns a schema file into {db}_M-Schema.bin:
+#
+#   header     magic, version, record count, size and mtime_ns of the source JSON, offset table position,
+#              directory length
+#   directory  JSON skeleton: foreign keys, top-level keys, the (top-level key, dataset, table key, non-empty)
+#              of every table in file order and the (top-level key, dataset) of every Snowflake schema /
+#              BigQuery dataset
+#   records    one UTF-8 JSON blob per table ({"columns": [...], "description": ...}), followed by one per
+#              dataset with its table_Information
+#   offsets    (offset, length) of every record, as little-endian uint64 / uint32
+#
+# SchemaStore memory-maps the file: opening it parses only the directory, and record(i) decodes a single
+# table. Worker processes that open the same store share its pages through the OS page cache instead of
+# each holding a parsed copy of the whole schema. A store whose stamp does not match the size and mtime of
+# its JSON is stale and rebuilt (utils/schema_catalog.py compiles missing or stale stores on load).
+#
+# Records are JSON rather than msgpack so the store needs no extra dependency; per-record decoding is
+# what avoids parsing the whole file.
+#
+# python -m utils.schema_store compiles every schema file of the database directories in DB.json
+# (or of the directories given with --db_type).
+
+MAGIC = b"DSRSCHM1"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQqQQ")   # magic, version, records, source size, source mtime_ns, offsets at, directory length
+OFFSET = struct.Struct("<QI")         # record offset, record length
+
+META_KEYS = ("table_Information", "table_description_summary")
+STORE_SUFFIX = ".bin"
+
+
+def store_path_for(json_path):
+    """{db}_M-Schema.json -> {db}_M-Schema.bin"""
+    return (json_path[:-len(".json")] if json_path.endswith(".json") else json_path) + STORE_SUFFIX
+
+
+def source_stamp(json_path):
+    stat = os.stat(json_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def build_skeleton(db_type, db_id, data):
+    """
+    Splits a parsed schema file into its directory and its records.
+
+    Returns:
+        tuple: (directory, records) where records[i] is the record of directory["tables"][i] for the first
+        len(tables) records and the table_Information of directory["datasets"][j] after them.
+    """
+    tops, tables, datasets, records, infos = [], [], [], [], []
+    foreign_keys = {}
+
+    def add_container(top_key, dataset_key, content):
+        summaries = content.get("table_description_summary", {})
+        for table_key, columns in content.items():
+            if table_key in META_KEYS:
+                continue
+            tables.append([top_key, dataset_key, table_key, bool(columns)])
+            records.append({"columns": columns, "description": summaries.get(table_key)})
+        if dataset_key is not None:
+            datasets.append([top_key, dataset_key])
+            infos.append(content.get("table_Information", {}))
+
+    if db_type == "sqlite":
+        foreign_keys = data.get("foreign_keys", {})
+        # Some files are {"AdventureWorks": {...}, "foreign_keys": {...}} under another key than the db_id
+        db_key = db_id if isinstance(data.get(db_id), dict) else next(
+            (k for k, v in data.items() if k != "foreign_keys" and isinstance(v, dict)), None)
+        if db_key is not None:
+            tops.append(db_key)
+            add_container(db_key, None, data[db_key])
+    elif db_type == "bigquery":
+        for project, db_content in data.items():
+            if not isinstance(db_content, dict):
+                continue
+            tops.append(project)
+            for dataset, dataset_content in db_content.items():
+                if isinstance(dataset_content, dict):
+                    add_container(project, dataset, dataset_content)
+    else:
+        for schema, schema_content in data.items():
+            if isinstance(schema_content, dict):
+                tops.append(schema)
+                add_container(schema, schema, schema_content)
+
+    directory = {"db_type": db_type, "db_id": db_id, "foreign_keys": foreign_keys, "tops": tops,
+                 "tables": tables, "datasets": datasets}
+    return directory, records + infos
+
+
+def compile_schema_store(db_type, db_id, json_path, data=None):
+    """
+    Writes the binary store of a schema file next to it.
+
+    Args:
+        db_type (str): sqlite, snow or bigquery.
+        db_id (str): The database id the file belongs to.
+        json_path (str): Path of the {db}_M-Schema.json file.
+        data (dict): The already parsed file, to avoid reading it again.
+
+    Returns:
+        str: Path of the written store.
+    """
+    size, mtime_ns = source_stamp(json_path)
+    if data is None:
+        with open(json_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    directory, records = build_skeleton(db_type, db_id, data)
+
+    directory_blob = json.dumps(directory, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    store_path = store_path_for(json_path)
+    tmp_path = f"{store_path}.{os.getpid()}.tmp"
+    offsets = []
+    with open(tmp_path, 'wb') as f:
+        f.write(b"\0" * HEADER.size)
+        f.write(directory_blob)
+        for record in records:
+            blob = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            offsets.append((f.tell(), len(blob)))
+            f.write(blob)
+        offsets_at = f.tell()
+        for offset, length in offsets:
+            f.write(OFFSET.pack(offset, length))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, len(records), size, mtime_ns, offsets_at, len(directory_blob)))
+    # Readers that have the old store mapped keep their (unlinked) copy
+    os.replace(tmp_path, store_path)
+    return store_path
+
+
+class SchemaStore:
+    """Read-only, memory-mapped access to a compiled schema store."""
+    def __init__(self, store_path):
+        self.path = store_path
+        with open(store_path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.n_records, size, mtime_ns, self._offsets_at, directory_length = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mm.close()
+            raise ValueError(f"Not a schema store of version {VERSION}: {store_path}")
+        self.source = (size, mtime_ns)
+        self.directory = json.loads(self._mm[HEADER.size:HEADER.size + directory_length])
+
+    def record(self, index):
+        """Decodes record `index` only."""
+        if not 0 <= index < self.n_records:
+            raise IndexError(f"Record {index} out of range ({self.n_records} records)")
+        offset, length = OFFSET.unpack_from(self._mm, self._offsets_at + index * OFFSET.size)
+        return json.loads(self._mm[offset:offset + length])
+
+    def close(self):
+        self._mm.close()
+
+
+def open_schema_store(json_path):
+    """The store of a schema file, or None when it is missing, unreadable or older than the JSON."""
+    store_path = store_path_for(json_path)
+    if not os.path.exists(store_path):
+        return None
+    try:
+        store = SchemaStore(store_path)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"[Schema store] Ignoring unreadable store {store_path}: {e}")
+        return None
+    if store.source != source_stamp(json_path):
+        store.close()
+        return None
+    return store
+
+
+def schema_files(base_dir):
+    """(db_id, json_path) of every {db}_M-Schema.json directly below the database folders of base_dir."""
+    if not base_dir or not os.path.isdir(base_dir):
+        return
+    for folder in sorted(os.listdir(base_dir)):
+        folder_path = os.path.join(base_dir, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        # The file name does not always match the case of its folder (BigQuery)
+        for name in sorted(os.listdir(folder_path)):
+            if name.endswith("_M-Schema.json"):
+                yield name[:-len("_M-Schema.json")], os.path.join(folder_path, name)
+
+
+if __name__ == "__main__":
+    from utils.DBsetup.Get_DB import read_db_config
+
+    parser = argparse.ArgumentParser(description="Compile {db}_M-Schema.json files into binary schema stores")
+    parser.add_argument("--db_type", choices=["sqlite", "snow", "bigquery"], default=None,
+                        help="Only compile this database type (default: all types configured in DB.json)")
+    parser.add_argument("--dir", default=None, help="Database directory to compile instead of the one in DB.json")
+    parser.add_argument("--force", action="store_true", help="Rebuild stores that are up to date")
+    args = parser.parse_args()
+
+    sqlite_dir, snow_dir, bigquery_dir, _, _ = read_db_config()
+    base_dirs = {"sqlite": sqlite_dir, "snow": snow_dir, "bigquery": bigquery_dir}
+    if args.dir:
+        if not args.db_type:
+            parser.error("--dir requires --db_type")
+        base_dirs = {args.db_type: args.dir}
+    elif args.db_type:
+        base_dirs = {args.db_type: base_dirs[args.db_type]}
+
+    for db_type, base_dir in base_dirs.items():
+        compiled = skipped = 0
+        for db_id, json_path in schema_files(base_dir):
+            store = None if args.force else open_schema_store(json_path)
+            if store is not None:
+                store.close()
+                skipped += 1
+                continue
+            store_path = compile_schema_store(db_type, db_id, json_path)
+            compiled += 1
+            print(f"  {db_id}: {os.path.getsize(json_path) / 1024:.0f} KiB -> {os.path.getsize(store_path) / 1024:.0f} KiB")
+        print(f"[{db_type}] {compiled} stores compiled, {skipped} up to date ({base_dir})")
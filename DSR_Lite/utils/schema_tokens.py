@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import sqlite3
+import argparse
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils.schema_store import build_skeleton, schema_files, source_stamp
+from utils.schema_format import (mschema_column, mschema_indent, render_mschema_column,
+                                 snow_table_ddl, bigquery_table_ddl)
+
+# --- Precomputed token costs ---
+# Every schema-size decision (process_entry's MAX_MSchema_TOKEN, SL_workflow's max_token checks) used to
+# render the schema and run the tokenizer over tens of thousands of tokens. The preprocessors now also
+# write {db}_M-Schema.tokens.json next to the schema file, with the token count of every element the
+# renderers of utils/schema_format.py produce:
+#   {"format": TOKENS_FORMAT,
+#    "source": {"size", "mtime_ns"},                      size and mtime of the schema file
+#    "tables": {top-level key: {table key: {
+#        "name":        "# Table: ..." line
+#        "description": "# Table Description: ..." line (0 when the table has none)
+#        "columns":     {column: [line without description and examples, ", <description>", ", <examples>"]}
+#        "ddl":         CREATE TABLE statement of generate_ddl_from_json (0 when it writes none, e.g. for a
+#                       table whose columns are not a list)}}}}
+# Counts are taken without special tokens and without what the renderers put between the elements (the
+# newline after each line, the "," after every column but the last, the separators of the DDL
+# statements); utils/schema_pruning.py adds those itself. The schema catalog serves the counts
+# (SchemaCatalog.token_costs), so a budget check is a sum over the selected tables; the tokenizer only
+# confirms sizes near a threshold. A sidecar whose stamp does not match its schema file, or that was
+# written in another format, is ignored.
+#
+# python -m utils.schema_tokens backfills the sidecars of schema files preprocessed before (or of the
+# directory given with --db_type / --dir).
+
+TOKENS_SUFFIX = ".tokens.json"
+# Version of the sidecar layout; sidecars of another version are recounted
+TOKENS_FORMAT = 2
+
+
+def token_costs_path(json_path):
+    """{db}_M-Schema.json -> {db}_M-Schema.tokens.json"""
+    return (json_path[:-len(".json")] if json_path.endswith(".json") else json_path) + TOKENS_SUFFIX
+
+
+def sqlite_table_ddl(conn):
+    """Table name -> CREATE statement from sqlite_master, the DDL get_tables_ddl_sqlite returns."""
+    rows = conn.execute("SELECT name, sql FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'").fetchall()
+    return {name: sql for name, sql in rows if sql}
+
+
+def compute_token_costs(db_type, db_id, data, sqlite_ddl=None, count=None):
+    """
+    Counts the elements of every table of a parsed schema file in one batch tokenizer call.
+
+    Args:
+        db_type (str): sqlite, snow or bigquery.
+        db_id (str): The database id the file belongs to.
+        data (dict): The parsed {db}_M-Schema.json.
+        sqlite_ddl (dict): For SQLite, table name -> CREATE statement (see sqlite_table_ddl).
+        count (callable): Token counts of a list of texts (default: the DeepSeek tokenizer).
+
+    Returns:
+        dict: top-level key -> table key -> costs, the "tables" entry of the sidecar.
+    """
+    if count is None:
+        from utils.mytoken.deepseek_tokenizer import get_token_counts
+        count = get_token_counts
+    directory, records = build_skeleton(db_type, db_id, data)
+    indent = mschema_indent(db_type)
+    texts = []
+
+    def slot(text):
+        if not text:
+            return None
+        texts.append(text)
+        return len(texts) - 1
+
+    tables = []
+    for (top_key, _, table_key, _), record in zip(directory["tables"], records):
+        columns = record["columns"] if isinstance(record["columns"], list) else []
+        display_name = table_key if db_type == "sqlite" else f"{db_id if db_type == 'snow' else top_key}.{table_key}"
+        if db_type == "sqlite":
+            ddl = (sqlite_ddl or {}).get(table_key)
+        elif not isinstance(record["columns"], list):
+            # generate_ddl_from_json skips these tables
+            ddl = None
+        elif db_type == "bigquery":
+            ddl = bigquery_table_ddl(display_name, columns, record["description"])
+        else:
+            ddl = snow_table_ddl(display_name, columns, record["description"])
+        column_slots = {}
+        for col_info in columns:
+            column = mschema_column(db_type, col_info)
+            if column is None:
+                continue
+            line = render_mschema_column({**column, "description": None, "examples": None}, indent)
+            column_slots[column["name"]] = (slot(line),
+                                            slot(", " + column["description"]) if column["description"] else None,
+                                            slot(", " + column["examples"]) if column["examples"] else None)
+        description = record["description"] if db_type != "sqlite" else None
+        tables.append((top_key, table_key, slot(f"# Table: {display_name}"),
+                       slot(f"# Table Description: {description}") if description else None,
+                       column_slots, slot(ddl)))
+
+    counts = count(texts)
+
+    def value(i):
+        return counts[i] if i is not None else 0
+
+    costs = {}
+    for top_key, table_key, name, description, column_slots, ddl in tables:
+        costs.setdefault(top_key, {})[table_key] = {
+            "name": value(name),
+            "description": value(description),
+            "columns": {col: [value(i) for i in slots] for col, slots in column_slots.items()},
+            "ddl": value(ddl)
+        }
+    return costs
+
+
+def write_token_costs(db_type, db_id, json_path, data=None, sqlite_ddl=None):
+    """
+    Writes the token cost sidecar of a schema file (called by the preprocessors after writing it).
+
+    Returns:
+        str: Path of the written sidecar.
+    """
+    json_path = str(json_path)
+    size, mtime_ns = source_stamp(json_path)
+    if data is None:
+        with open(json_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    costs = compute_token_costs(db_type, db_id, data, sqlite_ddl)
+    sidecar_path = token_costs_path(json_path)
+    tmp_path = f"{sidecar_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"format": TOKENS_FORMAT, "source": {"size": size, "mtime_ns": mtime_ns}, "tables": costs}, f,
+                  ensure_ascii=False)
+    os.replace(tmp_path, sidecar_path)
+    return sidecar_path
+
+
+def load_token_costs(json_path):
+    """The "tables" of the sidecar of a schema file, or None when it is missing, unreadable, stale or of another format."""
+    sidecar_path = token_costs_path(json_path)
+    if not os.path.exists(sidecar_path):
+        return None
+    try:
+        with open(sidecar_path, 'r', encoding='utf-8') as f:
+            sidecar = json.load(f)
+        size, mtime_ns = source_stamp(json_path)
+        if sidecar.get("format") != TOKENS_FORMAT or sidecar.get("source") != {"size": size, "mtime_ns": mtime_ns}:
+            return None
+        return sidecar["tables"]
+    except (OSError, ValueError, KeyError, AttributeError) as e:
+        print(f"[Schema tokens] Ignoring unreadable token costs {sidecar_path}: {e}")
+        return None
+
+
+def write_token_costs_safely(db_type, db_id, json_path, data=None, sqlite_ddl=None):
+    """
+    write_token_costs for the preprocessors: a failure is reported and only costs the exact counts later.
+
+    Returns:
+        str: Path of the written sidecar, or None when it could not be written.
+    """
+    try:
+        sidecar_path = write_token_costs(db_type, db_id, json_path, data, sqlite_ddl)
+        print(f"Token costs saved: {sidecar_path}")
+        return sidecar_path
+    except Exception as e:
+        print(f"Warning: Could not write the token costs of '{json_path}': {e}")
+        return None
+
+
+if __name__ == "__main__":
+    from utils.DBsetup.Get_DB import read_db_config
+
+    parser = argparse.ArgumentParser(description="Backfill {db}_M-Schema.tokens.json for preprocessed schema files")
+    parser.add_argument("--db_type", choices=["sqlite", "snow", "bigquery"], default=None,
+                        help="Only this database type (default: all types configured in DB.json)")
+    parser.add_argument("--dir", default=None, help="Database directory to process instead of the one in DB.json")
+    parser.add_argument("--force", action="store_true", help="Recount sidecars that are up to date")
+    args = parser.parse_args()
+
+    sqlite_dir, snow_dir, bigquery_dir, _, _ = read_db_config()
+    base_dirs = {"sqlite": sqlite_dir, "snow": snow_dir, "bigquery": bigquery_dir}
+    if args.dir:
+        if not args.db_type:
+            parser.error("--dir requires --db_type")
+        base_dirs = {args.db_type: args.dir}
+    elif args.db_type:
+        base_dirs = {args.db_type: base_dirs[args.db_type]}
+
+    for db_type, base_dir in base_dirs.items():
+        written = skipped = failed = 0
+        for db_id, json_path in schema_files(base_dir):
+            if not args.force and load_token_costs(json_path) is not None:
+                skipped += 1
+                continue
+            sqlite_ddl = None
+            if db_type == "sqlite":
+                db_path = os.path.join(os.path.dirname(json_path), f"{db_id}.sqlite")
+                if os.path.exists(db_path):
+                    try:
+                        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+                        try:
+                            sqlite_ddl = sqlite_table_ddl(conn)
+                        finally:
+                            conn.close()
+                    except sqlite3.Error as e:
+                        print(f"Warning: Could not read the DDL of '{db_path}': {e}")
+                        failed += 1
+                        continue
+            # One malformed schema file is reported and skipped, the others are still processed
+            if write_token_costs_safely(db_type, db_id, json_path, sqlite_ddl=sqlite_ddl):
+                written += 1
+            else:
+                failed += 1
+        print(f"[{db_type}] {written} token cost files written, {skipped} up to date, {failed} failed ({base_dir})")
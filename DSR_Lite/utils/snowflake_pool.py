@@ -0,0 +1,235 @@
+import time
+import threading
+
+import snowflake.connector
+
+from utils.DBsetup.Get_DB import read_db_options
+
+# --- Pooled Snowflake sessions with asynchronous queries ---
+# Opening an authenticated Snowflake session takes seconds. Instead of connecting in a fresh child
+# process for every query, each set of credentials gets a long-lived pool of sessions that is shared by
+# all stages and threads. Queries are submitted with execute_async and polled by query id; a query that
+# runs past its deadline is cancelled on the server with SYSTEM$CANCEL_QUERY, so the warehouse stops
+# working on it and the session can be reused right away.
+#
+# Options come from the "Options" entry of the Snowflake item in utils/DBsetup/DB.json:
+#   pool_size            - sessions kept per set of credentials (callers wait when all are busy)
+#   warmup               - sessions opened in the background as soon as the pool is created
+#   timeout              - seconds before a running query is cancelled
+#   timeout_retries      - how often a cancelled query is submitted again
+#   retry_timeout_factor - deadline multiplier for each retry
+#   poll_interval        - longest pause between two status checks (polling starts at 50 ms and backs off)
+#   statement_timeout    - STATEMENT_TIMEOUT_IN_SECONDS of every session, a server-side backstop for
+#                          queries whose client went away (0 keeps the account default)
+#   max_retries          - attempts on a fresh session after a connection failure
+#   max_concurrent_queries - queries db_interface runs at the same time against one database
+
+DEFAULT_SNOWFLAKE_OPTIONS = {
+    "pool_size": 4,
+    "warmup": 1,
+    "timeout": 200,
+    "timeout_retries": 1,
+    "retry_timeout_factor": 1.0,
+    "poll_interval": 1.0,
+    "statement_timeout": 900,
+    "max_retries": 3,
+    "max_concurrent_queries": 4
+}
+
+FIRST_POLL_INTERVAL = 0.05
+
+_options = None
+_pools = {}
+_registry_lock = threading.Lock()
+
+
+def get_snowflake_options():
+    global _options
+    if _options is None:
+        _options = {**DEFAULT_SNOWFLAKE_OPTIONS, **read_db_options("snowflake")}
+    return _options
+
+
+def open_session(credentials, options=None):
+    """
+    Opens an authenticated session that stays alive between queries.
+
+    Args:
+        credentials (dict): user, password, account, role and warehouse (snowflake_credential.json).
+        options (dict): Overrides of get_snowflake_options().
+
+    Returns:
+        snowflake.connector.SnowflakeConnection
+    """
+    options = {**get_snowflake_options(), **(options or {})}
+    session_parameters = {"QUERY_TAG": "DSR-SQL"}
+    if options["statement_timeout"]:
+        session_parameters["STATEMENT_TIMEOUT_IN_SECONDS"] = int(options["statement_timeout"])
+    return snowflake.connector.connect(
+        user=credentials["user"],
+        password=credentials["password"],
+        account=credentials["account"],
+        role=credentials["role"],
+        warehouse=credentials["warehouse"],
+        client_session_keep_alive=True,
+        session_parameters=session_parameters
+    )
+
+
+class SnowflakePool:
+    """A bounded pool of authenticated sessions for one set of credentials."""
+    def __init__(self, credentials, size, warmup=0):
+        self.credentials = credentials
+        self.name = f"{credentials.get('user')}@{credentials.get('account')}/{credentials.get('warehouse')}"
+        self.size = max(1, int(size))
+        self._idle = []
+        self._open = 0
+        self.closed = False
+        self._cond = threading.Condition()
+        self.stats = {"queries": 0, "sessions_opened": 0, "reused": 0, "waits": 0, "wait_seconds": 0.0,
+                      "discarded": 0, "cancelled": 0}
+        for _ in range(min(int(warmup), self.size)):
+            with self._cond:
+                self._open += 1
+            threading.Thread(target=self._warm_up, daemon=True).start()
+
+    def _open_session(self):
+        try:
+            session = open_session(self.credentials)
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.stats["sessions_opened"] += 1
+        return session
+
+    def _warm_up(self):
+        try:
+            session = self._open_session()
+        except Exception as e:
+            print(f"[Snowflake pool] Warm-up session for '{self.name}' failed: {e}")
+            return
+        with self._cond:
+            self._idle.append(session)
+            self._cond.notify()
+
+    def acquire(self):
+        """Takes an idle session, opens a new one below pool_size, or waits for one to be released."""
+        while True:
+            with self._cond:
+                start = None
+                while not self._idle and self._open >= self.size:
+                    if start is None:
+                        start = time.monotonic()
+                        self.stats["waits"] += 1
+                    self._cond.wait()
+                if start is not None:
+                    self.stats["wait_seconds"] += time.monotonic() - start
+                if not self._idle:
+                    self.stats["queries"] += 1
+                    self._open += 1
+                    break
+                session = self._idle.pop()
+            # Sessions expire on the server after long idle periods; replace those instead of failing the query
+            if session.is_closed():
+                self.release(session, discard=True)
+                continue
+            with self._cond:
+                self.stats["queries"] += 1
+                self.stats["reused"] += 1
+            return session
+        return self._open_session()
+
+    def release(self, session, discard=False):
+        """Returns a session to the pool; discard=True closes it instead (e.g. after a connection failure)."""
+        with self._cond:
+            discard = discard or self.closed
+            if discard:
+                self._open -= 1
+                self.stats["discarded"] += 1
+            else:
+                self._idle.append(session)
+            self._cond.notify()
+        if discard:
+            try:
+                session.close()
+            except Exception:
+                pass
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for session in idle:
+            try:
+                session.close()
+            except Exception:
+                pass
+
+
+def wait_for_query(pool, session, query_id, timeout):
+    """
+    Polls an asynchronous query until it finishes. A query still running at the deadline is cancelled
+    on the server. Errors of the query itself are raised as the connector's ProgrammingError / DatabaseError.
+
+    Returns:
+        bool: True when the query finished, False when it was cancelled.
+    """
+    deadline = time.monotonic() + timeout
+    interval = FIRST_POLL_INTERVAL
+    max_interval = get_snowflake_options()["poll_interval"]
+    while session.is_still_running(session.get_query_status_throw_if_error(query_id)):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            cancel_query(pool, session, query_id)
+            return False
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+    return True
+
+
+def cancel_query(pool, session, query_id):
+    """Cancels a running query with SYSTEM$CANCEL_QUERY on the session that submitted it."""
+    with pool._cond:
+        pool.stats["cancelled"] += 1
+    cursor = session.cursor()
+    try:
+        cursor.execute(f"SELECT SYSTEM$CANCEL_QUERY('{query_id}')")
+    except Exception as e:
+        print(f"[Snowflake pool] Failed to cancel query {query_id}: {e}")
+    finally:
+        cursor.close()
+
+
+def get_snowflake_pool(credentials):
+    """Returns the process-wide pool of a set of credentials, creating (and warming up) it on first use."""
+    key = (credentials.get("user"), credentials.get("account"), credentials.get("role"), credentials.get("warehouse"))
+    pool = _pools.get(key)
+    if pool is None:
+        with _registry_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                options = get_snowflake_options()
+                pool = SnowflakePool(credentials, options["pool_size"], options["warmup"])
+                _pools[key] = pool
+    return pool
+
+
+def get_snowflake_pool_stats():
+    """Returns the counters of every pool used so far, keyed by user@account/warehouse."""
+    with _registry_lock:
+        pools = list(_pools.values())
+    return {pool.name: {k: (round(v, 3) if isinstance(v, float) else v) for k, v in pool.stats.items()}
+            for pool in pools}
+
+
+def close_snowflake_pools():
+    """Closes every pool; sessions still in use are closed when they are given back."""
+    with _registry_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
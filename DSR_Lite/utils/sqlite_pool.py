@@ -0,0 +1,220 @@
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from utils.DBsetup.Get_DB import read_db_options
+
+# --- Pooled read-only SQLite connections ---
+# Exploration, generation and repair run dozens of queries per instance against the same Spider2 file.
+# Instead of opening a fresh read-write connection for each of them, every database file gets a small
+# pool of read-only connections that is shared by all stages and threads, so the page cache and the
+# memory map stay warm between queries.
+#
+# Options come from the "Options" entry of the Sqlite item in utils/DBsetup/DB.json:
+#   pool_size   - connections kept per database file (callers wait when all are busy)
+#   immutable   - open with immutable=1 (no locking, no change detection); skipped when a -wal file exists
+#   mmap_size   - PRAGMA mmap_size in bytes (0 disables memory-mapped I/O)
+#   cache_size  - PRAGMA cache_size (negative values are KiB, positive values are pages)
+#   temp_store  - PRAGMA temp_store (DEFAULT | FILE | MEMORY)
+#
+# Query deadlines (used by execute_sqlite_query in utils/Database_Interface.py):
+#   timeout              - seconds before SQLite aborts the statement through the progress handler
+#   timeout_retries      - how often a timed-out query is run again (0 reports the timeout right away)
+#   retry_timeout_factor - deadline multiplier for each retry
+#   hard_kill            - run each query in a child process that is killed after the deadline
+#   hard_kill_grace      - seconds the child gets past the deadline before it is killed
+#
+# Resource-limited worker processes (sandbox, sandbox_workers, sandbox_memory_mb, sandbox_temp_mb,
+# sandbox_cpu_seconds, sandbox_max_queries) are described in utils/sqlite_sandbox.py.
+#
+# max_concurrent_queries caps the queries db_interface runs at the same time against one database file.
+
+DEFAULT_SQLITE_OPTIONS = {
+    "pool_size": 4,
+    "immutable": True,
+    "mmap_size": 268435456,   # 256 MiB
+    "cache_size": -65536,     # 64 MiB
+    "temp_store": "MEMORY",
+    "timeout": 30,
+    "timeout_retries": 1,
+    "retry_timeout_factor": 1.0,
+    "hard_kill": False,
+    "hard_kill_grace": 5,
+    "sandbox": False,
+    "sandbox_workers": 4,
+    "sandbox_memory_mb": 2048,
+    "sandbox_temp_mb": 4096,
+    "sandbox_cpu_seconds": 120,
+    "sandbox_max_queries": 200,
+    "max_concurrent_queries": 4
+}
+
+_options = None
+_pools = {}
+_inherited_pools = []
+_registry_lock = threading.Lock()
+
+
+def get_sqlite_options():
+    global _options
+    if _options is None:
+        _options = {**DEFAULT_SQLITE_OPTIONS, **read_db_options("sqlite")}
+    return _options
+
+
+def open_readonly_connection(db_path, options=None):
+    """
+    Opens a tuned read-only connection that may be used from any thread (one thread at a time).
+
+    Args:
+        db_path (str): Path of the .sqlite file.
+        options (dict): Overrides of get_sqlite_options().
+
+    Returns:
+        sqlite3.Connection
+    """
+    options = {**get_sqlite_options(), **(options or {})}
+    if not os.path.exists(db_path):
+        # mode=ro never creates the file, so report the same error a read-write connect would hit later
+        raise sqlite3.OperationalError(f"unable to open database file: {db_path}")
+
+    uri = f"file:{quote(os.path.abspath(db_path))}?mode=ro"
+    # immutable=1 is only safe for files nobody writes to; a -wal file means another writer is (or was) active
+    if options["immutable"] and not os.path.exists(db_path + "-wal"):
+        uri += "&immutable=1"
+
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    conn.execute("PRAGMA query_only = 1")
+    conn.execute(f"PRAGMA mmap_size = {int(options['mmap_size'])}")
+    conn.execute(f"PRAGMA cache_size = {int(options['cache_size'])}")
+    conn.execute(f"PRAGMA temp_store = {options['temp_store']}")
+    return conn
+
+
+class SQLitePool:
+    """A bounded pool of read-only connections to one database file."""
+    def __init__(self, db_path, size):
+        self.db_path = db_path
+        self.size = max(1, int(size))
+        self._idle = []       # most recently used connection last, so the warmest one is reused first
+        self._open = 0
+        self.closed = False
+        self._cond = threading.Condition()
+        self.stats = {"queries": 0, "connections_opened": 0, "reused": 0, "waits": 0, "wait_seconds": 0.0, "discarded": 0}
+
+    def acquire(self):
+        """Takes an idle connection, opens a new one below pool_size, or waits for one to be released."""
+        with self._cond:
+            start = None
+            while not self._idle and self._open >= self.size:
+                if start is None:
+                    start = time.monotonic()
+                    self.stats["waits"] += 1
+                self._cond.wait()
+            if start is not None:
+                self.stats["wait_seconds"] += time.monotonic() - start
+            self.stats["queries"] += 1
+            if self._idle:
+                self.stats["reused"] += 1
+                return self._idle.pop()
+            self._open += 1
+
+        try:
+            conn = open_readonly_connection(self.db_path)
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.stats["connections_opened"] += 1
+        return conn
+
+    def release(self, conn, discard=False):
+        """Returns a connection to the pool; discard=True closes it instead (e.g. after an unexpected error)."""
+        with self._cond:
+            discard = discard or self.closed
+            if discard:
+                self._open -= 1
+                self.stats["discarded"] += 1
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+        if discard:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection for the duration of the block. A connection whose block raised something
+        other than an SQL error is closed instead of being returned to the pool.
+        """
+        conn = self.acquire()
+        discard = False
+        try:
+            yield conn
+        except (sqlite3.ProgrammingError, sqlite3.OperationalError):
+            raise
+        except BaseException:
+            discard = True
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+def get_sqlite_pool(db_path):
+    """Returns the process-wide pool of a database file, creating it on first use."""
+    key = os.path.abspath(db_path)
+    pool = _pools.get(key)
+    if pool is None:
+        with _registry_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = SQLitePool(key, get_sqlite_options()["pool_size"])
+                _pools[key] = pool
+    return pool
+
+
+def get_sqlite_pool_stats():
+    """Returns the counters of every pool used so far, keyed by database file name."""
+    with _registry_lock:
+        pools = list(_pools.values())
+    return {os.path.basename(pool.db_path): {k: (round(v, 3) if isinstance(v, float) else v) for k, v in pool.stats.items()}
+            for pool in pools}
+
+
+def detach_pools_after_fork():
+    """
+    Forgets the pools inherited by a forked child. Their connections belong to the parent (they are kept
+    referenced, not closed) and the registry lock may have been held by one of its threads at fork time.
+    """
+    global _registry_lock, _inherited_pools
+    _inherited_pools = list(_pools.values())
+    _pools.clear()
+    _registry_lock = threading.Lock()
+
+
+def close_sqlite_pools():
+    """Closes every pool; connections still in use are closed when they are given back."""
+    with _registry_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
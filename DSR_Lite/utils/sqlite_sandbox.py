@@ -0,0 +1,296 @@
+import os
+import signal
+import sqlite3
+import threading
+import multiprocessing
+
+try:
+    import resource
+except ImportError:  # Windows: workers run without OS limits
+    resource = None
+
+from utils.sqlite_pool import get_sqlite_options, detach_pools_after_fork, close_sqlite_pools
+from utils.query_validation import take_phase_stats, merge_phase_stats
+
+# --- Resource-limited SQLite sandbox ---
+# A generated query such as an unbounded self-join or a recursive CTE without a stop condition can eat all
+# memory or temp disk of the runner, and in-process it takes down every thread of the run with it. With the
+# "sandbox" option, execute_sqlite_query sends SQLite queries to a pool of pre-forked worker processes
+# instead; each worker runs under OS limits and answers over a pipe with the usual (status, message):
+#   - PRAGMA hard_heap_limit caps the memory of SQLite itself (including temp_store = MEMORY), so most
+#     runaway queries end with a clean "out of memory" error;
+#   - RLIMIT_AS caps the whole worker as a backstop (the address space it inherited plus the memory cap and
+#     the mmap window of its connection; a worker only keeps connections to the database of its last query);
+#   - RLIMIT_FSIZE caps temp files (sorts and temp tables with temp_store = FILE);
+#   - RLIMIT_CPU caps the CPU seconds of each query; the kernel stops the worker when it is exceeded.
+# A worker is replaced after sandbox_max_queries queries, after a limit breach, and when it does not answer
+# hard_kill_grace seconds past the query deadline.
+#
+# Workers are forked by a forkserver (spawn where it is not available), never from the runner itself: by the
+# time a worker is started or replaced, the runner already has exploration, hedging and pool threads, and a
+# plain fork would copy locks they hold (logging, the tokenizer, client pools) into the child. The server
+# preloads the module of `run`, so starting a worker stays cheap. start_sqlite_sandbox pre-forks the pool
+# at startup. The child of the "hard_kill" option (Database_Interface) is started the same way.
+#
+# Options come from the "Options" entry of the Sqlite item in utils/DBsetup/DB.json:
+#   sandbox             - run SQLite queries in the sandbox pool
+#   sandbox_workers     - worker processes (callers wait when all are busy)
+#   sandbox_memory_mb   - hard_heap_limit of SQLite and headroom of RLIMIT_AS
+#   sandbox_temp_mb     - largest temp file a query may write (0 disables the limit)
+#   sandbox_cpu_seconds - CPU time of one query (0 disables the limit)
+#   sandbox_max_queries - queries a worker runs before it is replaced
+
+MB = 1024 * 1024
+
+_sandbox = None
+_sandbox_lock = threading.Lock()
+
+
+def _address_space():
+    """Bytes of address space the current process already uses (Linux), or 0 when unknown."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def worker_context(run):
+    """
+    The multiprocessing context the workers are started with (see the module comment); also used for the
+    hard-kill child of Database_Interface.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    if "forkserver" in methods:
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload([run.__module__])
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+
+def _apply_limits(options):
+    # A worker starts without pools of its own; this only matters if it was forked from a process that had some
+    detach_pools_after_fork()
+    memory = int(options["sandbox_memory_mb"] * MB)
+    if memory:
+        conn = sqlite3.connect(":memory:")
+        conn.execute(f"PRAGMA hard_heap_limit = {memory}")  # process-wide, ignored before SQLite 3.31
+        conn.close()
+    if resource is None:
+        return
+    inherited = _address_space()
+    if memory and inherited:
+        limit = inherited + memory + int(options["mmap_size"])
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if options["sandbox_temp_mb"]:
+        # Writing past the limit then fails with EFBIG ("disk I/O error") instead of killing the worker
+        signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+        limit = int(options["sandbox_temp_mb"] * MB)
+        resource.setrlimit(resource.RLIMIT_FSIZE, (limit, limit))
+
+
+def _set_cpu_budget(seconds):
+    if resource is None or not seconds:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = int(usage.ru_utime + usage.ru_stime + seconds) + 1
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft if hard == resource.RLIM_INFINITY else min(soft, hard), hard))
+
+
+def _breach_message(result, options):
+    """The message of a query that hit the memory or temp-file limit, or None."""
+    if not isinstance(result, str):
+        return None
+    if result.endswith("out of memory"):
+        return (f"SQLite Database Error: out of memory. The query exceeded the sandbox memory limit of "
+                f"{options['sandbox_memory_mb']} MiB; avoid joins without conditions, unbounded recursive CTEs "
+                f"and DISTINCT / ORDER BY over huge intermediate results.")
+    if options["sandbox_temp_mb"] and result.endswith("disk I/O error"):
+        return (f"SQLite Database Error: disk I/O error. The query most likely exceeded the sandbox temp-file "
+                f"limit of {options['sandbox_temp_mb']} MiB; avoid sorting or grouping huge intermediate results.")
+    return None
+
+
+def _worker_main(conn, run, options):
+    _apply_limits(options)
+    take_phase_stats()  # counters inherited from the parent
+    served = 0
+    db_path = None
+    while True:
+        try:
+            args = conn.recv()
+        except (EOFError, OSError):
+            return
+        if args is None:
+            return
+        if args[1] != db_path:
+            close_sqlite_pools()
+            db_path = args[1]
+        _set_cpu_budget(options["sandbox_cpu_seconds"])
+        status, result = run(*args)
+        served += 1
+        breach = _breach_message(result, options)
+        if breach:
+            status, result = 2, breach
+        retire = bool(breach) or served >= options["sandbox_max_queries"]
+        conn.send(((status, result), take_phase_stats(), retire, bool(breach)))
+        if retire:
+            return
+
+
+class _Worker:
+    def __init__(self, ctx, run, options):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, run, options), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def stop(self, kill=False):
+        if kill and self.process.is_alive():
+            self.process.kill()
+        elif self.process.is_alive():
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+        self.process.join(timeout=None if kill else 5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class SQLiteSandbox:
+    """A pool of pre-forked, resource-limited worker processes that run `run(*args)` for SQLite queries."""
+    def __init__(self, run, options=None):
+        self.run = run
+        self.options = {**get_sqlite_options(), **(options or {})}
+        self.size = max(1, int(self.options["sandbox_workers"]))
+        self._ctx = worker_context(run)
+        self._idle = []
+        self._open = 0
+        self.closed = False
+        self._cond = threading.Condition()
+        self.stats = {"queries": 0, "workers_started": 0, "recycled": 0, "limit_breaches": 0, "killed": 0}
+        with self._cond:
+            for _ in range(self.size):
+                self._idle.append(self._start_worker())
+                self._open += 1
+
+    def _start_worker(self):
+        self.stats["workers_started"] += 1
+        return _Worker(self._ctx, self.run, self.options)
+
+    def _acquire(self):
+        with self._cond:
+            while not self._idle and self._open >= self.size:
+                self._cond.wait()
+            self.stats["queries"] += 1
+            if self._idle:
+                return self._idle.pop()
+            self._open += 1
+            try:
+                return self._start_worker()
+            except Exception:
+                self._open -= 1
+                self._cond.notify()
+                raise
+
+    def _release(self, worker, retire=False, kill=False):
+        with self._cond:
+            retire = retire or kill or self.closed
+            if retire:
+                self._open -= 1
+            else:
+                self._idle.append(worker)
+            self._cond.notify()
+        if retire:
+            worker.stop(kill=kill)
+
+    def execute(self, args, timeout, grace):
+        """
+        Runs one query in a worker.
+
+        Args:
+            args (tuple): Arguments of `run`, starting with (query, db_path, fetch_results, timeout).
+            timeout (float): Query deadline enforced inside the worker.
+            grace (float): Seconds past the deadline before an unresponsive worker is killed.
+
+        Returns:
+            tuple: (status_code, query_result_or_error_message)
+        """
+        worker = self._acquire()
+        try:
+            worker.conn.send(args)
+            if not worker.conn.poll(timeout + grace if timeout else None):
+                with self._cond:
+                    self.stats["killed"] += 1
+                self._release(worker, kill=True)
+                # Same message as the in-process deadline, so execute_sqlite_query retries it like one
+                return 2, f"SQLite Database Error: execution exceeded {timeout:g} seconds."
+            result, phase_stats, retire, breach = worker.conn.recv()
+        except (EOFError, OSError):
+            # The worker died: RLIMIT_CPU (SIGXCPU), RLIMIT_AS outside SQLite, or a crash
+            self._release(worker, kill=True)
+            with self._cond:
+                self.stats["limit_breaches"] += 1
+            code = worker.process.exitcode
+            if code is not None and code < 0 and -code == getattr(signal, "SIGXCPU", None):
+                return 2, (f"SQLite Database Error: the query exceeded the sandbox CPU limit of "
+                           f"{self.options['sandbox_cpu_seconds']} seconds.")
+            return 3, f"Unknown Error: SQLite sandbox worker exited with code {code}."
+        except BaseException:
+            self._release(worker, kill=True)
+            raise
+
+        merge_phase_stats(phase_stats)
+        if retire:
+            with self._cond:
+                self.stats["recycled"] += 1
+                self.stats["limit_breaches"] += int(breach)
+        self._release(worker, retire=retire)
+        return result
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for worker in idle:
+            worker.stop()
+
+
+def get_sqlite_sandbox(run):
+    """Returns the process-wide sandbox, pre-forking its workers on first use."""
+    global _sandbox
+    if _sandbox is None:
+        with _sandbox_lock:
+            if _sandbox is None:
+                _sandbox = SQLiteSandbox(run)
+    return _sandbox
+
+
+def start_sqlite_sandbox(run):
+    """
+    Pre-forks the sandbox workers when the "sandbox" option is on (call it at startup, before the worker
+    threads of the run exist). Returns the sandbox, or None when the option is off.
+    """
+    if not get_sqlite_options()["sandbox"]:
+        return None
+    return get_sqlite_sandbox(run)
+
+
+def get_sqlite_sandbox_stats():
+    """Returns the counters of the sandbox, or an empty dict when it was not used."""
+    sandbox = _sandbox
+    return dict(sandbox.stats) if sandbox is not None else {}
+
+
+def close_sqlite_sandbox():
+    """Stops the idle workers; busy ones stop when their query returns."""
+    global _sandbox
+    with _sandbox_lock:
+        sandbox, _sandbox = _sandbox, None
+    if sandbox is not None:
+        sandbox.close()